@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2014, The MetadataMenagerie Project"
+__credits__ = ["Jesse RR Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.1dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+"""
+Seeded generators of synthetic QIIME mapping files for benchmarks.
+
+Generated tables look like field survey metadata: a SampleID, a Site,
+categorical treatment columns, numeric measurements, collection dates
+and a Description.  Missing values are written as 'Unknown'.  The same
+arguments and seed always give the same lines.
+"""
+
+from datetime import date
+from numpy import char,arange,array,datetime64
+from numpy.random import RandomState
+
+MISSING_VALUE = "Unknown"
+FIRST_DAY = date(2010,1,1).toordinal()
+
+def generate_mapping_columns(n_rows,n_categorical_cols=3,n_numeric_cols=5,\
+    n_date_cols=1,cardinality=10,n_sites=20,missing_rate=0.1,seed=0):
+    """Return (header fields,list of string arrays) of a synthetic mapping table
+
+    n_rows -- number of samples
+    n_categorical_cols -- number of 'Treatment' columns, each with
+      cardinality distinct values
+    n_numeric_cols -- number of 'Measure' columns of floats
+    n_date_cols -- number of 'Date' columns (YYYYMMDD, over ten years)
+    n_sites -- number of distinct values of the 'Site' column
+    missing_rate -- fraction of measurement and date fields that are missing
+    seed -- seed for the random number generator
+    """
+    random = RandomState(seed)
+    header = ["SampleID","Site"]
+    columns = [char.add("S.",arange(n_rows).astype(str)),\
+      char.add("site_",random.randint(0,n_sites,n_rows).astype(str))]
+    for i in range(n_categorical_cols):
+        header.append("Treatment_%i" %i)
+        columns.append(char.add("level_",\
+          random.randint(0,cardinality,n_rows).astype(str)))
+    for i in range(n_numeric_cols):
+        header.append("Measure_%i" %i)
+        values = random.normal(25.0,5.0,n_rows).round(3).astype(str)
+        columns.append(_with_missing(values,missing_rate,random))
+    for i in range(n_date_cols):
+        header.append("Date_%i" %i)
+        days = random.randint(FIRST_DAY,FIRST_DAY+3650,n_rows)
+        columns.append(_with_missing(day_strings(days),missing_rate,random))
+    header.append("Description")
+    columns.append(array(["synthetic sample"]*n_rows))
+    return header,columns
+
+def generate_mapping_lines(n_rows,**kwargs):
+    """Return a list of the lines of a synthetic mapping file
+
+    Keyword arguments are as for generate_mapping_columns.
+    """
+    header,columns = generate_mapping_columns(n_rows,**kwargs)
+    return columns_to_lines(header,columns)
+
+def generate_site_metadata_lines(n_sites=20,seed=0):
+    """Return lines of a metadata file with one row per Site"""
+    random = RandomState(seed)
+    sites = char.add("site_",arange(n_sites).astype(str))
+    depths = random.uniform(1.0,30.0,n_sites).round(2).astype(str)
+    reefs = char.add("reef_",random.randint(0,5,n_sites).astype(str))
+    return columns_to_lines(["Site","SiteDepth","Reef"],[sites,depths,reefs])
+
+def generate_sensor_log_lines(n_readings,n_sites=20,missing_rate=0.01,seed=0):
+    """Return lines of a logger file of readings by Site and Day
+
+    Days are numbered as the ordinals of Date columns from
+    generate_mapping_columns, so the two can be joined on day numbers.
+    """
+    random = RandomState(seed)
+    sites = char.add("site_",random.randint(0,n_sites,n_readings).astype(str))
+    days = (FIRST_DAY + random.uniform(0,3650,n_readings)).round(3).astype(str)
+    temps = random.normal(27.0,2.0,n_readings).round(2).astype(str)
+    return columns_to_lines(["Site","Day","Temp"],\
+      [sites,days,_with_missing(temps,missing_rate,random)])
+
+def day_strings(days):
+    """Return YYYYMMDD strings for an array of date ordinals"""
+    dates = datetime64(date(1970,1,1),'D') + (days - date(1970,1,1).toordinal())
+    months = dates.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]').astype(int) + 1970
+    month_numbers = months.astype(int) % 12 + 1
+    month_days = (dates - months).astype(int) + 1
+    return (years*10000 + month_numbers*100 + month_days).astype(str)
+
+def columns_to_lines(header,columns):
+    """Return tab-delimited lines (a '#' header, then one line per row) of columns"""
+    lines = ["#"+"\t".join(header)+"\n"]
+    lines.extend("\t".join(fields)+"\n" for fields in zip(*[c.tolist() for c in columns]))
+    return lines
+
+def _with_missing(values,missing_rate,random):
+    """Return values with about missing_rate of them replaced by MISSING_VALUE"""
+    values = values.astype(object)
+    values[random.random_sample(len(values)) < missing_rate] = MISSING_VALUE
+    return values
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] output_file",\
+      description="Write a synthetic QIIME mapping file")
+    parser.add_option("-n","--rows",type="int",default=1000)
+    parser.add_option("--categorical_cols",type="int",default=3)
+    parser.add_option("--numeric_cols",type="int",default=5)
+    parser.add_option("--date_cols",type="int",default=1)
+    parser.add_option("--cardinality",type="int",default=10)
+    parser.add_option("--sites",type="int",default=20)
+    parser.add_option("--missing_rate",type="float",default=0.1)
+    parser.add_option("--seed",type="int",default=0)
+    opts,args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("An output file is required")
+    lines = generate_mapping_lines(opts.rows,n_categorical_cols=opts.categorical_cols,\
+      n_numeric_cols=opts.numeric_cols,n_date_cols=opts.date_cols,\
+      cardinality=opts.cardinality,n_sites=opts.sites,\
+      missing_rate=opts.missing_rate,seed=opts.seed)
+    outfile = open(args[0],"w")
+    outfile.writelines(lines)
+    outfile.close()
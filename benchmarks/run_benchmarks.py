@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2014, The MetadataMenagerie Project"
+__credits__ = ["Jesse RR Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.1dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+"""
+Time and memory benchmarks of the main MappingTable operations.
+
+Run from the top level of the repository:
+
+    python -m benchmarks.run_benchmarks -o results.json
+    python -m benchmarks.run_benchmarks --sizes 1000,1000000,10000000 -b load_lines
+    python -m benchmarks.run_benchmarks --compare benchmarks/baseline.json
+
+Each benchmark runs at each table size in its own process.  Memory is
+reported as the largest rise in resident memory over the start of a
+timed run (peak_increase_kb), so that it excludes the interpreter,
+imports and untimed setup.  Inputs are made by
+benchmarks.mapping_generator with a fixed seed, and setup (e.g. parsing
+the table an operation works on) is not timed.  The fastest of --repeat
+runs is reported.
+
+Results are written as JSON.  With --compare, each result is compared
+with the same benchmark and size in a stored results file, and the
+report lists timings that are more than --threshold times slower.
+"""
+
+import os
+import sys
+import json
+import atexit
+import platform
+import resource
+from time import time,strftime
+from shutil import rmtree
+from tempfile import mkdtemp
+from datetime import datetime
+from subprocess import Popen,PIPE
+from optparse import OptionParser
+import numpy
+from benchmarks.mapping_generator import generate_mapping_lines,\
+  generate_site_metadata_lines,generate_sensor_log_lines
+#Imported here so that no timed run includes a cold import
+from md_menagerie.mapping import MappingTable
+from md_menagerie.table_cache import load_mapping_table
+from md_menagerie.parallel_sets import get_top_level_sets_from_mapping,\
+  intersect_two_set_dicts
+
+DEFAULT_SIZES = [1000,10000,100000]
+
+def setup_load_lines(n_rows,seed):
+    lines = generate_mapping_lines(n_rows,seed=seed)
+    return lambda: _mapping_table(lines)
+
+def setup_load_lazy(n_rows,seed):
+    lines = generate_mapping_lines(n_rows,seed=seed)
+    return lambda: _mapping_table(lines,lazy=True)
+
+def setup_load_cached(n_rows,seed):
+    temp_dir = mkdtemp()
+    atexit.register(rmtree,temp_dir)
+    path = os.path.join(temp_dir,"mapping.txt")
+    outfile = open(path,"w")
+    outfile.writelines(generate_mapping_lines(n_rows,seed=seed))
+    outfile.close()
+    load_mapping_table(path)
+    return lambda: load_mapping_table(path).getCol('Measure_0')
+
+def setup_split_by_col(n_rows,seed):
+    table = _mapping_table(generate_mapping_lines(n_rows,seed=seed))
+    return lambda: table.splitByCol(['Site','Treatment_0'])
+
+def setup_interpolate(n_rows,seed):
+    table = _mapping_table(generate_mapping_lines(n_rows,seed=seed))
+    return lambda: table.updateColByInterpolation('Measure_1','Measure_0')
+
+def setup_interpolate_groups(n_rows,seed):
+    table = _mapping_table(generate_mapping_lines(n_rows,seed=seed))
+    return lambda: table.updateColsByInterpolation(['Measure_1','Measure_2',\
+      'Measure_3'],'Measure_0',['Site'])
+
+def setup_write_table(n_rows,seed):
+    table = _mapping_table(generate_mapping_lines(n_rows,seed=seed))
+    temp_dir = mkdtemp()
+    atexit.register(rmtree,temp_dir)
+    return lambda: table.writeTable(os.path.join(temp_dir,"out.txt"))
+
+def setup_join_metadata(n_rows,seed):
+    table = _mapping_table(generate_mapping_lines(n_rows,seed=seed))
+    sites = _mapping_table(generate_site_metadata_lines(seed=seed))
+    return lambda: table.joinAll([sites],['Site'])
+
+def setup_join_nearest(n_rows,seed):
+    samples,readings = _samples_and_readings(n_rows,seed)
+    return lambda: samples.joinNearest(readings,'Date_0',other_on='Day',\
+      by=['Site'],conversion_fn=_date_to_day)
+
+def setup_join_window(n_rows,seed):
+    samples,readings = _samples_and_readings(n_rows,seed)
+    return lambda: samples.joinWindow(readings,'Date_0',['Temp'],(-30,0),\
+      other_on='Day',by=['Site'],stats=['mean','max'],conversion_fn=_date_to_day)
+
+def setup_derived_column(n_rows,seed):
+    table = _mapping_table(generate_mapping_lines(n_rows,n_date_cols=3,seed=seed))
+    expression = 'if date(Date_0) < date(Date_1) then Treatment_0 + "_pre" '+\
+      'elif date(Date_0) <= date(Date_2) then Treatment_0 else Treatment_0 + "_post"'
+    return lambda: table.addDerivedColumn('Phase',expression)
+
+def setup_intersect_sets(n_rows,seed):
+    table = _mapping_table(generate_mapping_lines(n_rows,seed=seed))
+    def intersect():
+        sets = get_top_level_sets_from_mapping(table,['Site','Treatment_0'])
+        return intersect_two_set_dicts(sets['Site'],sets['Treatment_0'])
+    return intersect
+
+#name: function(n_rows,seed) doing untimed setup and returning the timed operation
+BENCHMARKS = [
+  ('load_lines',setup_load_lines),
+  ('load_lazy',setup_load_lazy),
+  ('load_cached',setup_load_cached),
+  ('split_by_col',setup_split_by_col),
+  ('interpolate',setup_interpolate),
+  ('interpolate_groups',setup_interpolate_groups),
+  ('write_table',setup_write_table),
+  ('join_metadata',setup_join_metadata),
+  ('join_nearest',setup_join_nearest),
+  ('join_window',setup_join_window),
+  ('derived_column',setup_derived_column),
+  ('intersect_sets',setup_intersect_sets),
+]
+
+def _mapping_table(lines,**kwargs):
+    return MappingTable(lines,**kwargs)
+
+def _samples_and_readings(n_rows,seed):
+    """Return one sample per 10 readings, and n_rows logger readings"""
+    samples = _mapping_table(generate_mapping_lines(max(n_rows//10,10),seed=seed))
+    readings = _mapping_table(generate_sensor_log_lines(n_rows,seed=seed))
+    return samples,readings
+
+def _date_to_day(date_string):
+    return datetime.strptime(date_string,"%Y%m%d").toordinal()
+
+def current_rss_kb():
+    """Return the resident memory of this process in KB"""
+    statm = open("/proc/self/statm")
+    pages = int(statm.read().split()[1])
+    statm.close()
+    return pages*resource.getpagesize()//1024
+
+def peak_rss_kb():
+    """Return the peak resident memory of this process in KB"""
+    try:
+        status = open("/proc/self/status")
+    except IOError:
+        #ru_maxrss is in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for line in status:
+        if line.startswith("VmHWM:"):
+            status.close()
+            return int(line.split()[1])
+    status.close()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def reset_peak_rss():
+    """Restart peak_rss_kb from the current resident memory, where Linux allows it"""
+    try:
+        clear_refs = open("/proc/self/clear_refs","w")
+        clear_refs.write("5")
+        clear_refs.close()
+    except IOError:
+        pass
+
+def run_benchmark(name,n_rows,repeat=3,seed=0):
+    """Return a dict of the results of benchmark name at n_rows in this process
+
+    The operation is set up again before each run, since some
+    (e.g. interpolation) modify their input.
+    """
+    setup = dict(BENCHMARKS)[name]
+    timings = []
+    start_rss_kb = None
+    peak_increase_kb = 0
+    for i in range(repeat):
+        operation = setup(n_rows,seed)
+        run_start_rss_kb = current_rss_kb()
+        if start_rss_kb is None:
+            start_rss_kb = run_start_rss_kb
+        reset_peak_rss()
+        start = time()
+        operation()
+        timings.append(time()-start)
+        peak_increase_kb = max(peak_increase_kb,peak_rss_kb()-run_start_rss_kb)
+        del operation
+    return {'benchmark':name,'rows':n_rows,'seconds':min(timings),\
+      'all_seconds':timings,'start_rss_kb':start_rss_kb,\
+      'peak_rss_kb':peak_rss_kb(),'peak_increase_kb':peak_increase_kb}
+
+def run_in_subprocess(name,n_rows,repeat,seed):
+    """Return the results of run_benchmark in a new Python process"""
+    command = [sys.executable,"-m","benchmarks.run_benchmarks","--single",name,\
+      "--sizes",str(n_rows),"--repeat",str(repeat),"--seed",str(seed)]
+    process = Popen(command,stdout=PIPE)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise RuntimeError("Benchmark %s at %i rows failed" %(name,n_rows))
+    return json.loads(output)
+
+def machine_info():
+    """Return a dict describing the machine and library versions"""
+    return {'python':platform.python_version(),'numpy':numpy.__version__,\
+      'platform':platform.platform(),'processor':platform.processor(),\
+      'date':strftime("%Y-%m-%d %H:%M:%S")}
+
+def compare_results(results,baseline,threshold=1.2):
+    """Return (report lines,number of regressions) comparing results with baseline
+
+    results,baseline -- lists of result dicts from run_benchmark
+    threshold -- timings more than this times the baseline are regressions
+    """
+    baseline_by_key = dict(((r['benchmark'],r['rows']),r) for r in baseline)
+    lines = ["%-20s %10s %10s %10s %7s %10s" %("benchmark","rows",\
+      "baseline_s","seconds","ratio","peak_mb+")]
+    n_regressions = 0
+    for result in results:
+        key = (result['benchmark'],result['rows'])
+        peak_mb = result['peak_increase_kb']/1024
+        if key not in baseline_by_key:
+            lines.append("%-20s %10i %10s %10.4f %7s %10.1f  (new)" %(key[0],\
+              key[1],"-",result['seconds'],"-",peak_mb))
+            continue
+        old_seconds = baseline_by_key[key]['seconds']
+        ratio = result['seconds']/old_seconds if old_seconds else float('inf')
+        note = ""
+        if ratio > threshold:
+            note = "  SLOWER"
+            n_regressions += 1
+        elif ratio < 1/threshold:
+            note = "  faster"
+        lines.append("%-20s %10i %10.4f %10.4f %7.2f %10.1f%s" %(key[0],key[1],\
+          old_seconds,result['seconds'],ratio,peak_mb,note))
+    return lines,n_regressions
+
+def main():
+    parser = OptionParser(usage="python -m benchmarks.run_benchmarks [options]",\
+      description="Time MappingTable operations on synthetic mapping files")
+    parser.add_option("-b","--benchmarks",default=None,\
+      help="comma-separated benchmarks to run [default: all of %s]"\
+      %",".join(name for name,setup in BENCHMARKS))
+    parser.add_option("--sizes",default=",".join(map(str,DEFAULT_SIZES)),\
+      help="comma-separated numbers of rows [default: %default]")
+    parser.add_option("--repeat",type="int",default=3,\
+      help="runs of each benchmark; the fastest is reported [default: %default]")
+    parser.add_option("--seed",type="int",default=0)
+    parser.add_option("-o","--output_file",default=None,\
+      help="write results as JSON to this file")
+    parser.add_option("--compare",default=None,\
+      help="a results file (e.g. benchmarks/baseline.json) to compare against")
+    parser.add_option("--threshold",type="float",default=1.2,\
+      help="report timings this many times the baseline as slower [default: %default]")
+    parser.add_option("--single",default=None,help=\
+      "run one benchmark at one size in this process and print its JSON result")
+    opts,args = parser.parse_args()
+    sizes = [int(float(size)) for size in opts.sizes.split(",")]
+
+    if opts.single:
+        #Keep anything the operation prints out of the JSON result
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        try:
+            result = run_benchmark(opts.single,sizes[0],opts.repeat,opts.seed)
+        finally:
+            sys.stdout = stdout
+        print json.dumps(result)
+        return 0
+
+    names = [name for name,setup in BENCHMARKS]
+    if opts.benchmarks:
+        names = opts.benchmarks.split(",")
+        for name in names:
+            if name not in dict(BENCHMARKS):
+                parser.error("Unknown benchmark %s" %name)
+
+    results = []
+    for name in names:
+        for n_rows in sizes:
+            result = run_in_subprocess(name,n_rows,opts.repeat,opts.seed)
+            print >>sys.stderr,"%-20s %10i rows %10.4f s %10.1f MB peak increase"\
+              %(name,n_rows,result['seconds'],result['peak_increase_kb']/1024)
+            results.append(result)
+
+    if opts.output_file:
+        outfile = open(opts.output_file,"w")
+        json.dump({'machine':machine_info(),'results':results},outfile,indent=1,\
+          sort_keys=True)
+        outfile.close()
+
+    if opts.compare:
+        baseline = json.load(open(opts.compare))
+        lines,n_regressions = compare_results(results,baseline['results'],\
+          opts.threshold)
+        print "Compared with %s (%s)" %(opts.compare,baseline['machine']['date'])
+        print "\n".join(lines)
+        if n_regressions:
+            print "%i benchmarks were more than %.2f times slower" %(n_regressions,\
+              opts.threshold)
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2014, The MetadataMenagerie Project"
+__credits__ = ["Jesse RR Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.1dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+"""
+Counters and timers for MappingTable operations.
+
+Instrumentation is off by default.  While it is off, instrumented
+methods only check a flag before running, and debug messages are
+never formatted.  Once enabled, each instrumented operation (e.g.
+'loadTableFromLines', 'splitByCol', 'joinAll', 'writeTable') records
+its number of calls, wall time, rows in and out and, for loads and
+writes, bytes of text.
+
+Times are self times: an operation's seconds exclude time spent in
+instrumented operations it calls (e.g. join calls joinAll, and
+updateColByInterpolation calls interpolate).  So the seconds of all
+operations add up to no more than the wall time, and can be read as a
+breakdown of it.
+
+    from md_menagerie import instrumentation
+    instrumentation.enable()
+    ...
+    print instrumentation.snapshot()['joinAll']['seconds']
+    instrumentation.export_stats('table_stats.json')
+
+With enable(debug=True), diagnostic messages from inside operations
+(e.g. the input data of each interpolation) are also sent to the
+'md_menagerie' logger at DEBUG level.
+
+Stats are kept per process, so operations run in worker processes
+(e.g. updateColsByInterpolation with jobs > 1) record only the
+parent's share of the work.
+"""
+
+import json
+import logging
+from time import time
+from functools import wraps
+
+ENABLED = False
+DEBUG = False
+STAT_FIELDS = ('calls','seconds','rows_in','rows_out','bytes')
+
+logger = logging.getLogger("md_menagerie")
+_stats = {}
+#Seconds spent in instrumented children of each running operation
+_child_seconds = []
+
+def enable(debug=False):
+    """Start recording stats (and debug messages if debug is True)"""
+    global ENABLED,DEBUG
+    ENABLED = True
+    DEBUG = debug
+
+def disable():
+    """Stop recording stats and debug messages.  Recorded stats are kept."""
+    global ENABLED,DEBUG
+    ENABLED = False
+    DEBUG = False
+
+def is_enabled():
+    """Return True if stats are being recorded"""
+    return ENABLED
+
+def record(operation,seconds=0.0,calls=1,rows_in=0,rows_out=0,n_bytes=0):
+    """Add one call (or calls calls) of operation to its stats"""
+    stats = _stats.get(operation)
+    if stats is None:
+        stats = _stats[operation] = dict.fromkeys(STAT_FIELDS,0)
+        stats['seconds'] = 0.0
+    stats['calls'] += calls
+    stats['seconds'] += seconds
+    stats['rows_in'] += rows_in
+    stats['rows_out'] += rows_out
+    stats['bytes'] += n_bytes
+
+def counted_bytes(operation,chunks):
+    """Yield the strings in chunks, adding their lengths to the bytes of operation"""
+    for chunk in chunks:
+        record(operation,calls=0,n_bytes=len(chunk))
+        yield chunk
+
+def instrumented(method):
+    """Decorate a MappingTable method to record its stats under its name
+
+    Rows in are the rows of the table before the call.  Rows out are
+    the rows of the returned table(s), or of the table after the call
+    if the method doesn't return tables.  Seconds are self time (see
+    the module documentation).
+    """
+    operation = method.__name__
+    @wraps(method)
+    def wrapper(self,*args,**kwargs):
+        if not ENABLED:
+            return method(self,*args,**kwargs)
+        rows_in = len(getattr(self,'RowIds',()))
+        _child_seconds.append(0.0)
+        start = time()
+        try:
+            result = method(self,*args,**kwargs)
+        finally:
+            elapsed = time()-start
+            child_seconds = _child_seconds.pop()
+            if _child_seconds:
+                _child_seconds[-1] += elapsed
+        record(operation,elapsed-child_seconds,rows_in=rows_in,\
+          rows_out=_rows_out(self,result))
+        return result
+    return wrapper
+
+def _rows_out(table,result):
+    """Return the number of rows in the tables returned by a method of table"""
+    if hasattr(result,'RowIds') and result is not table:
+        return len(result.RowIds)
+    if isinstance(result,dict):
+        return sum(len(getattr(value,'RowIds',())) for value in result.itervalues())
+    return len(getattr(table,'RowIds',()))
+
+def debug(*values):
+    """Log values, joined by spaces, if debug messages are enabled"""
+    if DEBUG:
+        logger.debug(" ".join(map(str,values)))
+
+def snapshot():
+    """Return a dict of {operation:{stat:value}} of the stats recorded so far"""
+    return dict((operation,dict(stats)) for operation,stats in _stats.iteritems())
+
+def reset():
+    """Clear all recorded stats"""
+    _stats.clear()
+
+def export_stats(out,format='json'):
+    """Write a snapshot of the recorded stats to a file object or path
+
+    format -- 'json' (a dict by operation) or 'tsv' (one line per operation)
+    """
+    if format not in ('json','tsv'):
+        raise ValueError("format must be 'json' or 'tsv', not %s" %format)
+    stats = snapshot()
+    if format == 'json':
+        text = json.dumps(stats,indent=1,sort_keys=True)+"\n"
+    else:
+        lines = ["\t".join(('operation',)+STAT_FIELDS)+"\n"]
+        for operation in sorted(stats):
+            values = [str(stats[operation][field]) for field in STAT_FIELDS]
+            lines.append("\t".join([operation]+values)+"\n")
+        text = "".join(lines)
+
+    if isinstance(out,basestring):
+        outfile = open(out,"w")
+        outfile.write(text)
+        outfile.close()
+    else:
+        out.write(text)
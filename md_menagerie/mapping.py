@@ -1,34 +1,552 @@
 from string import strip
 from collections import defaultdict
-from numpy import diff,interp,array,unique,mean
+import os
+import re
+from tempfile import mkstemp
+from itertools import izip
+from weakref import WeakSet
+from multiprocessing import Pool
+from numpy import diff,interp,array,unique,mean,empty,ones,zeros,\
+  float64,bincount,column_stack,flatnonzero,arange,intp,int64,\
+  searchsorted,where,add,concatenate,errstate,min_scalar_type,integer,\
+  cumsum,minimum,maximum,inf,lexsort,char,datetime64,isfinite,\
+  result_type
+from datetime import datetime,date
 import matplotlib.pyplot as plt
+import instrumentation
+from instrumentation import instrumented
 
-class MappingTable():
+#Field values that mark missing data
+DEFAULT_NULL_TOKENS = ("Unknown","unknown","NULL","NA","")
+
+#Formats tried, in order, when parsing date columns (e.g. 20120817)
+DEFAULT_DATE_FORMATS = ("%Y%m%d",)
+
+#Aggregates available to MappingTable.joinWindow
+WINDOW_STATS = ('mean','min','max','sum','count')
+WINDOW_REDUCERS = {'min':minimum,'max':maximum}
+WINDOW_IDENTITY = {'min':inf,'max':-inf}
+
+class MappingTable(object):
     """Handle loading and manipulation of QIIME mapping files
+
+    Data are stored by column: each column is a single contiguous numpy
+    object array of field strings, in the same order as self.ColIds.
+    self.Data and iterRows provide row-oriented views on the same storage.
+
+    Columns with few distinct values (e.g. 'Treatment') are stored as a
+    CategoricalColumn: a pool of the distinct values plus a small integer
+    code per row.  Grouping, equality lookups and numeric parsing of 
+    these columns work on the codes.
+
+    A table may also be a view of a subset of another table's rows (see
+    subsetByIndex).  Views read the parent's columns through an array of
+    row positions and copy them into their own storage only when modified.
+
+    With lazy=True only the SampleID of each line is read at load time.
+    Each column is split out of the raw lines the first time it is used.
+
+    Fields equal to one of null_tokens (e.g. 'Unknown') are missing
+    values.  getValidMask gives a boolean mask of the non-missing rows
+    of a column, and numeric, interpolation and filtering methods all
+    use it to skip missing data.
     """
-    def __init__(self,lines,field_delimiter="\t",comment_prefix="#"):
+    def __init__(self,lines=None,field_delimiter="\t",comment_prefix="#",lazy=False,\
+        null_tokens=DEFAULT_NULL_TOKENS):
         
+        self._Views = WeakSet()
+        if lines is None:
+            #An empty table, e.g. to fill using loadTableFromColumns
+            self._resetTable([],field_delimiter,comment_prefix,null_tokens)
+            self._Columns = []
+            return
         #Load a table object from lines
         self.loadTableFromLines(lines,field_delimiter=field_delimiter,\
-          comment_prefix=comment_prefix)
+          comment_prefix=comment_prefix,lazy=lazy,null_tokens=null_tokens)
 
-    
-    def iterRows(self,row_names=None):
-        """Iterate id,data tuples for each row"""
+    def __getstate__(self):
+        """Return the data of the table for pickling (e.g. to another process)"""
+        return {'HeaderFields':self.HeaderFields,'RowIds':self.RowIds,\
+          'Columns':[self._storedColumn(j) for j in range(len(self.ColIds))],\
+          'OtherCommentLines':self.OtherCommentLines,\
+          'FieldDelimiter':self.FieldDelimiter,'CommentPrefix':self.CommentPrefix,\
+          'NullTokens':self.NullTokens}
+
+    def __setstate__(self,state):
+        """Rebuild an unpickled table.  Caches and indexes are not kept"""
+        self._Views = WeakSet()
+        self.loadTableFromColumns(state['HeaderFields'],state['Columns'],\
+          state['OtherCommentLines'],field_delimiter=state['FieldDelimiter'],\
+          comment_prefix=state['CommentPrefix'],null_tokens=state['NullTokens'])
+        self.RowIds = list(state['RowIds'])
+        self.RowIndices = dict((row_id,i) for i,row_id in enumerate(self.RowIds))
+
+    @property
+    def Data(self):
+        """A read-only, list-like view of the table as rows of fields"""
+        return RowView(self)
+
+    def getCol(self,col_id):
+        """Return the array of values for a column
+
+        col_id -- the header name of the column (e.g. 'pH')
+
+        Callers must not modify the returned array in place (it may be
+        the stored array).  Use updateCol instead.
+        """
+        return self._column(self._colIndex(col_id))
+
+    def getCategoricalCol(self,col_id):
+        """Return a (pool,codes) pair describing the values of a column
+
+        col_id -- the header name of the column (e.g. 'treatment')
+
+        pool is a sorted array of the distinct values in the column, and
+        codes gives the position in pool of each row's value, so that
+        pool[codes] equals getCol(col_id).  For dictionary encoded 
+        columns these are the stored arrays, so no values are compared.
+        (See dictionary_encode for values that can't be sorted.)
+        """
+        col = self._storedColumn(self._colIndex(col_id))
+        if isinstance(col,CategoricalColumn):
+            return col.Pool,col.Codes
+        return dictionary_encode(col)
+
+    def _colIndex(self,col_id):
+        """Return the index of col_id, raising ValueError if it isn't a column"""
+        try:
+            return self.ColIndices[col_id]
+        except KeyError:
+            raise ValueError("%s is not a valid column.  Valid columns are: %s"\
+              %(col_id,self.ColIds))
+
+    def _column(self,col_idx):
+        """Return the array of values for the column at col_idx"""
+        col = self._storedColumn(col_idx)
+        if isinstance(col,CategoricalColumn):
+            return col.values()
+        return col
+
+    def _columnValues(self,col_idx,row_indices):
+        """Return an object array of the values at row_indices of column col_idx
+
+        row_indices -- an array of row positions or a slice
+        """
+        col = self._storedColumn(col_idx)[row_indices]
+        if isinstance(col,CategoricalColumn):
+            return col.values()
+        return col
+
+    def _storedColumn(self,col_idx):
+        """Return the stored array or CategoricalColumn for the column at col_idx"""
+        if self._Parent is not None:
+            #Gather from the parent (copies only references or codes)
+            return self._Parent._storedColumn(col_idx)[self._RowSelection]
+        col = self._Columns[col_idx]
+        if col is None:
+            col = self._parseColumn(col_idx)
+        return col
+
+    def _parseColumn(self,col_idx):
+        """Load the column at col_idx from a lazily loaded table's source"""
+        col = encode_column(self._ColumnSource.column(col_idx))
+        self._Columns[col_idx] = col
+        self._releaseColumnSource()
+        return col
+
+    def _releaseColumnSource(self):
+        """Drop the source of a lazily loaded table once all columns are loaded"""
+        if all(col is not None for col in self._Columns):
+            self._ColumnSource = None
+
+    def _setColumn(self,col_idx,values):
+        """Replace the stored array for the column at col_idx"""
+        self._detachViews()
+        self._materialize()
+        if col_idx in self._ValueIndices:
+            self._updateValueIndex(col_idx,self._column(col_idx),values)
+        self._Columns[col_idx] = encode_column(values)
+        self._releaseColumnSource()
+        self._invalidateCaches(col_idx)
+
+    def _resetCaches(self):
+        """Start empty caches of values derived from the columns"""
+        self._NumericCache = {}
+        self._SortedIndexCache = {}
+        self._ValidMaskCache = {}
+        self._DateCache = {}
+        self._ValueIndices = {}
+
+    def createIndex(self,col):
+        """Index the rows of a (categorical) column by value
         
-        for row_id,data in zip(self.RowIds,self.Data):
-            if row_names is None:
-                #Don't filter by row_names
-                yield row_id,data
-            elif row_id in row_names:
-                yield row_id,data
+        col -- the name of the column to index (e.g. 'treatment')
+        
+        Once created, the index is kept up to date by updateCol, and is 
+        used by rowIndicesWithValue, valueGroups, splitByCol and equality
+        criteria in rowsMatching, so these cost O(result) not O(table).
+        """
+        index = defaultdict(set)
+        for (value,),row_indices in self.groupRowIndices([col]):
+            index[value] = set(row_indices.tolist())
+        self._ValueIndices[self.ColIndices[col]] = index
+        return self
+
+    def dropIndex(self,col):
+        """Remove the value index for col (if any)"""
+        self._ValueIndices.pop(self.ColIndices[col],None)
+        return self
+
+    def _updateValueIndex(self,col_idx,old_values,new_values):
+        """Move changed rows between value groups of the index for col_idx"""
+        index = self._ValueIndices[col_idx]
+        changed = flatnonzero(old_values != new_values)
+        for i,old_value,new_value in izip(changed.tolist(),\
+          old_values[changed].tolist(),new_values[changed].tolist()):
+            rows = index[old_value]
+            rows.discard(i)
+            if not rows:
+                del index[old_value]
+            index[new_value].add(i)
+
+    def rowIndicesWithValue(self,col,value):
+        """Return an array of positions (in table order) of rows where col == value"""
+        col_idx = self._colIndex(col)
+        index = self._ValueIndices.get(col_idx)
+        if index is not None:
+            return array(sorted(index.get(value,())),dtype=intp)
+        col_values = self._storedColumn(col_idx)
+        if isinstance(col_values,CategoricalColumn):
+            return col_values.rowIndicesWithValue(value)
+        return flatnonzero(col_values == value)
+
+    def valueGroups(self,col):
+        """Return a dict of {value:array of row positions} for each value in col"""
+        index = self._ValueIndices.get(self._colIndex(col))
+        if index is not None:
+            return dict((value,array(sorted(rows),dtype=intp))\
+              for value,rows in index.iteritems())
+        return dict((value,row_indices) for (value,),row_indices\
+          in self.groupRowIndices([col]))
+
+    def _invalidateCaches(self,col_idx):
+        """Drop cached values derived from the column at col_idx"""
+        #Any parsed copies of the old values are now stale
+        for cache in (self._NumericCache,self._SortedIndexCache,self._ValidMaskCache,\
+          self._DateCache):
+            for key in [k for k in cache if k[0] == col_idx]:
+                del cache[key]
+
+    def getValidMask(self,col_id):
+        """Return a boolean array that is False for rows missing a value in col_id
+
+        A value is missing if its field is one of self.NullTokens.  The
+        mask is built once per column and cached until updateCol.
+        """
+        key = (self._colIndex(col_id),)
+        if key not in self._ValidMaskCache:
+            if self._Parent is not None:
+                mask = self._Parent.getValidMask(col_id)[self._RowSelection]
+            else:
+                col = self._storedColumn(key[0])
+                if isinstance(col,CategoricalColumn):
+                    #Check each distinct value once
+                    mask = ~null_mask(col.Pool,self.NullTokens)[col.Codes]
+                else:
+                    mask = ~null_mask(col,self.NullTokens)
+            self._ValidMaskCache[key] = mask
+        return self._ValidMaskCache[key]
+
+    def getNumericCol(self,col_id,dtype=float64):
+        """Return a (values,valid) pair of arrays for a (mostly) numeric column
+
+        col_id -- the header name of the column (e.g. 'pH')
+        dtype -- numpy float type for the values (float64 or float32)
+
+        values holds the parsed number for each row (NaN where the field
+        is missing or could not be converted), and valid is a boolean
+        mask that is True for rows that parsed cleanly.  Missing fields 
+        (see getValidMask) are never parsed.  Results are parsed once and
+        cached until the column is changed with updateCol.
+        """
+        key = (self._colIndex(col_id),dtype)
+        if key not in self._NumericCache:
+            if self._Parent is not None:
+                #Reuse the parent's parsed values
+                values,valid = self._Parent.getNumericCol(col_id,dtype)
+                self._NumericCache[key] =\
+                  (values[self._RowSelection],valid[self._RowSelection])
+            else:
+                col = self._storedColumn(key[0])
+                if isinstance(col,CategoricalColumn):
+                    #Parse each distinct value once
+                    not_null = ~null_mask(col.Pool,self.NullTokens)
+                    values,valid = parse_numeric_array(col.Pool,dtype,not_null)
+                    self._NumericCache[key] = (values[col.Codes],valid[col.Codes])
+                else:
+                    self._NumericCache[key] = parse_numeric_array(col,dtype,\
+                      self.getValidMask(col_id))
+        return self._NumericCache[key]
+
+    def getConvertedCol(self,col_id,conversion_fn=float):
+        """Return a (values,valid) pair of arrays for col_id converted to numbers
+        
+        conversion_fn -- a function converting a field to a number (e.g. a
+          date string to a day number).  Fields that are missing or raise 
+          ValueError are NaN in values and False in valid.
+        
+        With float this is getNumericCol.  Otherwise conversion_fn is 
+        called once for each distinct value in the column.
+        """
+        if conversion_fn is float:
+            return self.getNumericCol(col_id)
+        pool,codes = self.getCategoricalCol(col_id)
+        not_null = ~null_mask(pool,self.NullTokens)
+        values = empty(len(pool),dtype=float64)
+        values.fill(float('nan'))
+        valid = zeros(len(pool),dtype=bool)
+        for k in flatnonzero(not_null):
+            try:
+                values[k] = conversion_fn(pool[k])
+            except ValueError:
+                continue
+            valid[k] = True
+        return values[codes],valid[codes]
+
+    def getDateCol(self,col_id,date_formats=DEFAULT_DATE_FORMATS):
+        """Return a (dates,valid) pair of arrays for a column of dates
+
+        col_id -- the header name of the column (e.g. 'CollectionDate')
+        date_formats -- strptime formats to try in order (e.g. ('%Y%m%d',
+          '%Y-%m-%d')).  '%Y%m%d' is parsed without calling strptime.
+
+        dates is a datetime64[D] array (NaT where the field is missing or 
+        is not a date in any of date_formats) and valid is True for rows
+        that parsed.  Day differences, comparisons and sorting can then 
+        use numpy directly, e.g. (dates - dates.min()).astype(int).  Each
+        distinct value is parsed once, and results are cached until the
+        column is changed with updateCol.
+        """
+        key = (self._colIndex(col_id),tuple(date_formats))
+        if key not in self._DateCache:
+            if self._Parent is not None:
+                dates,valid = self._Parent.getDateCol(col_id,date_formats)
+                self._DateCache[key] =\
+                  (dates[self._RowSelection],valid[self._RowSelection])
+            else:
+                pool,codes = self.getCategoricalCol(col_id)
+                not_null = ~null_mask(pool,self.NullTokens)
+                dates,valid = parse_date_array(pool,date_formats,not_null)
+                self._DateCache[key] = (dates[codes],valid[codes])
+        return self._DateCache[key]
+
+    def daysBetween(self,col_id,start,date_formats=DEFAULT_DATE_FORMATS):
+        """Return a (days,valid) pair of arrays of days from start to the dates in col_id
+
+        col_id -- a column of dates (see getDateCol)
+        start -- another column of dates, or a single datetime.date
+        
+        days is an int64 array, negative where col_id is before start,
+        and 0 where either date is missing.  valid is True for rows
+        where both dates are present.
+        """
+        dates,valid = self.getDateCol(col_id,date_formats)
+        if isinstance(start,date):
+            start_dates = datetime64(start,'D')
+        else:
+            start_dates,start_valid = self.getDateCol(start,date_formats)
+            valid = valid & start_valid
+        days = (dates - start_dates).astype(int64)
+        days[~valid] = 0
+        return days,valid
+
+    @instrumented
+    def timeToEvent(self,time_col,events,individual_col='Individual',\
+        date_formats=DEFAULT_DATE_FORMATS,weeks=True):
+        """Add columns of the days (and weeks) since each individual's first event
+
+        time_col -- a column of sample dates (see getDateCol)
+        events -- list of (column,state) pairs, e.g. [('HealthState',
+          'DarkSpotSyndrome'),('Bleached','Yes')]
+        individual_col -- column identifying individuals.  Each row is
+          compared with the first event of its own individual.
+        weeks -- if True, also add a column of weeks, rounded to whole weeks
+
+        For each event a column 'DaysAfter<state>' (and 'WeeksAfter<state>')
+        is added, named 'DaysAfter<column>_<state>' if two events share a 
+        state.  Days are negative before the first event.  Rows whose 
+        individual never has the event, or with no date, are 'Unknown'.
+        Returns the list of new column names.
+
+        For each event, its rows are sorted by individual and date once,
+        and the first event of every individual is taken from the sort.
+        """
+        states = [state for col,state in events]
+        dates,date_valid = self.getDateCol(time_col,date_formats)
+        days = dates.astype(int64)
+        individuals = self.getCategoricalCol(individual_col)[1]
+        n_individuals = int(individuals.max())+1 if len(individuals) else 0
+        dated_rows = flatnonzero(date_valid)
+        
+        new_cols = []
+        new_columns = []
+        for col,state in events:
+            if states.count(state) > 1:
+                suffix = "%s_%s" %(col,state)
+            else:
+                suffix = state
+            pool,codes = self.getCategoricalCol(col)
+            state_code = flatnonzero(pool == state)
+            if len(state_code):
+                event_rows = dated_rows[codes[dated_rows] == state_code[0]]
+            else:
+                event_rows = dated_rows[:0]
+            #Sort events by individual, then date, and take each individual's first
+            event_rows = event_rows[lexsort((days[event_rows],individuals[event_rows]))]
+            event_individuals,first = unique(individuals[event_rows],return_index=True)
+            has_event = zeros(n_individuals,dtype=bool)
+            has_event[event_individuals] = True
+            first_event = zeros(n_individuals,dtype=int64)
+            first_event[event_individuals] = days[event_rows[first]]
+            
+            valid = date_valid & has_event[individuals]
+            days_after = days - first_event[individuals]
+            new_cols.append("DaysAfter%s" %suffix)
+            new_columns.append(_int_strings(days_after,valid))
+            if weeks:
+                #Round halves away from zero, as round() does
+                weeks_after = days_after/7.0
+                weeks_after = where(weeks_after < 0,-(0.5-weeks_after).astype(int64),\
+                  (weeks_after+0.5).astype(int64))
+                new_cols.append("WeeksAfter%s" %suffix)
+                new_columns.append(_int_strings(weeks_after,valid,".0"))
+        
+        for new_col in new_cols:
+            if new_col in self.ColIndices:
+                raise ValueError("Column %s is already in the table" %new_col)
+        for new_col,values in zip(new_cols,new_columns):
+            self._appendColumn(new_col,values)
+        return new_cols
+
+    def subsetByIndex(self,row_indices):
+        """Return a new MappingTable viewing the rows at row_indices
+
+        row_indices -- an array of integer row positions in this table
+
+        The new table shares this table's column storage rather than
+        copying it.  Either table copies the data it needs before a column
+        is modified, so changes to one are never seen by the other.
+        """
+        row_indices = array(row_indices,dtype=intp)
+        view = MappingTable.__new__(MappingTable)
+        view.FieldDelimiter = self.FieldDelimiter
+        view.CommentPrefix = self.CommentPrefix
+        view.HeaderFields = list(self.HeaderFields)
+        view.ColIds = view.HeaderFields
+        view.ColIndices = dict(self.ColIndices)
+        view.OtherCommentLines = list(self.OtherCommentLines)
+        view.NullTokens = self.NullTokens
+        view.RowIds = [self.RowIds[i] for i in row_indices]
+        view.RowIndices = dict((row_id,i) for i,row_id in enumerate(view.RowIds))
+        view._resetCaches()
+        view._Views = WeakSet()
+        view._Columns = None
+        view._ColumnSource = None
+        view._Parent = self
+        view._RowSelection = row_indices
+        self._Views.add(view)
+        return view
+
+    def _materialize(self):
+        """Copy a view's rows from its parent into its own column storage"""
+        if self._Parent is None:
+            return
+        self._Columns = [self._storedColumn(j) for j in range(len(self.ColIds))]
+        self._Parent._Views.discard(self)
+        self._Parent = None
+        self._RowSelection = None
+
+    def _detachViews(self):
+        """Materialize all views of this table before its storage changes"""
+        for view in list(self._Views):
+            view._materialize()
+
+    def _numericRowMask(self,col_names):
+        """Return col indices (in table order) and a mask of rows numeric in all"""
+        col_indices = sorted(set(self.ColIndices[col] for col in col_names))
+        all_valid = ones(len(self.RowIds),dtype=bool)
+        for col_idx in col_indices:
+            all_valid &= self.getNumericCol(self.ColIds[col_idx])[1]
+        return col_indices,all_valid
+
+    def _row(self,row_idx):
+        """Return the fields of the row at row_idx as a new list"""
+        if self._Parent is not None:
+            return self._Parent._row(self._RowSelection[row_idx])
+        if self._ColumnSource is not None:
+            #Load just this row, rather than parsing whole columns
+            fields = self._ColumnSource.row(row_idx)
+            return [fields[j] if col is None else col[row_idx]\
+              for j,col in enumerate(self._Columns)]
+        return [col[row_idx] for col in self._Columns]
+
+    def rowIndices(self,row_names,preserve_order=False):
+        """Return an array of row positions for the rows named in row_names
+
+        row_names -- an iterable of row ids.  Ids not in the table are ignored.
+        preserve_order -- if True, positions are in the order of row_names
+          (including any repeats).  Otherwise they are unique and in table order.
+
+        Ids are looked up in self.RowIndices, so the cost depends on the
+        number of ids requested rather than the size of the table.
+        """
+        row_indices = self.RowIndices
+        result = array([row_indices[row_id] for row_id in row_names\
+          if row_id in row_indices],dtype=intp)
+        if not preserve_order:
+            result = unique(result)
+        return result
+
+    def iterRows(self,row_names=None,preserve_order=False):
+        """Iterate id,data tuples for each row
+        row_names -- if supplied, only yield rows with ids in row_names
+        preserve_order -- if True, yield rows in the order of row_names
+          rather than in table order
+        """
+        
+        if row_names is None:
+            #Don't filter by row_names
+            row_indices = None
+        else:
+            row_indices = self.rowIndices(row_names,preserve_order)
+        
+        for row_id,data in self.iterRowsByIndex(row_indices):
+            yield row_id,data
+
+    def iterRowsByIndex(self,row_indices=None):
+        """Iterate id,data tuples for rows at the given positions
+        row_indices -- an array of integer row positions.  If None, use all rows
+        """
+        all_cols = [self._column(j) for j in range(len(self.ColIds))]
+        if row_indices is None:
+            cols = [col.tolist() for col in all_cols]
+            row_ids = self.RowIds
+        else:
+            cols = [col[row_indices].tolist() for col in all_cols]
+            row_ids = [self.RowIds[i] for i in row_indices]
+        
+        #Transposing whole columns at once is much faster than
+        #indexing every column for every row
+        for row_id,data in izip(row_ids,izip(*cols)):
+            yield row_id,list(data)
     
-    def iterRowData(self,row_names=None):
+    def iterRowData(self,row_names=None,preserve_order=False):
         """Iterate data values for each row
         row_names -- if a list is supplied only yield rows matching these names
+        preserve_order -- if True, yield rows in the order of row_names
         """
 
-        for row_id,data in self.iterRows(row_names=row_names):
+        for row_id,data in self.iterRows(row_names,preserve_order):
             yield data
 
     def iterCols(self,col_names=None,row_names=None):
@@ -40,12 +558,15 @@ class MappingTable():
         if col_names is None:
             col_names = self.ColIds
         
+        if row_names is not None:
+            row_indices = self.rowIndices(row_names)
+        
         for col_id in col_names:
-            data = []
-            #Get data for this column from all rows
-            for row in self.iterRowData(row_names):
-                curr_data=row[self.ColIndices[col_id]]
-                data.append(curr_data)
+            col = self._column(self.ColIndices[col_id])
+            if row_names is None:
+                data = col.tolist()
+            else:
+                data = col[row_indices].tolist()
         
             yield col_id,data
 
@@ -69,6 +590,16 @@ class MappingTable():
         limit_by_col -- limit to only rows with particular data vales
         """
            
+        if conversion_fn is float:
+            #Use cached, pre-parsed values
+            for col in col_names:
+                values,valid = self.getNumericCol(col)
+                if not valid.all():
+                    #Bad data, must skip entire data point
+                    continue
+                yield values.tolist()
+            return
+
         #Try to convert row data using conversion_fn
         for col in self.iterColData(col_names):
             try:
@@ -79,7 +610,19 @@ class MappingTable():
             yield converted_data
     
     def iterNumericDataByRow(self,col_names,conversion_fn=float):
-        
+        """Yields lists of numeric data for each row where all of col_names can be converted to float
+
+        Fields are yielded in the order they appear in the table.
+        """
+        if conversion_fn is float:
+            #Select fully numeric rows with a single mask over cached values
+            col_indices,all_valid = self._numericRowMask(col_names)
+            values = column_stack([self.getNumericCol(self.ColIds[i])[0]\
+              for i in col_indices])
+            for row in values[all_valid].tolist():
+                yield row
+            return
+
         #Try to convert row data using conversion_fn
         col_indices_of_interest = set(self.ColIndices[col] for col in col_names)
         for row in self.iterRowData():
@@ -106,6 +649,19 @@ class MappingTable():
         (as with e.g. the defautl float() function)
         """
            
+        if conversion_fn is float:
+            col_indices,all_valid = self._numericRowMask(col_names)
+            parsed = [self.getNumericCol(self.ColIds[i]) for i in col_indices]
+            for row_idx in flatnonzero(~all_valid):
+                converted_data = []
+                for col_idx,(values,valid) in zip(col_indices,parsed):
+                    if valid[row_idx]:
+                        converted_data.append(float(values[row_idx]))
+                    else:
+                        converted_data.append(self._column(col_idx)[row_idx])
+                yield converted_data
+            return
+
         #Try to convert row data using conversion_fn
         col_indices_of_interest = set(self.ColIndices[col] for col in col_names)
         
@@ -127,80 +683,420 @@ class MappingTable():
                         converted_data.append(field)
                 yield converted_data
     
+    @instrumented
+    def join(self,other,on,how='left',other_on=None,fill_value='Unknown'):
+        """Return a new MappingTable with the columns of other joined onto self
+        
+        other -- a MappingTable (e.g. of metadata) to join to this one
+        on -- the column of self whose values are matched to other
+        how -- 'left' keeps every row of self, 'inner' keeps only rows of
+          self that match a row of other, and 'outer' also adds rows of
+          other whose keys match no row of self.  Added rows keep their 
+          row id in other if other has the row id column of self (e.g. 
+          SampleID), and are otherwise named by their key.  A ValueError 
+          is raised if that would repeat a row id.
+        other_on -- the key column of other.  Defaults to on.
+        fill_value -- the value of fields that have no matching row
+        
+        Columns of other that are not in self are added after the columns
+        of self, in the order they appear in other.  Where a column is in 
+        both tables, the values in self are kept.  If several rows of other
+        share a key, the last one is used.  Other is indexed on its key 
+        column once, and each new column is built by a single gather.
+        """
+        if how not in ('left','inner','outer'):
+            raise ValueError("how must be 'left','inner' or 'outer', not %s" %how)
+        if how != 'outer':
+            return self.joinAll([other],on,how,other_on,fill_value)
+        if other_on is None:
+            other_on = on
+        
+        index = other._keyIndex(other_on)
+        key_pool,key_codes = self.getCategoricalCol(on)
+        matches = _lookup_keys(index,key_pool,key_codes)
+        matched = flatnonzero(matches >= 0)
+        self_keys = set(key_pool.tolist())
+        extra_rows = array(sorted(i for key,i in index.iteritems()\
+          if key not in self_keys),dtype=intp)
+        n_self_rows = len(matches)
+        n_rows = n_self_rows+len(extra_rows)
+        
+        #Columns of self that added rows of other can fill in
+        other_cols = dict((col,col) for col in self.ColIds if col in other.ColIndices)
+        other_cols[on] = other_on
+        #Added rows are named by their row id in other if it has the row
+        #id column of self, and otherwise by their key
+        other_cols.setdefault(self.ColIds[0],other_on)
+        new_cols = [col for col in other.ColIds\
+          if col != other_on and col not in self.ColIndices]
+        
+        columns = []
+        for col in self.ColIds:
+            values = empty(n_rows,dtype=object)
+            values[:n_self_rows] = self.getCol(col)
+            if col in other_cols:
+                values[n_self_rows:] = other._columnValues(\
+                  other.ColIndices[other_cols[col]],extra_rows)
+            else:
+                values[n_self_rows:] = fill_value
+            columns.append(values)
+        for col in new_cols:
+            other_values = other.getCol(col)
+            values = empty(n_rows,dtype=object)
+            values[:] = fill_value
+            values[matched] = other_values[matches[matched]]
+            values[n_self_rows:] = other_values[extra_rows]
+            columns.append(values)
+        added_ids = columns[0][n_self_rows:].tolist()
+        repeated = [row_id for row_id in added_ids if row_id in self.RowIndices]
+        if repeated or len(set(added_ids)) < len(added_ids):
+            raise ValueError("An outer join would add rows of other with row ids that are already used: %s"\
+              %(repeated or added_ids))
+        return self._derivedTable(self.ColIds+new_cols,columns)
+
+    @instrumented
+    def joinAll(self,others,on,how='left',other_on=None,fill_value='Unknown'):
+        """Return a new MappingTable with the columns of several tables joined onto self
+
+        others -- a list of MappingTables (e.g. of metadata), in join order
+        on -- the key column of self, or a list giving the key column of
+          self to use for each table in others.  A key column may also be
+          a column added by an earlier table in others.
+        how -- 'left' or 'inner' (see join).  For 'outer', the tables are
+          joined one after another with join.
+        other_on -- the key column of others, or a list of key columns.
+          Defaults to on.
+        fill_value -- the value of fields that have no matching row
+
+        The result is the same as chaining join, but each table is indexed
+        and matched once, and the output columns are only assembled after 
+        every table has been matched.
+        """
+        if isinstance(on,basestring):
+            on = [on]*len(others)
+        if other_on is None:
+            other_on = on
+        elif isinstance(other_on,basestring):
+            other_on = [other_on]*len(others)
+        if not len(on) == len(other_on) == len(others):
+            raise ValueError("on and other_on need one key column per table in others")
+        if how == 'outer':
+            result = self
+            for other,on_col,other_on_col in zip(others,on,other_on):
+                result = result.join(other,on_col,'outer',other_on_col,fill_value)
+            return result
+        if how not in ('left','inner'):
+            raise ValueError("how must be 'left','inner' or 'outer', not %s" %how)
+        
+        n_rows = len(self.RowIds)
+        keep = ones(n_rows,dtype=bool)
+        new_cols = []
+        new_values = {}
+        for other,on_col,other_on_col in zip(others,on,other_on):
+            index = other._keyIndex(other_on_col)
+            if on_col in new_values:
+                #Key added by an earlier table
+                key_pool,key_codes = unique(new_values[on_col],return_inverse=True)
+            else:
+                key_pool,key_codes = self.getCategoricalCol(on_col)
+            matches = _lookup_keys(index,key_pool,key_codes)
+            if how == 'inner':
+                keep &= matches >= 0
+            matched = flatnonzero(matches >= 0)
+            for col in other.ColIds:
+                if col == other_on_col or col in self.ColIndices or col in new_values:
+                    continue
+                values = empty(n_rows,dtype=object)
+                values[:] = fill_value
+                values[matched] = other.getCol(col)[matches[matched]]
+                new_cols.append(col)
+                new_values[col] = values
+        
+        rows = slice(None) if keep.all() else flatnonzero(keep)
+        #Columns of self are kept (or selected) as stored
+        columns = [self._storedColumn(j)[rows] for j in range(len(self.ColIds))]
+        columns.extend(new_values[col][rows] for col in new_cols)
+        return self._derivedTable(self.ColIds+new_cols,columns)
+
+    @instrumented
+    def joinNearest(self,other,on,other_on=None,by=None,other_by=None,\
+        tolerance=None,direction='nearest',method='nearest',\
+        conversion_fn=float,fill_value='Unknown'):
+        """Return a new MappingTable joining each row to the nearest row of other by key
+
+        other -- a MappingTable (e.g. of sensor records) to join to this one
+        on -- a column of self with sortable keys (e.g. depth, or dates)
+        other_on -- the key column of other.  Defaults to on.
+        by -- optional list of columns of self that must also match exactly
+          (e.g. ['site'] to only match records from the same site)
+        other_by -- the matching columns of other.  Defaults to by.
+        tolerance -- if set, only match records at most this far from the key
+        direction -- 'nearest' (the closer record, or the earlier if tied),
+          'backward' (the last record at or before the key) or 'forward'
+          (the first record at or after the key)
+        method -- 'nearest' copies the fields of the matched record. 'linear'
+          interpolates numeric fields between the records on either side
+          of the key, and otherwise uses the nearest record.
+        conversion_fn -- converts keys to numbers (see getConvertedCol)
+        fill_value -- the value of fields that have no matching row
+
+        Columns are added as for join.  Rows whose keys are missing or
+        can't be converted are not matched.  Other is sorted by group and 
+        key once, then every row of self is located by binary search.
+        """
+        if direction not in ('nearest','backward','forward'):
+            raise ValueError("direction must be 'nearest','backward' or 'forward', not %s"\
+              %direction)
+        if method not in ('nearest','linear'):
+            raise ValueError("method must be 'nearest' or 'linear', not %s" %method)
+        if other_on is None:
+            other_on = on
+        by = list(by or [])
+        other_by = by if other_by is None else list(other_by)
+        if len(by) != len(other_by):
+            raise ValueError("by and other_by must name the same number of columns")
+        
+        new_cols = [col for col in other.ColIds if col != other_on and\
+          col not in other_by and col not in self.ColIndices]
+        columns = [self._storedColumn(j) for j in range(len(self.ColIds))]
+        
+        x,x_valid = self.getConvertedCol(on,conversion_fn)
+        other_x,other_valid = other.getConvertedCol(other_on,conversion_fn)
+        rows = flatnonzero(x_valid)
+        other_rows = flatnonzero(other_valid)
+        if not len(rows) or not len(other_rows):
+            #Nothing can match
+            for col in new_cols:
+                values = empty(len(self.RowIds),dtype=object)
+                values[:] = fill_value
+                columns.append(values)
+            return self._derivedTable(self.ColIds+new_cols,columns)
+        groups,other_groups = _shared_group_codes(self.groupCodes(by),\
+          other.groupCodes(other_by))
+        
+        #Rank keys of both tables together so (group,key) pairs sort as integers
+        x = x[rows]
+        ranks = unique(concatenate((x,other_x[other_rows])),return_inverse=True)[1]
+        n_ranks = len(ranks)+1
+        row_keys = groups[rows]*n_ranks + ranks[:len(rows)]
+        other_keys = other_groups[other_rows]*n_ranks + ranks[len(rows):]
+        order = other_keys.argsort(kind='mergesort')
+        other_keys = other_keys[order]
+        other_rows = other_rows[order]
+        
+        #The records on either side of each key, within the same group
+        n_other = len(other_rows)
+        before = searchsorted(other_keys,row_keys,side='right') - 1
+        after = searchsorted(other_keys,row_keys,side='left')
+        has_before = before >= 0
+        has_after = after < n_other
+        before = other_rows[before.clip(0,n_other-1)]
+        after = other_rows[after.clip(0,n_other-1)]
+        has_before &= other_groups[before] == groups[rows]
+        has_after &= other_groups[after] == groups[rows]
+        before_dist = x - other_x[before]
+        after_dist = other_x[after] - x
+        if tolerance is not None:
+            has_before &= before_dist <= tolerance
+            has_after &= after_dist <= tolerance
+        
+        if direction == 'backward':
+            use_after = zeros(len(rows),dtype=bool)
+        elif direction == 'forward':
+            use_after = ones(len(rows),dtype=bool)
+        else:
+            use_after = has_after & (~has_before | (after_dist < before_dist))
+        found = where(use_after,has_after,has_before)
+        matched = rows[found]
+        matches = where(use_after,after,before)[found]
+        
+        for col in new_cols:
+            values = empty(len(self.RowIds),dtype=object)
+            values[:] = fill_value
+            values[matched] = other.getCol(col)[matches]
+            if method == 'linear':
+                #Interpolate numeric fields between bracketing records
+                y,y_valid = other.getNumericCol(col)
+                bracketed = has_before & has_after & y_valid[before] & y_valid[after]
+                gap = before_dist + after_dist
+                bracketed &= gap > 0
+                #Only bracketed rows have valid values and a nonzero gap
+                y_before = y[before[bracketed]]
+                y_after = y[after[bracketed]]
+                weight = before_dist[bracketed]/gap[bracketed]
+                interpolated = y_before + (y_after - y_before)*weight
+                values[rows[bracketed]] =\
+                  [str(float(y_val)) for y_val in interpolated]
+            columns.append(values)
+        return self._derivedTable(self.ColIds+new_cols,columns)
+
+    @instrumented
+    def joinWindow(self,other,on,value_cols,window,other_on=None,by=None,\
+        other_by=None,stats=('mean',),conversion_fn=float,fill_value='Unknown'):
+        """Return a new MappingTable adding stats of other's values in a window around each key
+
+        other -- a MappingTable of readings (e.g. a temperature logger)
+        on -- a column of self with keys to aggregate around (e.g. sample dates)
+        value_cols -- list of numeric columns of other to aggregate
+        window -- (start,end) offsets from each key, e.g. (-30,0) for the
+          30 days up to and including a sample date.  Both ends are included.
+        other_on -- the key column of other.  Defaults to on.
+        by -- optional list of columns of self that must also match exactly
+          (e.g. ['site'] to only use readings from the sample's site)
+        other_by -- the matching columns of other.  Defaults to by.
+        stats -- list of 'mean','min','max','sum' or 'count'
+        conversion_fn -- converts keys to numbers (see getConvertedCol)
+        fill_value -- the value of stats for rows without readings in
+          their window (count is 0 for these)
+
+        One column is added per value column and stat, named e.g.
+        'HCOM_temp_5m_mean'.  Missing or non-numeric readings are skipped.
+        Other is sorted once and window ends are found by binary search,
+        so sums, means and counts come from prefix sums.  Min and max 
+        reduce each window's slice of the sorted readings.
+        """
+        for stat in stats:
+            if stat not in WINDOW_STATS:
+                raise ValueError("Unknown window stat %s.  Valid stats are: %s"\
+                  %(stat,",".join(WINDOW_STATS)))
+        start,end = window
+        if start > end:
+            raise ValueError("window start %s is after its end %s" %(start,end))
+        if other_on is None:
+            other_on = on
+        by = list(by or [])
+        other_by = by if other_by is None else list(other_by)
+        if len(by) != len(other_by):
+            raise ValueError("by and other_by must name the same number of columns")
+        new_cols = ["%s_%s" %(col,stat) for col in value_cols for stat in stats]
+        for col in new_cols:
+            if col in self.ColIndices:
+                raise ValueError("Column %s is already in the table" %col)
+        
+        x,x_valid = self.getConvertedCol(on,conversion_fn)
+        other_x,other_valid = other.getConvertedCol(other_on,conversion_fn)
+        rows = flatnonzero(x_valid)
+        other_rows = flatnonzero(other_valid)
+        groups,other_groups = _shared_group_codes(self.groupCodes(by),\
+          other.groupCodes(other_by))
+        
+        #Rank readings and window ends together so (group,key) pairs sort as integers
+        x = x[rows]
+        ranks = unique(concatenate((other_x[other_rows],x+start,x+end)),\
+          return_inverse=True)[1]
+        n_ranks = len(ranks)+1
+        n_other = len(other_rows)
+        other_keys = other_groups[other_rows]*n_ranks + ranks[:n_other]
+        row_groups = groups[rows]*n_ranks
+        lo_keys = row_groups + ranks[n_other:n_other+len(rows)]
+        hi_keys = row_groups + ranks[n_other+len(rows):]
+        order = other_keys.argsort(kind='mergesort')
+        other_keys = other_keys[order]
+        other_rows = other_rows[order]
+        #Readings other_rows[lo[i]:hi[i]] are in the window of rows[i]
+        lo = searchsorted(other_keys,lo_keys,side='left')
+        hi = searchsorted(other_keys,hi_keys,side='right')
+        
+        columns = [self._storedColumn(j) for j in range(len(self.ColIds))]
+        for col in value_cols:
+            y,y_valid = other.getNumericCol(col)
+            y = y[other_rows]
+            y_valid = y_valid[other_rows]
+            counts = cumsum(concatenate(([0],y_valid)))
+            counts = counts[hi] - counts[lo]
+            has_data = counts > 0
+            for stat in stats:
+                values = empty(len(self.RowIds),dtype=object)
+                values[:] = fill_value
+                if stat == 'count':
+                    values[rows] = [str(n) for n in counts]
+                    columns.append(values)
+                    continue
+                if stat in ('mean','sum'):
+                    sums = cumsum(concatenate(([0.0],where(y_valid,y,0.0))))
+                    result = sums[hi] - sums[lo]
+                    if stat == 'mean':
+                        with errstate(invalid='ignore',divide='ignore'):
+                            result = result/counts
+                else:
+                    result = _window_reduce(where(y_valid,y,WINDOW_IDENTITY[stat]),\
+                      lo,hi,WINDOW_REDUCERS[stat],WINDOW_IDENTITY[stat])
+                values[rows[has_data]] = [str(float(v)) for v in result[has_data]]
+                columns.append(values)
+        return self._derivedTable(self.ColIds+new_cols,columns)
+
+    def _keyIndex(self,col):
+        """Return a dict of {value:row position} for col.  Later rows replace earlier ones"""
+        keys = self.getCol(col).tolist()
+        return dict(izip(keys,xrange(len(keys))))
+
+    def _derivedTable(self,header_fields,columns):
+        """Return a new MappingTable of columns, with the comments and settings of self"""
+        result = MappingTable()
+        result.loadTableFromColumns(header_fields,columns,\
+          self.OtherCommentLines,field_delimiter=self.FieldDelimiter,\
+          comment_prefix=self.CommentPrefix,null_tokens=self.NullTokens)
+        return result
+
+    @instrumented
     def splitByCol(self,cols):
         """Return a dict of new MappingTable objects, one for each unique value in col
         
         cols -- list of column to use in splitting the data.  
         New groups of data will be created, each keyed by the tuple
+
+        The new tables are views sharing this table's storage (see
+        subsetByIndex), so splitting does not copy or re-parse the data.
         """
         
         #Note that cols *must not* be a string
         if isinstance(cols,basestring):
             raise ValueError("splitByCol method needs a list of strings for input, not a naked str")
-        col_indices = [self.ColIndices[col] for col in cols]
         
-        row_id_collections = defaultdict(list)
-        for row_id,row_data in self.iterRows():
-            #We want a dict of  groups based on each unique value for our column
-            group = tuple(row_data[col_idx] for col_idx in col_indices)        
-            row_id_collections[group].append(row_id)
-
-        #Now we want to generate a delimited table for each 
-        #set of row ids
-        text_collections = defaultdict(list)
-        for group_id,row_ids in row_id_collections.iteritems():
-            text_collections[group_id]=self.delimitedSelf(limit_to_rows=row_ids)
-
         result={}
-        for group_id,lines in text_collections.iteritems():
-            result[group_id] = MappingTable(lines,field_delimiter=self.FieldDelimiter,\
-              comment_prefix=self.CommentPrefix)
+        if len(cols) == 1:
+            #Uses the value index for cols[0], if there is one
+            for value,row_indices in self.valueGroups(cols[0]).iteritems():
+                result[(value,)] = self.subsetByIndex(row_indices)
+            return result
+        
+        #We want a dict of  groups based on each unique value for our column
+        for group_id,row_indices in self.groupRowIndices(cols):
+            result[group_id] = self.subsetByIndex(row_indices)
         
         return result
 
+    @instrumented
     def interpolate(self,col,reference_col):
         """Interpolate non-numerical values of col using linear piece-wise regression on reference col
         
         col -- column to interpolate (only non-numerical values will be interpolated
         reference_col -- column to use as a reference for interpolated values
+
+        Returns an array of reference_col values for the rows that need
+        interpolation (in table order) and an array of interpolated values of col.
         """
-        print "COL TO INTERPOLATE:",col
-        print "reference_col:",reference_col
-        paired_numeric_vals = self.iterNumericDataByRow(col_names=[col,reference_col])
-        non_numeric_vals = [ref_col for col,ref_col in self.iterNonNumericDataByRow([col,reference_col])]
-        print "non_numeric_x_vals:", non_numeric_vals
-        #print "paired_numeric_data:",[x for x in paired_numeric_vals]
-        x_vals = []
-        for x_val in non_numeric_vals:
-            print "x_val",x_val
-            try:
-                x_val = float(x_val)
-                x_vals.append(x_val)
-            except ValueError:
-                print "Could not convert %s to float" %x_val
-                continue
-                
-        x = array(x_vals) 
-        #default sort is by first element which is what we want.
-        #numpy.interp requires that x_ref be sorted in increasing order
-        sorted_numeric_vals = sorted(paired_numeric_vals)
-        paired_numeric_series = zip(*sorted_numeric_vals)
-        if paired_numeric_series:
-            y_ref,x_ref = paired_numeric_series
-            x_ref,y_ref = map(array,average_points_by_x(x_ref,y_ref))
-        else:
+        instrumentation.debug("COL TO INTERPOLATE:",col)
+        instrumentation.debug("reference_col:",reference_col)
+        y,y_valid = self.getNumericCol(col)
+        x,x_valid = self.getNumericCol(reference_col)
+        
+        #Rows with a usable x but no y value are interpolated
+        #Rows where both are present are the reference data
+        to_interpolate = x_valid & ~y_valid
+        is_reference = x_valid & y_valid
+        if not is_reference.any():
             #No reference data!
             return [],[]
+        
+        x_ref,y_ref = average_points_by_x(x[is_reference],y[is_reference])
         #Quickly check to ensure we are sorted cleanly
-        assert all(diff(x_ref)) > 0
-        #manually convert to list because array() doesn't handle generators
-        print "INPUT INTERPOLATION DATA:",x,x_ref,y_ref
-        try:
-            interpolated_y = interp(x,x_ref,y_ref)
-        except TypeError,e:
-            raise ValueError("Bad input to interpolate:",x,x_ref,y_ref)
-        print "X:",x
-        print"interpolated_y:",interpolated_y
+        assert all(diff(x_ref) > 0)
+        x = x[to_interpolate]
+        instrumentation.debug("INPUT INTERPOLATION DATA:",x,x_ref,y_ref)
+        interpolated_y = interp(x,x_ref,y_ref)
+        instrumentation.debug("X:",x)
+        instrumentation.debug("interpolated_y:",interpolated_y)
         return x,interpolated_y
     
     def selectRowsByValue(self,target_value,ref_col,conversion_fn=float,sides='both'):
@@ -213,50 +1109,210 @@ class MappingTable():
           If both, select rows using only the absolute difference.  
           If 'greater_than', limit the selection to rows that are larger than the target_value. 
           If 'less_than', limit the selection to rows that are smaller than the target_value. 
+
+        Returns a list of the ids of all rows tied for closest, in table order.
+        Lookups use a sorted index of ref_col (see sortedValueIndex).
         """
-         
-        ref_col_idx = self.ColIndices(ref_col)
+        sorted_vals,positions = self.sortedValueIndex(ref_col,conversion_fn)
+        starts,ends,tie_starts,tie_ends =\
+          nearest_sorted_runs(sorted_vals,array([target_value]),sides)
+        row_positions = concatenate((positions[starts[0]:ends[0]],\
+          positions[tie_starts[0]:tie_ends[0]]))
+        return [self.RowIds[i] for i in sorted(row_positions)]
+
+    def selectRowsByValues(self,target_values,ref_col,conversion_fn=float,sides='both'):
+        """Return the id of the row closest to each of many target values
         
-        row_ids = []
-        row_vals = []
-        for row_id,row in self.iterRows():
-            raw_row_val = row[ref_col_idx]
-            
-            try:
-                row_val = conversion_fn(raw_row_val)
-            except ValueError:
-                #skip values that can't be converted (e.g. 'Unknown')
-                continue
-            if sides == 'greater_than' and row_val <= target_val:
-                #we want only rows above target_val
-                continue
-            if sides == 'less_than' and row_val >= target_val:
-                #we want only rows below target_val
-                continue
-            row_ids.append(row_id)
-            row_vals.append(row_val)
-        
-        row_vals = array(row_vals)
-        diffs = abs(row_vals - target_value)
-        min_row_indices = argmin(row_vals)
-        #Not just selecting these from an array of row_ids
-        # because row_ids may be non-numeric
-        min_row_ids = [row_ids[i] for i in list(min_row_indices)]             
-        return min_row_ids
+        target_values -- a sequence of values to match in the reference column
+        ref_col,conversion_fn,sides -- as for selectRowsByValue
+        
+        Returns a list with one row id per target value (None if no row 
+        qualifies).  Where several rows are equally close, the first in 
+        table order is used, preferring smaller values when sides is 'both'.
+        All targets are matched at once by binary search of the sorted index.
+        """
+        sorted_vals,positions = self.sortedValueIndex(ref_col,conversion_fn)
+        if conversion_fn is float:
+            target_values = array(target_values,dtype=float64)
+        else:
+            target_values = object_array(target_values)
+        starts,ends,tie_starts,tie_ends =\
+          nearest_sorted_runs(sorted_vals,target_values,sides)
+        
+        #When tied on both sides, the smaller value's run comes first
+        first = where(tie_starts < tie_ends,tie_starts,starts)
+        return [self.RowIds[positions[s]] if s < e else None\
+          for s,e in zip(first.tolist(),ends.tolist())]
+
+    def sortedValueIndex(self,ref_col,conversion_fn=float):
+        """Return (sorted_values,row_positions) for the convertible values of ref_col
+        
+        ref_col -- the name of the column to index (e.g. 'pH')
+        conversion_fn -- function to convert raw values.  Missing values
+          and values that raise ValueError are left out of the index.
+        
+        Rows with equal values keep their table order.  The index is built 
+        once per column and conversion_fn, and rebuilt after updateCol.
+        """
+        key = (self._colIndex(ref_col),conversion_fn)
+        if key not in self._SortedIndexCache:
+            if conversion_fn is float:
+                values,valid = self.getNumericCol(ref_col)
+                positions = flatnonzero(valid)
+                values = values[positions]
+            else:
+                positions = []
+                converted = []
+                not_null = flatnonzero(self.getValidMask(ref_col))
+                raw_vals = self._columnValues(key[0],not_null)
+                for i,raw_val in izip(not_null.tolist(),raw_vals.tolist()):
+                    try:
+                        converted.append(conversion_fn(raw_val))
+                    except ValueError:
+                        #skip values that can't be converted
+                        continue
+                    positions.append(i)
+                values = object_array(converted)
+                positions = array(positions,dtype=intp)
+            order = values.argsort(kind='mergesort')
+            self._SortedIndexCache[key] = (values[order],positions[order])
+        return self._SortedIndexCache[key]
  
     
+    @instrumented
     def updateColByInterpolation(self,col,ref_col):
-        """Update a column of self.Data using interpolation of col on ref_col"""
-        #Find values that need updating because they lack a 
-
-        non_numeric_entries =\
-          [data for data in self.iterNonNumericDataByRow([col,ref_col])]
+        """Update a column of self.Data using interpolation of col on ref_col
+        
+        Only rows where col is non-numeric and ref_col is numeric are updated.
+        """
+        y,y_valid = self.getNumericCol(col)
+        x,x_valid = self.getNumericCol(ref_col)
         x_series,y_series = self.interpolate(col,ref_col)
-        update_dict = {x:y for x,y in zip(x_series,y_series)}
-        return self.updateCol(col,ref_col,update_dict,conversion_fn=float)
+        if not len(x_series):
+            return self
+        
+        new_vals = self._column(self.ColIndices[col]).copy()
+        new_vals[x_valid & ~y_valid] = [str(float(y_val)) for y_val in y_series]
+        self._setColumn(self.ColIndices[col],new_vals)
+        return self
+
+    @instrumented
+    def updateColsByInterpolation(self,cols,ref_col,group_cols=None,jobs=1):
+        """Update several columns by interpolation on ref_col within groups of rows
 
+        cols -- list of columns to interpolate (only non-numerical values 
+          will be updated)
+        ref_col -- column to use as a reference (the x axis) for interpolation
+        group_cols -- list of columns defining groups.  Interpolation only uses
+          reference data from rows that share values for all of these columns.
+          If None, all rows form a single group.
+        jobs -- number of processes to interpolate with.  Each column's
+          groups are split into about jobs tasks of whole groups.
         
-    def updateCol(self,col,ref_col,updates,conversion_fn=None,ignore_vals=["Unknown","NULL","unknown"]):
+        Gives the same result as calling updateColByInterpolation for each 
+        col on each table from splitByCol(group_cols), but sorts the rows by 
+        (group,ref_col) once and interpolates all groups in one pass per col.
+        """
+        x,x_valid = self.getNumericCol(ref_col)
+        if group_cols:
+            groups = self.groupCodes(group_cols)[0]
+        else:
+            groups = zeros(len(self.RowIds),dtype=int64)
+        
+        #Encode (group,x) as a single integer key that sorts in the
+        #same order, using the rank of each x value
+        x_order_vals,x_ranks = unique(x[x_valid],return_inverse=True)
+        n_ranks = max(len(x_order_vals),1)
+        valid_rows = flatnonzero(x_valid)
+        keys = groups[valid_rows].astype(int64)*n_ranks + x_ranks
+        order = keys.argsort(kind='mergesort')
+        sorted_rows = valid_rows[order]
+        sorted_keys = keys[order]
+        
+        ys = [self.getNumericCol(col) for col in cols]
+        if jobs <= 1:
+            slices = [(0,len(sorted_rows))]
+        else:
+            slices = _group_slices(sorted_keys//n_ranks,jobs)
+        tasks = [(col_idx,start,stop) for col_idx in range(len(cols))\
+          for start,stop in slices]
+        _INTERPOLATION_STATE['args'] = (x,x_order_vals,n_ranks,groups,\
+          sorted_rows,sorted_keys,ys)
+        try:
+            if jobs <= 1 or len(tasks) <= 1:
+                results = map(_interpolation_task,tasks)
+            else:
+                #Workers are forked with the arrays above, so only task
+                #bounds and results are pickled
+                pool = Pool(min(jobs,len(tasks)))
+                try:
+                    results = pool.map(_interpolation_task,tasks)
+                finally:
+                    pool.close()
+                    pool.join()
+        finally:
+            _INTERPOLATION_STATE.clear()
+        
+        #Merge results in column, then group order
+        for col_idx,col in enumerate(cols):
+            col_results = results[col_idx*len(slices):(col_idx+1)*len(slices)]
+            rows = concatenate([r for r,y_vals in col_results])
+            if not len(rows):
+                continue
+            y_vals = concatenate([y_vals for r,y_vals in col_results])
+            new_vals = self._column(self.ColIndices[col]).copy()
+            new_vals[rows] = [str(y_val) for y_val in y_vals.tolist()]
+            self._setColumn(self.ColIndices[col],new_vals)
+        
+        return self
+
+    def groupCodes(self,cols):
+        """Return (codes,keys) describing groups of rows sharing values in cols
+
+        cols -- list of columns to use in grouping rows
+        
+        codes is an integer array giving the group of each row, and keys
+        is a list giving the tuple of column values for each group code.
+        """
+        n_rows = len(self.RowIds)
+        codes = zeros(n_rows,dtype=int64)
+        n_groups = 1
+        for col in cols:
+            col_values,col_codes = self.getCategoricalCol(col)
+            #Keep codes compact so they can't overflow with many cols
+            codes = codes*len(col_values) + col_codes
+            n_combined = n_groups*len(col_values)
+            if n_combined <= 4*n_rows:
+                #Few enough combinations to count them rather than sort
+                present = bincount(codes,minlength=n_combined) > 0
+                codes = (cumsum(present) - 1)[codes]
+                n_groups = int(present.sum())
+            else:
+                codes = unique(codes,return_inverse=True)[1]
+                n_groups = int(codes.max()) + 1 if n_rows else 0
+        if not n_rows:
+            return codes,[]
+        #Codes are 0..n_groups-1, so these are the first rows of each group
+        first_rows = unique(codes,return_index=True)[1]
+        col_data = [self._columnValues(self._colIndex(col),first_rows).tolist()\
+          for col in cols]
+        keys = zip(*col_data) if cols else [()]
+        return codes,keys
+
+    def groupRowIndices(self,cols):
+        """Return a list of (key,row positions) pairs for each group of rows sharing values in cols
+        
+        key is the tuple of values of cols for the group, and row positions 
+        is an array of the group's rows in table order.
+        """
+        codes,keys = self.groupCodes(cols)
+        order = codes.argsort(kind='mergesort')
+        bounds = searchsorted(codes[order],arange(len(keys)+1))
+        return [(key,order[start:end]) for key,start,end in\
+          zip(keys,bounds[:-1],bounds[1:])]
+
+    @instrumented
+    def updateCol(self,col,ref_col,updates,conversion_fn=None,ignore_vals=None):
         """Update self.Data for col with values from update_dict
 
         col -- the name of a column to update (i.e. overwrite)
@@ -265,26 +1321,33 @@ class MappingTable():
         column values equal to a key in the dict will be set to the value of the dict
         conversion_fn -- a function to apply to each value in ref_col before
         matching to the keys of updates
+        ignore_vals -- reference values not passed to conversion_fn.  If 
+        None, missing values (see getValidMask) are not converted.
         """
         if ref_col not in self.ColIndices:
             err_text = "%s is not a valid column.  Valid columns are: %s"%(ref_col,self.ColIndices.keys())
             raise ValueError(err_text)
-        ref_val_idx = self.ColIndices[ref_col]
-        curr_val_idx = self.ColIndices[col]
-
-        for i,row in enumerate(self.Data):
-            
-            reference_val = row[ref_val_idx]
-            curr_data_val = row[curr_val_idx]
-            #NOTE: do not update values not in update dict
-            #This is accomplished by updating these values
-            # with the reference valiiue
-            if conversion_fn is not None and reference_val not in ignore_vals:
+        curr_val_idx = self._colIndex(col)
+        
+        #Look up each distinct reference value once
+        ref_pool,ref_codes = self.getCategoricalCol(ref_col)
+        if ignore_vals is None:
+            ignore_vals = self.NullTokens
+        to_convert = ~null_mask(ref_pool,ignore_vals)
+        has_update = zeros(len(ref_pool),dtype=bool)
+        pool_updates = empty(len(ref_pool),dtype=object)
+        for k,reference_val in enumerate(ref_pool.tolist()):
+            if conversion_fn is not None and to_convert[k]:
                 reference_val = conversion_fn(reference_val)
-            
-            update_val = str(updates.get(reference_val,curr_data_val))
-            self.Data[i][curr_val_idx]=update_val
+            #NOTE: do not update values not in update dict
+            if reference_val in updates:
+                has_update[k] = True
+                pool_updates[k] = str(updates[reference_val])
         
+        new_vals = self._column(curr_val_idx).copy()
+        rows_to_update = has_update[ref_codes]
+        new_vals[rows_to_update] = pool_updates[ref_codes[rows_to_update]]
+        self._setColumn(curr_val_idx,new_vals)
         return self
 
     def rowMatches(self,row,criteria={}):
@@ -304,13 +1367,122 @@ class MappingTable():
         return True
     
     def rowsMatching(self,criteria={}):
-        """Return all rows matching criteria"""
-        for row_id,row in self.iterRows():
-            if self.rowMatches(row,criteria):
-                yield row_id,row
+        """Return all rows matching criteria
+        criteria -- a dict of field names and ok values (as for rowMatches),
+          query text (see make_criterion_from_text) or a compiled criterion
+        """
+        row_indices = flatnonzero(self.rowMaskMatching(criteria))
+        for row_id,row in self.iterRowsByIndex(row_indices):
+            yield row_id,row
+
+    def rowMaskMatching(self,criteria={}):
+        """Return a boolean array that is True for rows matching criteria
+        criteria -- a dict of field names and ok values (as for rowMatches),
+          query text (see make_criterion_from_text) or a compiled criterion
+        
+        The criteria are evaluated over whole columns at once.
+        """
+        if isinstance(criteria,basestring):
+            criteria = make_criterion_from_text(criteria)
+        elif isinstance(criteria,dict):
+            criteria = make_criterion_from_dict(criteria)
+        return criteria(self)
+
+    def evaluateExpression(self,expression,date_formats=DEFAULT_DATE_FORMATS):
+        """Return a (values,valid) pair of arrays of the value of expression in each row
+
+        expression -- expression text (see make_expression_from_text) or
+          a compiled expression
+        date_formats -- formats of dates read by the expression
+
+        valid is False for rows with no result.  Text results are
+        returned as an object array.
+        """
+        if isinstance(expression,basestring):
+            expression = make_expression_from_text(expression,date_formats)
+        values,valid = expression(self)
+        if isinstance(values,CategoricalColumn):
+            values = values.values()
+        return values,valid
+
+    @instrumented
+    def addDerivedColumn(self,col_id,expression,fill_value='Unknown',\
+        date_formats=DEFAULT_DATE_FORMATS):
+        """Add a column of the value of expression in each row, e.g. to label samples
+
+        col_id -- name of the new column (e.g. 'TreatmentPhase')
+        expression -- expression text (see make_expression_from_text) or
+          a compiled expression.  Example: 'if date(SampleDate) < 
+          date(StartDate) then "pre" else "post"'
+        fill_value -- the value of rows with no result (e.g. a missing date)
+        date_formats -- formats of dates read by the expression
+
+        The expression is evaluated over whole columns.  Numbers with an
+        integer type (e.g. days between dates) are written as integers,
+        other numbers as str(float), dates as yyyymmdd and conditions as
+        True or False.  Returns col_id.
+        """
+        if col_id in self.ColIndices:
+            raise ValueError("Column %s is already in the table" %col_id)
+        if isinstance(expression,basestring):
+            expression = make_expression_from_text(expression,date_formats)
+        self._appendColumn(col_id,_expression_stored_column(self,expression(self),\
+          fill_value))
+        return col_id
+
+    @instrumented
+    def mapRows(self,func,col_id,columns=None,jobs=1,chunksize=None):
+        """Add a column of the result of calling func on each row
+
+        func -- a function taking a dict of {column:value} for one row
+          and returning a string (other results are converted with str)
+        col_id -- name of the new column
+        columns -- the columns passed to func [default: all columns]
+        jobs -- number of processes to call func in
+        chunksize -- rows per task [default: about four tasks per job]
+
+        For derivations that can't be written as expressions (see 
+        addDerivedColumn).  Rows are split into chunks, which are run 
+        across a process pool when jobs > 1.  Workers are forked with 
+        func and the requested columns, so only chunk bounds and results
+        are pickled, and func may be a lambda or closure.  Results are 
+        collected in row order.  Returns col_id.
+        """
+        if col_id in self.ColIndices:
+            raise ValueError("Column %s is already in the table" %col_id)
+        if columns is None:
+            columns = list(self.ColIds)
+        if not columns:
+            raise ValueError("mapRows needs at least one column to pass to func")
+        stored = [self._storedColumn(self._colIndex(col)) for col in columns]
+        n_rows = len(self.RowIds)
+        if chunksize is None:
+            chunksize = max(1,-(-n_rows//(4*max(jobs,1))))
+        chunks = [(start,min(start+chunksize,n_rows)) for start in\
+          xrange(0,n_rows,chunksize)]
+        _ROW_MAP_STATE['args'] = (func,columns,stored)
+        try:
+            if jobs <= 1 or len(chunks) <= 1:
+                results = map(_row_map_task,chunks)
+            else:
+                pool = Pool(min(jobs,len(chunks)))
+                try:
+                    results = pool.map(_row_map_task,chunks)
+                finally:
+                    pool.close()
+                    pool.join()
+        finally:
+            _ROW_MAP_STATE.clear()
+        values = object_array(value for chunk in results for value in chunk)
+        self._appendColumn(col_id,encode_column(values))
+        return col_id
    
-    def delimitedSelf(self,limit_to_rows=None,write_header=True,write_comments=True):
-        """Output a delimited version of self"""
+    def delimitedSelf(self,limit_to_rows=None,write_header=True,write_comments=True,\
+        row_indices=None):
+        """Output a delimited version of self
+        limit_to_rows -- if supplied, only output rows with these ids
+        row_indices -- if supplied, only output rows at these positions
+        """
         delimiter = self.FieldDelimiter
         
         result = []
@@ -324,90 +1496,848 @@ class MappingTable():
             for comment in self.OtherCommentLines:
                 result.append(comment) #must already start with comment prefix
         
-        for fields in self.iterRowData(limit_to_rows):
+        if limit_to_rows is not None:
+            row_indices = self.rowIndices(limit_to_rows)
+        
+        for row_id,fields in self.iterRowsByIndex(row_indices):
             data_line = "%s\n" %(delimiter.join(fields))
             result.append(data_line)
 
         return result
 
+    @instrumented
+    def writeTable(self,out,limit_to_rows=None,write_header=True,\
+        write_comments=True,row_indices=None,cols=None,rows_per_chunk=10000):
+        """Write a delimited version of self to a file object or path
+        out -- an open file object, or the path of a file to (over)write
+        limit_to_rows -- if supplied, only output rows with these ids
+        row_indices -- if supplied, only output rows at these positions
+        cols -- if supplied, only output these columns, in this order
+        rows_per_chunk -- the number of rows formatted per write call
+
+        Rows are formatted and written a chunk at a time, so memory use
+        does not grow with the size of the output.  When out is a path,
+        the table is written to a temporary file in the same directory
+        and renamed over out once complete, so readers never see a 
+        partially written file.
+        """
+        chunks = self.iterDelimitedChunks(limit_to_rows=limit_to_rows,\
+          write_header=write_header,write_comments=write_comments,\
+          row_indices=row_indices,cols=cols,rows_per_chunk=rows_per_chunk)
+        
+        if instrumentation.ENABLED:
+            chunks = instrumentation.counted_bytes('writeTable',chunks)
+        
+        if not isinstance(out,basestring):
+            for chunk in chunks:
+                out.write(chunk)
+            return
+        
+        out_dir,out_name = os.path.split(os.path.abspath(out))
+        fd,temp_path = mkstemp(prefix=".%s." %out_name,suffix=".tmp",dir=out_dir)
+        try:
+            with os.fdopen(fd,"w") as temp_file:
+                for chunk in chunks:
+                    temp_file.write(chunk)
+            #mkstemp creates private files; match what open() would give
+            if os.path.exists(out):
+                mode = os.stat(out).st_mode & 0777
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0666 & ~umask
+            os.chmod(temp_path,mode)
+            os.rename(temp_path,out)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def iterDelimitedChunks(self,limit_to_rows=None,write_header=True,\
+        write_comments=True,row_indices=None,cols=None,rows_per_chunk=10000):
+        """Iterate blocks of delimited text that together make up self
+        
+        Arguments are as for writeTable.  Each block holds the lines
+        for at most rows_per_chunk rows.
+        """
+        delimiter = self.FieldDelimiter
+        if cols is None:
+            cols = self.ColIds
+        #Check cols are valid before writing anything
+        col_indices = [self._colIndex(col) for col in cols]
+        
+        if write_header:
+            yield "%s%s\n" %(self.CommentPrefix,delimiter.join(cols))
+        
+        if write_comments and self.OtherCommentLines:
+            #must already start with comment prefix
+            yield "".join(self.OtherCommentLines)
+        
+        if limit_to_rows is not None:
+            row_indices = self.rowIndices(limit_to_rows)
+        n_rows = len(self.RowIds) if row_indices is None else len(row_indices)
+        
+        for start in xrange(0,n_rows,rows_per_chunk):
+            if row_indices is None:
+                block = slice(start,start+rows_per_chunk)
+            else:
+                block = row_indices[start:start+rows_per_chunk]
+            block_cols = [self._columnValues(j,block).tolist() for j in col_indices]
+            yield "".join(["%s\n" %delimiter.join(fields)\
+              for fields in izip(*block_cols)])
+
     def mergedColsAsText(self,cols,merged_col_delimiter="_"):
         """output a list of lines mapping sample ids to a set of merged columns
         cols_to_merge -- list of header names for columns to merge
         """
-        all_col_data = []
-        col_names = []
-        for col_name,col_vals in self.iterCols(cols):
-           all_col_data.append(col_vals)
-           col_names.append(col_name)
+        yield merged_col_delimiter.join(cols)+"\n"
+        merged = self._mergedColumn(cols,merged_col_delimiter)
+        if isinstance(merged,CategoricalColumn):
+            merged = merged.values()
+        for value in merged.tolist():
+            yield value+"\n"
 
-        yield merged_col_delimiter.join(col_names)+"\n"
-        print "all_col_data:",all_col_data
-        
-        for merged_row_items in zip(*all_col_data):
-            print "merged_row_items:",merged_row_items
-            curr_result=merged_col_delimiter.join(map(str,merged_row_items))+"\n"
-            yield curr_result 
-    
+    def addMergedColumn(self,cols,delimiter="_",merged_col=None,index=True):
+        """Add a column joining the values of cols in each row, e.g. for composite keys
+
+        cols -- list of columns to merge (e.g. ['Site','Date'])
+        delimiter -- string placed between the merged values
+        merged_col -- name of the new column.  Defaults to the names of
+          cols joined by delimiter (e.g. 'Site_Date').
+        index -- if True, also index the new column by value (see createIndex)
+
+        The merged values are built once per distinct combination of 
+        values in cols (from their dictionary codes), not once per row.
+        Returns the name of the new column.
+        """
+        if merged_col is None:
+            merged_col = delimiter.join(cols)
+        if merged_col in self.ColIndices:
+            raise ValueError("Column %s is already in the table" %merged_col)
+        self._appendColumn(merged_col,self._mergedColumn(cols,delimiter))
+        if index:
+            self.createIndex(merged_col)
+        return merged_col
+
+    def _mergedColumn(self,cols,delimiter):
+        """Return a stored column of the values of cols joined by delimiter"""
+        group_codes,keys = self.groupCodes(cols)
+        if not keys:
+            return object_array([])
+        pool,pool_codes = dictionary_encode([delimiter.join(key) for key in keys])
+        codes = pool_codes[group_codes]
+        if len(pool) > CATEGORICAL_MAX_FRACTION*len(codes):
+            return pool.take(codes)
+        return CategoricalColumn(pool,codes.astype(min_scalar_type(len(pool)-1)))
+
+    def _appendColumn(self,col_id,col):
+        """Add a stored array or CategoricalColumn as a new last column"""
+        self._materialize()
+        self.HeaderFields.append(col_id)
+        self.ColIndices[col_id] = len(self.HeaderFields)-1
+        self._Columns.append(col)
+
+    @instrumented
     def loadTableFromLines(self,lines,field_delimiter="\t",comment_prefix="#",
-        row_id_field_idx=0,header_row=0):
+        row_id_field_idx=0,header_row=0,lazy=False,null_tokens=DEFAULT_NULL_TOKENS):
         """Populate a mapping table object from lines
         
         Notably, SampleIds are currently preserved in self.Data
+
+        Rows with fewer fields than the header are padded with empty fields.
+        Rows with more raise a ValueError, unless the extra fields are all 
+        empty (e.g. a trailing tab).
+
+        lazy -- if True, keep the data lines and split out each column only
+          when it is first accessed.
+        null_tokens -- field values that mean a value is missing
         """
         
+        if instrumentation.ENABLED:
+            instrumentation.record('loadTableFromLines',calls=0,\
+              n_bytes=sum(len(line) for line in lines))
+        
         header=lines[header_row]
+        header_fields=[h.strip() for h in\
+          header.lstrip(comment_prefix).split(field_delimiter)]
+        self._resetTable(header_fields,field_delimiter,comment_prefix,null_tokens)
+        n_cols = len(self.HeaderFields)
 
-        self.FieldDelimiter=field_delimiter
-        self.CommentPrefix=comment_prefix
-        
-        self.HeaderFields=\
-          header.lstrip(comment_prefix).split(field_delimiter)
-        
-        self.HeaderFields=[h.strip() for h in self.HeaderFields]
-        self.OtherCommentLines=[]
-        self.RowIndices={}
-        self.ColIndices={}
-        self.RowIds=[]
-        self.ColIds=self.HeaderFields
-        self.Data = []
+        rows = []
         for line in lines[1:]:
             #Non-header comment lines are saved without processing
             if line.startswith(comment_prefix):
                 self.OtherCommentLines.append(line)
                 continue
             
-            fields = [f.strip() for f in line.split(field_delimiter)]
+            if lazy:
+                #Count fields without splitting them, so bad lines still fail now
+                n_fields = line.count(field_delimiter) + 1
+                if n_fields > n_cols:
+                    check_extra_fields(line.split(field_delimiter),n_cols,line)
+                rows.append(line)
+                row_id = split_field(line,row_id_field_idx,field_delimiter)
+            else:
+                fields = split_fields(line,field_delimiter,n_cols)
+                rows.append(fields)
+                row_id = fields[row_id_field_idx]
             
-            #if a non-comment line, add to self.Data
-            self.Data.append(fields)
-            i=len(self.Data) - 1   
+            i=len(rows) - 1   
             #using this instead of enumerate because we skip some lines
             
-            row_id = fields[row_id_field_idx]
             self.RowIds.append(row_id)
 
             #Map identifier to this index
             self.RowIndices[row_id] = i
-            
-            for j,field in enumerate(fields):
-                #Map column identifier to this index
-                col_id = self.HeaderFields[j]
-                self.ColIndices[col_id]=j
+        
+        if lazy:
+            self._ColumnSource = LineColumnSource(rows,field_delimiter,n_cols)
+            self._Columns = [None]*n_cols
+            return
+        
+        #Transpose parsed rows into one contiguous array per column
+        self._Columns = [encode_column(object_array(col_data)) for col_data in\
+          (izip(*rows) if rows else [()]*n_cols)]
 
-            
+    def loadTableFromColumns(self,header_fields,columns,other_comment_lines=(),\
+        row_id_field_idx=0,field_delimiter="\t",comment_prefix="#",\
+        null_tokens=DEFAULT_NULL_TOKENS):
+        """Populate a mapping table from a list of columns of field values
+        
+        header_fields -- the column ids of the table
+        columns -- a sequence of fields (or a CategoricalColumn) for each 
+          column, in header order
+        other_comment_lines -- non-header comment lines, with comment prefix
+        row_id_field_idx -- the index of the column holding row ids
+        null_tokens -- field values that mean a value is missing
+        """
+        if len(columns) != len(header_fields):
+            raise ValueError("Got %i columns for %i header fields"\
+              %(len(columns),len(header_fields)))
+        columns = [col if isinstance(col,CategoricalColumn) else\
+          object_array(col) for col in columns]
+        if len(set(len(col) for col in columns)) > 1:
+            raise ValueError("Columns must all have the same number of rows")
+        self._resetTable(header_fields,field_delimiter,comment_prefix,null_tokens)
+        self.OtherCommentLines.extend(other_comment_lines)
+        self._Columns = [col if isinstance(col,CategoricalColumn) else\
+          encode_column(col) for col in columns]
+        if columns:
+            self.RowIds = self._column(row_id_field_idx).tolist()
+        self.RowIndices = dict((row_id,i) for i,row_id in enumerate(self.RowIds))
+
+    @instrumented
+    def loadTableFromColumnSource(self,header_fields,row_ids,column_source,\
+        other_comment_lines=(),field_delimiter="\t",comment_prefix="#",\
+        null_tokens=DEFAULT_NULL_TOKENS):
+        """Populate a mapping table whose columns are loaded on first use
+        
+        header_fields -- the column ids of the table
+        row_ids -- the id of each row, in table order
+        column_source -- an object whose column(col_idx) method returns
+          the object array of fields for a column, and whose row(row_idx)
+          method returns the list of fields for a row (e.g. LineColumnSource)
+        other_comment_lines -- non-header comment lines, with comment prefix
+        null_tokens -- field values that mean a value is missing
+        """
+        self._resetTable(header_fields,field_delimiter,comment_prefix,null_tokens)
+        self.OtherCommentLines.extend(other_comment_lines)
+        self.RowIds = list(row_ids)
+        self.RowIndices = dict((row_id,i) for i,row_id in enumerate(self.RowIds))
+        self._ColumnSource = column_source
+        self._Columns = [None]*len(self.HeaderFields)
+
+    def _resetTable(self,header_fields,field_delimiter,comment_prefix,null_tokens):
+        """Start an empty table with the given header, dropping any old data"""
+        #Existing views must keep the data they were made from
+        self._detachViews()
+        self.FieldDelimiter=field_delimiter
+        self.CommentPrefix=comment_prefix
+        self.NullTokens=tuple(null_tokens)
+        self.HeaderFields=list(header_fields)
+        self.OtherCommentLines=[]
+        self._resetCaches()
+        self._Parent=None
+        self._RowSelection=None
+        self._ColumnSource=None
+        self.RowIndices={}
+        self.ColIndices={}
+        self.RowIds=[]
+        self.ColIds=self.HeaderFields
+        for j,col_id in enumerate(self.HeaderFields):
+            #Map column identifier to this index
+            self.ColIndices[col_id]=j
+
+
+class RowView(object):
+    """Read-only, list-like row view of a MappingTable's columnar storage
+
+    Supports len(), iteration, indexing and comparison against lists
+    of rows.  Each row is built from the columns on access.
+    """
+    def __init__(self,table):
+        self.Table = table
+
+    def __len__(self):
+        return len(self.Table.RowIds)
+
+    def __iter__(self):
+        for row_id,row in self.Table.iterRows():
+            yield row
+
+    def __getitem__(self,idx):
+        if isinstance(idx,slice):
+            return [self.Table._row(i) for i in xrange(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("row index out of range")
+        return self.Table._row(idx)
+
+    def __eq__(self,other):
+        return list(self) == list(other)
+
+    def __ne__(self,other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class CategoricalColumn(object):
+    """A dictionary encoded column: a pool of distinct values plus a code per row"""
+
+    def __init__(self,pool,codes):
+        """pool -- sorted object array of distinct values
+        codes -- integer array giving the position in pool of each row's value
+        """
+        self.Pool = pool
+        self.Codes = codes
+
+    def __len__(self):
+        return len(self.Codes)
+
+    def __getitem__(self,idx):
+        """Return the value of one row, or a CategoricalColumn of several rows"""
+        if isinstance(idx,(int,long,integer)):
+            return self.Pool[self.Codes[idx]]
+        return CategoricalColumn(self.Pool,self.Codes[idx])
+
+    def values(self):
+        """Return an object array of the value of each row"""
+        return self.Pool.take(self.Codes)
+
+    def rowIndicesWithValue(self,value):
+        """Return an array of positions of rows equal to value"""
+        pool_idx = flatnonzero(self.Pool == value)
+        if not len(pool_idx):
+            return array([],dtype=intp)
+        return flatnonzero(self.Codes == pool_idx[0])
+
+#Dictionary encode columns with at most this many distinct values per row
+CATEGORICAL_MAX_FRACTION = 0.5
+
+def encode_column(values,max_fraction=CATEGORICAL_MAX_FRACTION):
+    """Return values as a CategoricalColumn if they repeat enough, else unchanged
+
+    values -- an object array of field values
+    max_fraction -- encode only if the number of distinct values is at
+      most this fraction of the number of rows
+    """
+    if not len(values):
+        return values
+    encoded = dictionary_encode(values,int(max_fraction*len(values)))
+    if encoded is None:
+        return values
+    pool,codes = encoded
+    return CategoricalColumn(pool,codes.astype(min_scalar_type(len(pool)-1)))
+
+#Values hashed between checks of the number of distinct values
+ENCODE_CHUNK_SIZE = 65536
+
+def dictionary_encode(values,max_distinct=None):
+    """Return a (pool,codes) pair for a sequence of values, or None if it has too many distinct values
+
+    values -- a sequence of field values (str or unicode)
+    max_distinct -- stop, returning None, once more than this many 
+      distinct values are found
+
+    Values are hashed, so only the distinct values are sorted.  pool is 
+    sorted unless its values can't be compared (e.g. non-ASCII byte 
+    strings mixed with unicode), in which case it is in order of first
+    appearance.
+    """
+    values = list(values)
+    index = {}
+    setdefault = index.setdefault
+    codes = []
+    for start in xrange(0,len(values),ENCODE_CHUNK_SIZE):
+        codes.extend([setdefault(value,len(index)) for value in\
+          values[start:start+ENCODE_CHUNK_SIZE]])
+        if max_distinct is not None and len(index) > max_distinct:
+            return None
+    codes = array(codes,dtype=intp)
+    pool = empty(len(index),dtype=object)
+    pool[index.values()] = index.keys()
+    try:
+        order = array(sorted(xrange(len(pool)),key=pool.__getitem__),dtype=intp)
+    except (TypeError,UnicodeError):
+        return pool,codes
+    ranks = empty(len(pool),dtype=intp)
+    ranks[order] = arange(len(pool))
+    return pool[order],ranks[codes]
+
+#Lazily loaded tables keep where every this many'th field starts in each line
+LAZY_CHECKPOINT_COLS = 16
+
+class LineColumnSource(object):
+    """Split columns or rows out of data lines on demand (see MappingTable lazy)"""
+
+    def __init__(self,lines,field_delimiter,n_cols):
+        self.Lines = lines
+        self.FieldDelimiter = field_delimiter
+        self.NCols = n_cols
+        #Where field NSplit of each line starts (past the end if it's short)
+        self.Offsets = None
+        self.NSplit = 0
+        #Offsets when NSplit was each multiple of LAZY_CHECKPOINT_COLS
+        self.Checkpoints = {}
+
+    def column(self,col_idx):
+        """Return an object array of the fields at col_idx of every line
+
+        Each line is read onward from the end of the last column loaded,
+        so loading columns left to right reads each field only once.
+        Between calls only offsets into the lines are kept, not fields.
+        A column left of the last one loaded is read from the nearest
+        checkpoint before it, so at most LAZY_CHECKPOINT_COLS fields of
+        each line are read again.
+        """
+        if col_idx < self.NSplit:
+            checkpoint = col_idx - col_idx % LAZY_CHECKPOINT_COLS
+            offsets = self.Checkpoints[checkpoint].tolist()
+            return object_array([split_field(line[start:],col_idx-checkpoint,\
+              self.FieldDelimiter) for line,start in izip(self.Lines,offsets)])
+        if self.Offsets is None:
+            self.Offsets = [0]*len(self.Lines)
+        for j in xrange(self.NSplit,col_idx):
+            self._checkpoint(j)
+            self._readFields(self.Offsets)
+        self._checkpoint(col_idx)
+        values = self._readFields(self.Offsets,keep=True)
+        self.NSplit = col_idx+1
+        return object_array(values)
+
+    def _checkpoint(self,col_idx):
+        """Save the current offsets if col_idx is a checkpoint column"""
+        if col_idx % LAZY_CHECKPOINT_COLS == 0:
+            self.Checkpoints[col_idx] = array(self.Offsets)
+
+    def _readFields(self,offsets,keep=False):
+        """Move each line's offset past its next field
+        
+        keep -- if True, return the list of the stripped fields read
+        """
+        delimiter = self.FieldDelimiter
+        step = len(delimiter)
+        values = []
+        for i,line in enumerate(self.Lines):
+            start = offsets[i]
+            end = line.find(delimiter,start)
+            if end < 0:
+                #The last field, or past the end of a short line
+                end = len(line)
+            if keep:
+                values.append(line[start:end].strip())
+            offsets[i] = end+step
+        return values
+
+    def row(self,row_idx):
+        """Return the list of fields on the line at row_idx"""
+        return split_fields(self.Lines[row_idx],self.FieldDelimiter,self.NCols)
+
+def _shared_group_codes(groups,other_groups):
+    """Return group codes for two tables that agree on which groups match
+
+    groups,other_groups -- (codes,keys) pairs, as from MappingTable.groupCodes
+    """
+    group_ids = {}
+    codes,keys = groups
+    other_codes,other_keys = other_groups
+    key_ids = array([group_ids.setdefault(key,len(group_ids)) for key in keys]+[0],\
+      dtype=int64)
+    other_key_ids = array([group_ids.setdefault(key,len(group_ids))\
+      for key in other_keys]+[0],dtype=int64)
+    return key_ids[codes],other_key_ids[other_codes]
+
+#Arrays shared with forked interpolation workers (see updateColsByInterpolation)
+_INTERPOLATION_STATE = {}
+
+def _interpolation_task(task):
+    """Return (rows,values) interpolated for one column and slice of sorted rows
+
+    task -- (index of the column in the shared ys,start,stop) of the
+      slice of the shared sorted rows to interpolate
+    """
+    col_idx,start,stop = task
+    x,x_order_vals,n_ranks,groups,sorted_rows,sorted_keys,ys =\
+      _INTERPOLATION_STATE['args']
+    y,y_valid = ys[col_idx]
+    return interpolate_sorted_rows(x,x_order_vals,n_ranks,groups,\
+      sorted_rows[start:stop],sorted_keys[start:stop],y,y_valid)
+
+def interpolate_sorted_rows(x,x_order_vals,n_ranks,groups,sorted_rows,\
+    sorted_keys,y,y_valid):
+    """Return (rows,values) of missing y interpolated within groups on x
+
+    x -- the reference values of every row
+    x_order_vals -- the sorted unique valid values of x
+    n_ranks -- the number of ranks used to encode keys
+    groups -- the group code of every row
+    sorted_rows,sorted_keys -- rows with valid x, sorted by their
+      (group*n_ranks + rank of x) keys.  Groups must not be split.
+    y,y_valid -- the values to interpolate, and which are known
+    """
+    is_known = y_valid[sorted_rows]
+    
+    #Reference points: average y for duplicated (group,x) keys
+    known_keys = sorted_keys[is_known]
+    if not len(known_keys):
+        return empty(0,dtype=intp),empty(0,dtype=float64)
+    starts = flatnonzero(concatenate(([True],\
+      known_keys[1:] != known_keys[:-1])))
+    ref_keys = known_keys[starts]
+    ref_y = add.reduceat(y[sorted_rows[is_known]],starts)/\
+      diff(concatenate((starts,[len(known_keys)])))
+    ref_groups = ref_keys // n_ranks
+    ref_x = x_order_vals[ref_keys % n_ranks]
+    
+    #Find the reference points bracketing each missing value
+    query_rows = sorted_rows[~is_known]
+    query_keys = sorted_keys[~is_known]
+    query_groups = groups[query_rows]
+    query_x = x[query_rows]
+    right = searchsorted(ref_keys,query_keys)
+    left = right - 1
+    n_ref = len(ref_keys)
+    right_clipped = right.clip(0,n_ref-1)
+    left_clipped = left.clip(0,n_ref-1)
+    has_right = (right < n_ref) & (ref_groups[right_clipped] == query_groups)
+    has_left = (left >= 0) & (ref_groups[left_clipped] == query_groups)
+    
+    #Linear interpolation between neighbours, or the nearest
+    #reference value past the ends of a group (as numpy.interp)
+    y_left = ref_y[left_clipped]
+    y_right = ref_y[right_clipped]
+    x_left = ref_x[left_clipped]
+    x_right = ref_x[right_clipped]
+    both = has_left & has_right
+    span = where(both,x_right - x_left,1.0)
+    span[span == 0] = 1.0
+    interpolated = where(both,\
+      y_left + (y_right - y_left)*(query_x - x_left)/span,\
+      where(has_left,y_left,y_right))
+    exact = has_right & (ref_keys[right_clipped] == query_keys)
+    interpolated[exact] = y_right[exact]
+    
+    to_update = has_left | has_right
+    return query_rows[to_update],interpolated[to_update]
+
+#The function and columns shared with forked workers (see mapRows)
+_ROW_MAP_STATE = {}
+
+def _row_map_task(chunk):
+    """Return the list of results of the shared function for a (start,stop) chunk of rows"""
+    func,columns,stored = _ROW_MAP_STATE['args']
+    start,stop = chunk
+    fields = []
+    for col in stored:
+        col = col[start:stop]
+        if isinstance(col,CategoricalColumn):
+            col = col.values()
+        fields.append(col.tolist())
+    results = []
+    for row in izip(*fields):
+        value = func(dict(izip(columns,row)))
+        if not isinstance(value,basestring):
+            value = str(value)
+        results.append(value)
+    return results
+
+def _group_slices(sorted_groups,n_slices):
+    """Return (start,stop) bounds splitting sorted_groups into about n_slices runs of whole groups"""
+    n = len(sorted_groups)
+    if not n:
+        return [(0,0)]
+    group_starts = flatnonzero(concatenate(([True],\
+      sorted_groups[1:] != sorted_groups[:-1])))
+    #Cut at the group start at or after each even split point
+    cuts = searchsorted(group_starts,arange(1,n_slices)*n//n_slices)
+    bounds = unique(concatenate(([0],group_starts.take(cuts,mode='clip'),[n])))
+    return zip(bounds[:-1].tolist(),bounds[1:].tolist())
+
+def _int_strings(values,valid,suffix="",missing="Unknown"):
+    """Return a stored column of '%i'+suffix of values for valid rows, else missing
+
+    Each distinct value is formatted once, and the column is dictionary
+    encoded directly when it repeats enough (see encode_column).
+    """
+    values = values[valid]
+    if len(values):
+        #Integers within a small range are counted rather than sorted
+        low = int(values.min())
+        span = int(values.max()) - low + 1
+        if span <= 4*len(values):
+            present = bincount(values - low,minlength=span) > 0
+            distinct = flatnonzero(present) + low
+            value_codes = (cumsum(present) - 1)[values - low]
+        else:
+            distinct,value_codes = unique(values,return_inverse=True)
+    else:
+        distinct = value_codes = zeros(0,dtype=int64)
+    texts = ["%i%s" %(v,suffix) for v in distinct.tolist()]
+    #Sort the pool, with missing as the last distinct value
+    pool,pool_order = unique(array(texts+[missing]),return_inverse=True)
+    codes = empty(len(valid),dtype=intp)
+    codes.fill(pool_order[-1])
+    codes[valid] = pool_order[value_codes]
+    pool = object_array(pool.tolist())
+    if len(pool) > CATEGORICAL_MAX_FRACTION*len(codes):
+        return pool.take(codes)
+    return CategoricalColumn(pool,codes.astype(min_scalar_type(len(pool)-1)))
+
+def _window_reduce(values,lo,hi,ufunc,identity):
+    """Return ufunc reduced over values[lo[i]:hi[i]] for each i (identity if empty)"""
+    if not len(lo):
+        return empty(0,dtype=float64)
+    #reduceat needs in-range indices, so add an identity element at the end
+    padded = concatenate((values,[identity]))
+    #reduceat also reduces the gaps between windows; in order of lo these
+    #gaps add up to at most len(values)
+    order = lo.argsort(kind='mergesort')
+    bounds = column_stack((lo[order],hi[order])).ravel()
+    result = empty(len(lo),dtype=padded.dtype)
+    result[order] = ufunc.reduceat(padded,bounds)[::2]
+    result[lo >= hi] = identity
+    return result
+
+def _lookup_keys(index,key_pool,key_codes):
+    """Return the index position for each row's key, or -1 if not in index
+
+    index -- a dict of {key:position}
+    key_pool,key_codes -- the distinct keys and a code per row, as from
+      MappingTable.getCategoricalCol
+    """
+    pool_positions = array([index.get(key,-1) for key in key_pool.tolist()],dtype=intp)
+    return pool_positions[key_codes]
+
+def split_fields(line,delimiter,n_fields):
+    """Split a data line into exactly n_fields stripped fields
+    
+    Short lines are padded with empty fields.  Extra empty fields at 
+    the end of the line (e.g. from a trailing tab) are dropped.  Raises 
+    ValueError if the line has more than n_fields non-empty fields.
+    """
+    fields = [f.strip() for f in line.split(delimiter)]
+    if len(fields) > n_fields:
+        check_extra_fields(fields,n_fields,line)
+        del fields[n_fields:]
+    elif len(fields) < n_fields:
+        fields.extend([""]*(n_fields-len(fields)))
+    return fields
+
+def check_extra_fields(fields,n_fields,line):
+    """Raise ValueError if any field of a data line past n_fields is non-empty"""
+    for field in fields[n_fields:]:
+        if field.strip():
+            raise ValueError("Data line has %i fields but header has only %i: %s"\
+              %(len(fields),n_fields,line))
+
+def split_field(line,field_idx,delimiter):
+    """Return the stripped field at field_idx of a data line
+    
+    Only the fields up to field_idx are split.  Returns "" if the line 
+    is too short to have that field.
+    """
+    fields = line.split(delimiter,field_idx+1)
+    if len(fields) <= field_idx:
+        return ""
+    return fields[field_idx].strip()
+
+def object_array(values):
+    """Return a 1d numpy object array holding values (e.g. field strings)"""
+    values = list(values)
+    result = empty(len(values),dtype=object)
+    result[:] = values
+    return result
+
+
+def nearest_sorted_runs(sorted_vals,targets,sides='both'):
+    """Find the run of values nearest to each target in a sorted array
+    
+    sorted_vals -- a sorted array of values
+    targets -- an array of values to look up
+    sides -- 'both','greater_than' (values above the target only) or
+      'less_than' (values below the target only)
+
+    Returns arrays (starts,ends,tie_starts,tie_ends).  For each target,
+    sorted_vals[start:end] is the run of values equal to the nearest value
+    (empty if there is none).  When sides is 'both' and values on either side
+    are equally near, tie_starts:tie_ends gives the smaller run (otherwise
+    it is empty).
+    """
+    if sides not in ('both','greater_than','less_than'):
+        raise ValueError("sides must be 'both','greater_than' or 'less_than', not '%s'"\
+          %sides)
+    
+    n = len(sorted_vals)
+    no_run = zeros(len(targets),dtype=intp)
+    if not n:
+        return no_run,no_run,no_run,no_run
+    
+    first_at_or_above = searchsorted(sorted_vals,targets,side='left')
+    tied = zeros(len(targets),dtype=bool)
+    if sides == 'greater_than':
+        chosen = searchsorted(sorted_vals,targets,side='right')
+        found = chosen < n
+    elif sides == 'less_than':
+        chosen = first_at_or_above - 1
+        found = chosen >= 0
+    else:
+        below = first_at_or_above - 1
+        above = first_at_or_above
+        has_below = below >= 0
+        has_above = above < n
+        below_diff = abs(targets - sorted_vals[below.clip(0,n-1)])
+        above_diff = abs(sorted_vals[above.clip(0,n-1)] - targets)
+        use_above = has_above &\
+          (~has_below | (above_diff <= below_diff).astype(bool))
+        chosen = where(use_above,above,below)
+        found = has_below | has_above
+        tied = has_below & has_above & (above_diff == below_diff).astype(bool)
+    
+    chosen_vals = sorted_vals[chosen.clip(0,n-1)]
+    starts = where(found,searchsorted(sorted_vals,chosen_vals,side='left'),0)
+    ends = where(found,searchsorted(sorted_vals,chosen_vals,side='right'),0)
+    tie_vals = sorted_vals[(first_at_or_above - 1).clip(0,n-1)]
+    tie_starts = where(tied,searchsorted(sorted_vals,tie_vals,side='left'),0)
+    tie_ends = where(tied,searchsorted(sorted_vals,tie_vals,side='right'),0)
+    return starts,ends,tie_starts,tie_ends
+
+def null_mask(values,null_tokens=DEFAULT_NULL_TOKENS):
+    """Return a boolean array that is True where values are null tokens
+
+    values -- an object array of fields
+    null_tokens -- the field values that mean a value is missing
+    """
+    result = zeros(len(values),dtype=bool)
+    for token in null_tokens:
+        result |= (values == token)
+    return result
+
+def parse_numeric_array(values,dtype=float64,not_null=None):
+    """Return (parsed,valid) arrays for a sequence of numeric strings
+
+    values -- a sequence of fields (e.g. ['1.0','Unknown','3'])
+    dtype -- numpy float type for the parsed values
+    not_null -- optional boolean mask of the fields to parse.  Other
+      fields are treated as missing without trying to convert them.
+
+    Fields that are missing or can't be converted by float() are NaN 
+    in parsed and False in valid.
+    """
+    values = object_array(values)
+    parsed = empty(len(values),dtype=dtype)
+    parsed.fill(float('nan'))
+    valid = zeros(len(values),dtype=bool)
+    if not_null is None:
+        to_parse = arange(len(values))
+    else:
+        to_parse = flatnonzero(not_null)
+    try:
+        #Fast path: every field that isn't missing is numeric
+        parsed[to_parse] = values[to_parse].astype(dtype)
+        valid[to_parse] = True
+    except ValueError:
+        for i,field in izip(to_parse.tolist(),values[to_parse].tolist()):
+            try:
+                parsed[i] = float(field)
+                valid[i] = True
+            except (ValueError,TypeError):
+                continue
+    return parsed,valid
+
+def parse_date_array(values,date_formats=DEFAULT_DATE_FORMATS,not_null=None):
+    """Return (dates,valid) arrays for a sequence of date strings
+
+    values -- a sequence of fields (e.g. ['20120817','Unknown'])
+    date_formats -- strptime formats to try, in order
+    not_null -- optional boolean mask of the fields to parse
+
+    dates is a datetime64[D] array, NaT where a field is missing or
+    doesn't match any format.
+    """
+    values = object_array(values)
+    dates = empty(len(values),dtype='datetime64[D]')
+    dates.fill(datetime64('NaT'))
+    valid = zeros(len(values),dtype=bool)
+    if not_null is None:
+        to_parse = arange(len(values))
+    else:
+        to_parse = flatnonzero(not_null)
+    for date_format in date_formats:
+        if not len(to_parse):
+            break
+        if date_format == "%Y%m%d":
+            parsed,parsed_valid = parse_yyyymmdd_array(values[to_parse])
+        else:
+            parsed,parsed_valid = _strptime_array(values[to_parse],date_format)
+        dates[to_parse[parsed_valid]] = parsed[parsed_valid]
+        valid[to_parse[parsed_valid]] = True
+        to_parse = to_parse[~parsed_valid]
+    return dates,valid
+
+def parse_yyyymmdd_array(values):
+    """Return (dates,valid) arrays for concatenated yyyymmdd dates, without strptime"""
+    fields = object_array(values).astype(str)
+    if not len(fields):
+        return empty(0,dtype='datetime64[D]'),zeros(0,dtype=bool)
+    valid = (char.str_len(fields) == 8) & char.isdigit(fields)
+    numbers = where(valid,fields,"19700101").astype(int64)
+    years = numbers//10000
+    months = numbers//100 % 100
+    days = numbers % 100
+    valid &= (months >= 1) & (months <= 12) & (days >= 1)
+    month_starts = (years - 1970).astype('datetime64[Y]').astype('datetime64[M]')\
+      + (months - 1)
+    dates = month_starts.astype('datetime64[D]') + (days - 1)
+    #Days past the end of the month roll into the next one
+    valid &= dates.astype('datetime64[M]') == month_starts
+    dates[~valid] = datetime64('NaT')
+    return dates,valid
+
+def _strptime_array(values,date_format):
+    """Return (dates,valid) arrays parsing each of values with strptime"""
+    dates = empty(len(values),dtype='datetime64[D]')
+    dates.fill(datetime64('NaT'))
+    valid = zeros(len(values),dtype=bool)
+    for i,field in enumerate(values.tolist()):
+        try:
+            dates[i] = datetime.strptime(field,date_format).date()
+        except (ValueError,TypeError):
+            continue
+        valid[i] = True
+    return dates,valid
 
 def average_points_by_x(x,y):
     """Return  sorted x,y with unique values of x, averaging y-values for each x value"""
-    x_to_y_vals = defaultdict(list)
-    for xi,yi in zip(x,y):
-        x_to_y_vals[xi].append(yi)
-    unique_x = list(unique(x))
-    averaged_y = [mean(x_to_y_vals[x]) for x in unique_x]
-    return unique_x,averaged_y
+    unique_x,x_groups = unique(array(x),return_inverse=True)
+    averaged_y = bincount(x_groups,weights=array(y,dtype=float64))/\
+      bincount(x_groups)
+    return list(unique_x),list(averaged_y)
 
 
 def make_criterion_from_text(text):
-    """Returns a criterion function from text.  The function always accepts to values: input and criteria and returns True if input matches critiera
+    """Returns a criterion function from text.  The function accepts a MappingTable and returns a boolean array that is True for rows matching the criteria
     
     Grammar:
     basic equality (basic shortcut):
@@ -416,6 +2346,645 @@ def make_criterion_from_text(text):
     'property = value' #equivalent to 'property:value'
     'property > value' #returns True if property is greater
     'property < value' #return True if property is lower than value
-     
+    
+    Criteria can be combined with 'and' and 'or' ('and' binds more tightly)
+    and grouped with parentheses.  Values containing spaces or operators
+    can be quoted.  Example: 'treatment:Control and (pH > 7.5 or site = "Reef 1")'
+
+    > and < compare numerically, and never match non-numeric fields
+    such as 'Unknown'.  The text is parsed once, so the returned function
+    can be reused cheaply on many tables.
     """
-    pass
+    tokens = tokenize_criterion_text(text)
+    criterion,next_token = _parse_criterion_or(tokens,0)
+    if next_token != len(tokens):
+        raise ValueError("Unexpected '%s' in criterion: %s" %(tokens[next_token][1],text))
+    return criterion
+
+def make_criterion_from_dict(criteria):
+    """Returns a criterion function requiring exact equality for each field in criteria
+    criteria -- a dict of field names and ok values.  Example: {'pH':'7.0','host':'human'}
+    """
+    criteria = [_make_comparison(col,'=',ok_value) for col,ok_value in criteria.items()]
+    def criterion(table):
+        mask = ones(len(table.RowIds),dtype=bool)
+        for comparison in criteria:
+            mask &= comparison(table)
+        return mask
+    return criterion
+
+CRITERION_TOKEN_PATTERN = re.compile(r"""\s*(?:
+    (?P<quoted>"[^"]*"|'[^']*')|
+    (?P<op>[:=<>()])|
+    (?P<word>[^\s:=<>()'"]+))""",re.VERBOSE)
+
+def tokenize_criterion_text(text):
+    """Split criterion text into a list of (token_type,value) tuples
+    
+    token_type is 'op' for one of : = < > ( ), 'keyword' for and/or,
+    or 'word' for property names and values (with any quotes removed)
+    """
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = CRITERION_TOKEN_PATTERN.match(text,pos)
+        if match is None:
+            raise ValueError("Could not parse criterion at '%s' in: %s" %(text[pos:],text))
+        pos = match.end()
+        if match.group('quoted') is not None:
+            tokens.append(('word',match.group('quoted')[1:-1]))
+        elif match.group('op') is not None:
+            tokens.append(('op',match.group('op')))
+        elif match.group('word').lower() in ('and','or'):
+            tokens.append(('keyword',match.group('word').lower()))
+        else:
+            tokens.append(('word',match.group('word')))
+    return tokens
+
+def _parse_criterion_or(tokens,i):
+    """Parse criteria joined by 'or' starting at tokens[i]"""
+    criterion,i = _parse_criterion_and(tokens,i)
+    while i < len(tokens) and tokens[i] == ('keyword','or'):
+        right,i = _parse_criterion_and(tokens,i+1)
+        criterion = _combine_criteria(criterion,right,'or')
+    return criterion,i
+
+def _parse_criterion_and(tokens,i):
+    """Parse criteria joined by 'and' starting at tokens[i]"""
+    criterion,i = _parse_criterion_atom(tokens,i)
+    while i < len(tokens) and tokens[i] == ('keyword','and'):
+        right,i = _parse_criterion_atom(tokens,i+1)
+        criterion = _combine_criteria(criterion,right,'and')
+    return criterion,i
+
+def _parse_criterion_atom(tokens,i):
+    """Parse a parenthesized criterion or a single comparison at tokens[i]"""
+    if i < len(tokens) and tokens[i] == ('op','('):
+        criterion,i = _parse_criterion_or(tokens,i+1)
+        if i >= len(tokens) or tokens[i] != ('op',')'):
+            raise ValueError("Missing ')' in criterion")
+        return criterion,i+1
+    
+    if i+2 >= len(tokens):
+        raise ValueError("Incomplete criterion: %s"\
+          %" ".join(value for token_type,value in tokens[i:]))
+    prop,op,value = tokens[i:i+3]
+    if prop[0] != 'word' or value[0] != 'word' or\
+      op[0] != 'op' or op[1] not in (':','=','<','>'):
+        raise ValueError("Criteria must have the form 'property:value', 'property = value', 'property > value' or 'property < value', not: %s"\
+          %" ".join(v for t,v in tokens[i:i+3]))
+    return _make_comparison(prop[1],op[1],value[1]),i+3
+
+def _make_comparison(prop,op,value):
+    """Return a criterion function comparing column prop to value"""
+    if op in (':','='):
+        def criterion(table):
+            mask = zeros(len(table.RowIds),dtype=bool)
+            mask[table.rowIndicesWithValue(prop,value)] = True
+            return mask
+        return criterion
+    
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError("'%s %s %s': %s comparisons need a numeric value"\
+          %(prop,op,value,op))
+    def criterion(table):
+        values,valid = table.getNumericCol(prop)
+        #NaN (non-numeric) fields compare False
+        with errstate(invalid='ignore'):
+            if op == '>':
+                return valid & (values > number)
+            return valid & (values < number)
+    return criterion
+
+def _combine_criteria(left,right,how):
+    """Return a criterion function combining two criteria with 'and' or 'or'"""
+    if how == 'and':
+        return lambda table: left(table) & right(table)
+    return lambda table: left(table) | right(table)
+
+#Keywords and functions of derived column expressions (see make_expression_from_text)
+EXPRESSION_KEYWORDS = ('and','or','not','if','then','elif','else','between')
+EXPRESSION_FUNCTIONS = ('date','number','text','known','abs','round')
+
+def make_expression_from_text(text,date_formats=DEFAULT_DATE_FORMATS):
+    """Returns an expression function from text.  The function accepts a MappingTable and returns a (values,valid) pair of arrays giving the value of the expression in each row
+
+    Grammar:
+    numbers (7, 2.5), quoted text ("Reef 1"), and columns (pH, or
+      [Column name] for names with spaces or operators.  Write ] in a
+      bracketed name as ]], e.g. [Dose [mg]]] for 'Dose [mg]')
+    'a + b', 'a - b', 'a * b', 'a / b' #arithmetic.  + also joins text,
+      date - date gives days, and date + number adds whole days
+    'a = b', 'a != b', 'a < b', 'a <= b', 'a > b', 'a >= b' #comparisons
+    'a between low and high' #True if low <= a <= high
+    'and', 'or', 'not' #combine conditions
+    'if condition then a elif condition then b else c' #conditional values
+    date(x), number(x), text(x) #x read as a date (in one of
+      date_formats), a number or text
+    known(x) #True unless x is missing
+    abs(x), round(x) #round() rounds halves away from zero
+
+    Example: 'if date(SampleDate) < date(StartDate) then Treatment+"_pre"
+      elif date(SampleDate) <= date(EndDate) then Treatment 
+      else Treatment+"_post"'
+
+    Columns are read as numbers in arithmetic and in comparisons with
+    numbers or other columns (except = and !=), as dates alongside a date,
+    and as text otherwise.  Columns given as the result of a conditional
+    are read like its other results.  Rows where a value the expression uses is
+    missing (see MappingTable.getValidMask) or can't be read have no 
+    result, and are False in valid.
+
+    values is a numeric array for numbers, datetime64[D] for dates, bool
+    for conditions, and a CategoricalColumn for text.  Text is handled 
+    as dictionary codes, so each distinct value is formatted, joined or
+    compared once.  The text is parsed once, so the returned function 
+    can be reused cheaply on many tables.
+    """
+    tokens = tokenize_expression_text(text)
+    node,next_token = _parse_expression(tokens,0)
+    if next_token != len(tokens):
+        raise ValueError("Unexpected '%s' in expression: %s" %(tokens[next_token][1],text))
+    def expression(table):
+        return _expression_result(table,node(table,date_formats))
+    return expression
+
+EXPRESSION_TOKEN_PATTERN = re.compile(r"""\s*(?:
+    (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)|
+    (?P<quoted>"[^"]*"|'[^']*')|
+    (?P<column>\[(?:[^\]]|\]\])*\])|
+    (?P<op><=|>=|!=|==|[-+*/<>=(),])|
+    (?P<word>[A-Za-z_][\w.]*))""",re.VERBOSE)
+
+def tokenize_expression_text(text):
+    """Split expression text into a list of (token_type,value) tuples
+
+    token_type is 'number', 'text' for quoted text (quotes removed),
+    'column', 'op', 'keyword' (see EXPRESSION_KEYWORDS) or 'function'
+    (see EXPRESSION_FUNCTIONS, when followed by '(')
+    """
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = EXPRESSION_TOKEN_PATTERN.match(text,pos)
+        if match is None:
+            raise ValueError("Could not parse expression at '%s' in: %s" %(text[pos:],text))
+        pos = match.end()
+        if match.group('number') is not None:
+            tokens.append(('number',match.group('number')))
+        elif match.group('quoted') is not None:
+            tokens.append(('text',match.group('quoted')[1:-1]))
+        elif match.group('column') is not None:
+            tokens.append(('column',match.group('column')[1:-1].replace("]]","]")))
+        elif match.group('op') is not None:
+            tokens.append(('op',match.group('op')))
+        elif match.group('word').lower() in EXPRESSION_KEYWORDS:
+            tokens.append(('keyword',match.group('word').lower()))
+        elif match.group('word').lower() in EXPRESSION_FUNCTIONS and\
+          text[pos:].lstrip().startswith('('):
+            tokens.append(('function',match.group('word').lower()))
+        else:
+            tokens.append(('column',match.group('word')))
+    return tokens
+
+def quote_expression_column(col_id):
+    """Return col_id as a bracketed column name for expression text"""
+    return "[%s]" %col_id.replace("]","]]")
+
+def _expect_token(tokens,i,token):
+    """Return i+1 if tokens[i] is token, else raise a ValueError"""
+    if i >= len(tokens) or tokens[i] != token:
+        found = "'%s'" %tokens[i][1] if i < len(tokens) else "the end"
+        raise ValueError("Expected '%s' but found %s in expression" %(token[1],found))
+    return i+1
+
+def _parse_expression(tokens,i):
+    """Parse a conditional or an expression joined by 'or' starting at tokens[i]"""
+    if i >= len(tokens) or tokens[i] != ('keyword','if'):
+        return _parse_expression_or(tokens,i)
+    branches = []
+    while i < len(tokens) and tokens[i] in (('keyword','if'),('keyword','elif')):
+        condition,i = _parse_expression_or(tokens,i+1)
+        i = _expect_token(tokens,i,('keyword','then'))
+        value,i = _parse_expression(tokens,i)
+        branches.append((condition,value))
+    i = _expect_token(tokens,i,('keyword','else'))
+    default,i = _parse_expression(tokens,i)
+    return _expression_conditional(branches,default),i
+
+def _parse_expression_or(tokens,i):
+    """Parse conditions joined by 'or' starting at tokens[i]"""
+    node,i = _parse_expression_and(tokens,i)
+    while i < len(tokens) and tokens[i] == ('keyword','or'):
+        right,i = _parse_expression_and(tokens,i+1)
+        node = _expression_logic(node,right,'or')
+    return node,i
+
+def _parse_expression_and(tokens,i):
+    """Parse conditions joined by 'and' starting at tokens[i]"""
+    node,i = _parse_expression_not(tokens,i)
+    while i < len(tokens) and tokens[i] == ('keyword','and'):
+        right,i = _parse_expression_not(tokens,i+1)
+        node = _expression_logic(node,right,'and')
+    return node,i
+
+def _parse_expression_not(tokens,i):
+    """Parse a comparison, possibly negated with 'not', starting at tokens[i]"""
+    if i < len(tokens) and tokens[i] == ('keyword','not'):
+        node,i = _parse_expression_not(tokens,i+1)
+        return _expression_not(node),i
+    node,i = _parse_expression_sum(tokens,i)
+    if i < len(tokens) and tokens[i][0] == 'op' and\
+      tokens[i][1] in ('=','==','!=','<','<=','>','>='):
+        right,next_token = _parse_expression_sum(tokens,i+1)
+        return _expression_comparison(node,tokens[i][1],right),next_token
+    if i < len(tokens) and tokens[i] == ('keyword','between'):
+        low,i = _parse_expression_sum(tokens,i+1)
+        i = _expect_token(tokens,i,('keyword','and'))
+        high,i = _parse_expression_sum(tokens,i)
+        return _expression_between(node,low,high),i
+    return node,i
+
+def _parse_expression_sum(tokens,i):
+    """Parse terms joined by + or - starting at tokens[i]"""
+    node,i = _parse_expression_product(tokens,i)
+    while i < len(tokens) and tokens[i] in (('op','+'),('op','-')):
+        right,next_token = _parse_expression_product(tokens,i+1)
+        node,i = _expression_arithmetic(node,tokens[i][1],right),next_token
+    return node,i
+
+def _parse_expression_product(tokens,i):
+    """Parse values joined by * or / starting at tokens[i]"""
+    node,i = _parse_expression_atom(tokens,i)
+    while i < len(tokens) and tokens[i] in (('op','*'),('op','/')):
+        right,next_token = _parse_expression_atom(tokens,i+1)
+        node,i = _expression_arithmetic(node,tokens[i][1],right),next_token
+    return node,i
+
+def _parse_expression_atom(tokens,i):
+    """Parse a value, function call, negation or parenthesized expression at tokens[i]"""
+    if i >= len(tokens):
+        raise ValueError("Incomplete expression")
+    token_type,value = tokens[i]
+    if token_type == 'number':
+        if value.isdigit():
+            return _expression_constant(int64(value)),i+1
+        return _expression_constant(float64(value)),i+1
+    if token_type == 'text':
+        return _expression_constant(value),i+1
+    if token_type == 'column':
+        return _expression_column(value),i+1
+    if token_type == 'function':
+        i = _expect_token(tokens,i+1,('op','('))
+        argument,i = _parse_expression(tokens,i)
+        i = _expect_token(tokens,i,('op',')'))
+        return _expression_function(value,argument),i
+    if tokens[i] == ('op','-'):
+        node,i = _parse_expression_atom(tokens,i+1)
+        return _expression_arithmetic(_expression_constant(int64(0)),'-',node),i
+    if tokens[i] == ('op','('):
+        node,i = _parse_expression(tokens,i+1)
+        return node,_expect_token(tokens,i,('op',')'))
+    raise ValueError("Unexpected '%s' in expression" %value)
+
+#Expression nodes are functions of (table,date_formats) returning a
+#(values,valid) pair.  Columns are returned as (col_id,None), and are
+#read as a number, date or text by the operation using them.
+
+def _expression_constant(constant):
+    """Return an expression node giving constant in every row"""
+    def node(table,date_formats):
+        n_rows = len(table.RowIds)
+        if isinstance(constant,basestring):
+            values = CategoricalColumn(object_array([constant]),zeros(n_rows,dtype=intp))
+        else:
+            values = empty(n_rows,dtype=type(constant))
+            values.fill(constant)
+        return values,ones(n_rows,dtype=bool)
+    return node
+
+def _expression_column(col_id):
+    """Return an expression node for column col_id"""
+    def node(table,date_formats):
+        table._colIndex(col_id)
+        return col_id,None
+    return node
+
+def _expression_function(name,argument):
+    """Return an expression node calling function name on argument"""
+    def node(table,date_formats):
+        value = argument(table,date_formats)
+        if name == 'date':
+            return _expression_dates(table,value,date_formats)
+        if name == 'text':
+            return _expression_text(table,value)
+        if name == 'known':
+            valid = _expression_result(table,value)[1]
+            return valid.copy(),ones(len(valid),dtype=bool)
+        values,valid = _expression_numbers(table,value)
+        if name == 'abs':
+            return abs(values),valid
+        if name == 'round':
+            #Round halves away from zero, as round() does
+            values = where(valid,values,0)
+            return where(values < 0,-(0.5-values).astype(int64),\
+              (values+0.5).astype(int64)),valid
+        return values,valid
+    return node
+
+def _expression_arithmetic(left,op,right):
+    """Return an expression node for left op right, where op is + - * or /"""
+    def node(table,date_formats):
+        a = left(table,date_formats)
+        b = right(table,date_formats)
+        kinds = (_expression_kind(*a),_expression_kind(*b))
+        if op == '+' and 'text' in kinds:
+            return _join_texts(_expression_text(table,a),_expression_text(table,b))
+        if op in ('+','-') and 'date' in kinds:
+            return _date_arithmetic(table,a,op,b,kinds,date_formats)
+        a_values,a_valid = _expression_numbers(table,a)
+        b_values,b_valid = _expression_numbers(table,b)
+        valid = a_valid & b_valid
+        with errstate(invalid='ignore',divide='ignore'):
+            if op == '+':
+                values = a_values + b_values
+            elif op == '-':
+                values = a_values - b_values
+            elif op == '*':
+                values = a_values * b_values
+            else:
+                values = a_values.astype(float64) / b_values
+                valid &= isfinite(values)
+        return values,valid
+    return node
+
+def _date_arithmetic(table,a,op,b,kinds,date_formats):
+    """Return date - date in days, or a date plus or minus a number of days"""
+    if op == '-' and kinds[1] != 'number':
+        a_dates,a_valid = _expression_dates(table,a,date_formats)
+        b_dates,b_valid = _expression_dates(table,b,date_formats)
+        valid = a_valid & b_valid
+        days = (a_dates - b_dates).astype(int64)
+        days[~valid] = 0
+        return days,valid
+    if kinds[0] != 'date':
+        if op == '-':
+            raise ValueError("Dates can't be subtracted from numbers in expressions")
+        a,b = b,a
+    dates,dates_valid = _expression_dates(table,a,date_formats)
+    days,days_valid = _expression_numbers(table,b)
+    valid = dates_valid & days_valid
+    offsets = where(valid,days,0).astype(int64).astype('timedelta64[D]')
+    if op == '-':
+        offsets = -offsets
+    return dates + offsets,valid
+
+def _expression_comparison(left,op,right):
+    """Return an expression node comparing left and right with op"""
+    def node(table,date_formats):
+        return _compare_expression_values(table,left(table,date_formats),op,\
+          right(table,date_formats),date_formats)
+    return node
+
+def _expression_between(node,low,high):
+    """Return an expression node that is True where low <= node <= high"""
+    def between(table,date_formats):
+        value = node(table,date_formats)
+        above,above_valid = _compare_expression_values(table,value,'>=',\
+          low(table,date_formats),date_formats)
+        below,below_valid = _compare_expression_values(table,value,'<=',\
+          high(table,date_formats),date_formats)
+        return above & below,above_valid & below_valid
+    return between
+
+def _compare_expression_values(table,a,op,b,date_formats):
+    """Return (result,valid) of comparing two (values,valid) pairs with op"""
+    kinds = (_expression_kind(*a),_expression_kind(*b))
+    if 'date' in kinds:
+        a = _expression_dates(table,a,date_formats)
+        b = _expression_dates(table,b,date_formats)
+    elif 'number' in kinds or (kinds == ('column','column') and op not in ('=','==','!=')):
+        a = _expression_numbers(table,a)
+        b = _expression_numbers(table,b)
+    elif 'bool' in kinds:
+        a = _expression_condition(a)
+        b = _expression_condition(b)
+    else:
+        #Text is compared by its codes in a shared sorted pool
+        (a_text,a_valid),(b_text,b_valid) = _expression_text(table,a),\
+          _expression_text(table,b)
+        pool,(a_codes,b_codes) = _shared_text_codes([a_text,b_text])
+        a,b = (a_codes,a_valid),(b_codes,b_valid)
+    (a_values,a_valid),(b_values,b_valid) = a,b
+    with errstate(invalid='ignore'):
+        if op in ('=','=='):
+            result = a_values == b_values
+        elif op == '!=':
+            result = a_values != b_values
+        elif op == '<':
+            result = a_values < b_values
+        elif op == '<=':
+            result = a_values <= b_values
+        elif op == '>':
+            result = a_values > b_values
+        else:
+            result = a_values >= b_values
+    valid = a_valid & b_valid
+    return result & valid,valid
+
+def _expression_logic(left,right,how):
+    """Return an expression node combining two conditions with 'and' or 'or'"""
+    def node(table,date_formats):
+        a_values,a_valid = _expression_condition(left(table,date_formats))
+        b_values,b_valid = _expression_condition(right(table,date_formats))
+        if how == 'and':
+            return a_values & b_values,a_valid & b_valid
+        return a_values | b_values,a_valid & b_valid
+    return node
+
+def _expression_not(condition):
+    """Return an expression node negating a condition"""
+    def node(table,date_formats):
+        values,valid = _expression_condition(condition(table,date_formats))
+        return ~values & valid,valid
+    return node
+
+def _expression_conditional(branches,default):
+    """Return an expression node for if/elif/else
+
+    branches -- list of (condition,value) nodes, tried in order
+    default -- the value node for rows matching no condition
+
+    Rows where a condition is unknown (e.g. a missing date) before an
+    earlier one matched have no result.
+    """
+    def node(table,date_formats):
+        n_rows = len(table.RowIds)
+        chosen = empty(n_rows,dtype=intp)
+        chosen.fill(len(branches))
+        undecided = ones(n_rows,dtype=bool)
+        decided_valid = ones(n_rows,dtype=bool)
+        for k,(condition,value) in enumerate(branches):
+            matches,valid = _expression_condition(condition(table,date_formats))
+            decided_valid &= valid | ~undecided
+            chosen[undecided & matches] = k
+            undecided &= ~matches
+        results = [value(table,date_formats) for condition,value in branches]+\
+          [default(table,date_formats)]
+        kinds = set(_expression_kind(*result) for result in results) - set(['column'])
+        pool = None
+        if len(kinds) == 1 and 'text' not in kinds:
+            kind = kinds.pop()
+            if kind == 'number':
+                results = [_expression_numbers(table,result) for result in results]
+            elif kind == 'date':
+                results = [_expression_dates(table,result,date_formats) for result in results]
+            else:
+                results = [_expression_condition(result) for result in results]
+        else:
+            #Mixed kinds (or only columns) give text
+            texts = [_expression_text(table,result) for result in results]
+            pool,codes = _shared_text_codes([values for values,valid in texts])
+            results = [(result_codes,valid) for result_codes,(values,valid) in\
+              zip(codes,texts)]
+        values = results[-1][0].astype(result_type(*[values for values,valid in results]))
+        valid = results[-1][1] & decided_valid
+        for k,(branch_values,branch_valid) in enumerate(results[:-1]):
+            rows = chosen == k
+            values[rows] = branch_values[rows]
+            valid[rows] = branch_valid[rows] & decided_valid[rows]
+        if pool is not None:
+            values = CategoricalColumn(pool,values)
+        return values,valid
+    return node
+
+def _expression_kind(values,valid):
+    """Return 'column', 'text', 'date', 'bool' or 'number' for a (values,valid) pair"""
+    if valid is None:
+        return 'column'
+    if isinstance(values,CategoricalColumn):
+        return 'text'
+    return {'M':'date','b':'bool'}.get(values.dtype.kind,'number')
+
+def _expression_numbers(table,value):
+    """Return a (values,valid) pair read as numbers"""
+    kind = _expression_kind(*value)
+    if kind == 'column':
+        return table.getNumericCol(value[0])
+    if kind == 'text':
+        text,valid = value
+        not_null = ~null_mask(text.Pool,table.NullTokens)
+        numbers,numbers_valid = parse_numeric_array(text.Pool,float64,not_null)
+        return numbers[text.Codes],numbers_valid[text.Codes] & valid
+    if kind != 'number':
+        raise ValueError("Expected a number in expression, not a %s" %kind)
+    return value
+
+def _expression_dates(table,value,date_formats):
+    """Return a (values,valid) pair read as datetime64[D] dates"""
+    kind = _expression_kind(*value)
+    if kind == 'column':
+        return table.getDateCol(value[0],date_formats)
+    if kind == 'text':
+        text,valid = value
+        not_null = ~null_mask(text.Pool,table.NullTokens)
+        dates,dates_valid = parse_date_array(text.Pool,date_formats,not_null)
+        return dates[text.Codes],dates_valid[text.Codes] & valid
+    if kind != 'date':
+        raise ValueError("Expected a date in expression, not a %s" %kind)
+    return value
+
+def _expression_condition(value):
+    """Return a (values,valid) pair, which must be a condition"""
+    kind = _expression_kind(*value)
+    if kind != 'bool':
+        raise ValueError("Expected a condition (e.g. a comparison) in expression, not a %s" %kind)
+    return value
+
+def _expression_text(table,value):
+    """Return a (values,valid) pair as a CategoricalColumn of text
+
+    Numbers with an integer type are written as integers, other numbers
+    as str(float), dates as yyyymmdd and conditions as True or False.
+    Each distinct value is formatted once.
+    """
+    kind = _expression_kind(*value)
+    if kind == 'column':
+        return CategoricalColumn(*table.getCategoricalCol(value[0])),\
+          table.getValidMask(value[0])
+    if kind == 'text':
+        return value
+    values,valid = value
+    codes = zeros(len(valid),dtype=intp)
+    if not valid.any():
+        return CategoricalColumn(object_array([""]),codes),valid
+    distinct,distinct_codes = unique(values[valid],return_inverse=True)
+    if kind == 'date':
+        texts = char.replace(distinct.astype(str),'-','').tolist()
+    elif kind == 'bool':
+        texts = [str(v) for v in distinct.tolist()]
+    elif distinct.dtype.kind in 'iu':
+        texts = ["%i" %v for v in distinct.tolist()]
+    else:
+        texts = [str(float(v)) for v in distinct.tolist()]
+    pool,pool_codes = unique(array(texts),return_inverse=True)
+    codes[valid] = pool_codes[distinct_codes]
+    return CategoricalColumn(object_array(pool.tolist()),codes),valid
+
+def _shared_text_codes(texts):
+    """Return (pool,list of codes) giving texts as codes into one sorted pool
+
+    texts -- a list of CategoricalColumns
+    """
+    pool,pool_codes = unique(concatenate([text.Pool for text in texts]),\
+      return_inverse=True)
+    codes = []
+    start = 0
+    for text in texts:
+        codes.append(pool_codes[start:start+len(text.Pool)][text.Codes])
+        start += len(text.Pool)
+    return pool,codes
+
+def _used_codes(codes,n_values):
+    """Return (used,new codes): the sorted values in codes and codes into them"""
+    if n_values <= 4*len(codes):
+        #Small ranges are counted rather than sorted
+        present = bincount(codes,minlength=n_values) > 0
+        return flatnonzero(present),(cumsum(present)-1)[codes]
+    return unique(codes,return_inverse=True)
+
+def _join_texts(a,b):
+    """Return a (values,valid) pair joining two text values row by row"""
+    (a_text,a_valid),(b_text,b_valid) = a,b
+    n_b = len(b_text.Pool)
+    pairs,pair_codes = _used_codes(a_text.Codes.astype(int64)*n_b + b_text.Codes,\
+      len(a_text.Pool)*n_b)
+    texts = [a_text.Pool[pair//n_b]+b_text.Pool[pair%n_b] for pair in pairs.tolist()]
+    pool,pool_codes = dictionary_encode(texts)
+    return CategoricalColumn(pool,pool_codes[pair_codes]),a_valid & b_valid
+
+def _expression_result(table,value):
+    """Return the (values,valid) pair of a finished expression, reading columns as text"""
+    if _expression_kind(*value) == 'column':
+        return _expression_text(table,value)
+    return value
+
+def _expression_stored_column(table,value,fill_value):
+    """Return a stored column of the text of an expression value, or fill_value where invalid"""
+    values,valid = value
+    if _expression_kind(*value) == 'number' and values.dtype.kind in 'iu':
+        return _int_strings(values,valid,missing=fill_value)
+    text,valid = _expression_text(table,value)
+    used,codes = _used_codes(text.Codes[valid],len(text.Pool))
+    #Sort the pool, with fill_value as the last distinct value
+    pool,pool_order = dictionary_encode(text.Pool[used].tolist()+[fill_value])
+    stored_codes = empty(len(valid),dtype=intp)
+    stored_codes.fill(pool_order[-1])
+    stored_codes[valid] = pool_order[codes]
+    if len(pool) > CATEGORICAL_MAX_FRACTION*len(stored_codes):
+        return pool.take(stored_codes)
+    return CategoricalColumn(pool,stored_codes.astype(min_scalar_type(len(pool)-1)))
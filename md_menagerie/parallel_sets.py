@@ -107,14 +107,11 @@ def get_top_level_sets_from_mapping(mapping_table,categories):
 
     top_level_sets = {}
     for category in categories:
-        curr_sets = defaultdict(set)
-        col_data = mapping_table.iterCols(col_names = [category])
-        for col_id,fields in col_data:
-            row_ids_by_field = zip(mapping_table.RowIds,fields)
-            for row_id,label in row_ids_by_field:
-                curr_sets[label].add(row_id)
+        curr_sets = {}
+        for label,row_indices in mapping_table.valueGroups(category).iteritems():
+            curr_sets[label] = set(mapping_table.RowIds[i] for i in row_indices)
         
-        top_level_sets[category] = dict(curr_sets)
+        top_level_sets[category] = curr_sets
         
     
     
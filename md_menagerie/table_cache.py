@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+from __future__ import division
+from warnings import warn
+
+__author__ = "Jesse Zaneveld"
+__copyright__ = "Copyright 2014, The MetadataMenagerie Project"
+__credits__ = ["Jesse RR Zaneveld"]
+__license__ = "GPL"
+__version__ = "0.1dev"
+__maintainer__ = "Jesse Zaneveld"
+__email__ = "zaneveld@gmail.com"
+__status__ = "Development"
+
+"""
+Binary caches of parsed mapping tables, so large mapping files that are
+loaded again and again are only parsed when they change.
+
+A cache file holds a small pickled description of the table (header,
+comment lines, the fingerprint of the source file) followed by one
+section per column.  Each section is the column's fields joined by
+newlines plus an int64 array of where each field starts.  Cache files
+are memory mapped when read, and each column is only decoded when the
+table first uses it.
+"""
+
+import os
+import mmap
+import struct
+from hashlib import sha1
+from cPickle import dumps,loads,HIGHEST_PROTOCOL
+from tempfile import mkstemp
+from numpy import frombuffer,zeros,int64,fromiter,cumsum
+from md_menagerie.mapping import MappingTable,object_array,DEFAULT_NULL_TOKENS
+
+CACHE_MAGIC = "MDMTBL01"
+CACHE_SUFFIX = ".mdcache"
+
+def load_mapping_table(path,cache_dir=None,max_cache_bytes=None,\
+    check_content=False,field_delimiter="\t",comment_prefix="#",\
+    null_tokens=DEFAULT_NULL_TOKENS):
+    """Return a MappingTable for the mapping file at path, using a binary cache
+
+    path -- path to a QIIME mapping file
+    cache_dir -- directory to store cache files in.  If None, the cache
+      is a hidden sidecar file next to path.
+    max_cache_bytes -- if set, delete the least recently used cache files
+      in the cache's directory until they total no more than this
+    check_content -- if True, only use the cache if the file's SHA-1
+      matches.  Otherwise the file's size and modification time must match.
+    null_tokens -- field values that mean a value is missing
+
+    The cache is rebuilt whenever the source file has changed.  If the
+    cache can't be written (e.g. a read-only directory), a warning is
+    given and the parsed table is returned anyway.  A cache that can be
+    read but not touched is used as is.
+    """
+    cache_path = cache_path_for(path,cache_dir)
+    fingerprint = file_fingerprint(path,content_hash=check_content)
+    table = read_table_cache(cache_path,fingerprint,field_delimiter,\
+      comment_prefix,null_tokens)
+    if table is not None:
+        #Mark the cache as recently used for eviction.  A read-only
+        #cache is still usable, it just looks older to evict_cache_files
+        try:
+            os.utime(cache_path,None)
+        except (IOError,OSError):
+            pass
+        return table
+
+    infile = open(path,"U")
+    table = MappingTable(infile.readlines(),field_delimiter=field_delimiter,\
+      comment_prefix=comment_prefix,null_tokens=null_tokens)
+    infile.close()
+
+    try:
+        write_table_cache(table,cache_path,file_fingerprint(path,content_hash=True))
+    except (IOError,OSError) as e:
+        warn("Could not write mapping table cache %s: %s" %(cache_path,e))
+        return table
+
+    if max_cache_bytes is not None:
+        evict_cache_files(os.path.dirname(cache_path),max_cache_bytes,keep=[cache_path])
+    return table
+
+def cache_path_for(path,cache_dir=None):
+    """Return the path of the cache file for the mapping file at path"""
+    path = os.path.abspath(path)
+    if cache_dir is None:
+        source_dir,source_name = os.path.split(path)
+        return os.path.join(source_dir,".%s%s" %(source_name,CACHE_SUFFIX))
+    return os.path.join(cache_dir,sha1(path).hexdigest()+CACHE_SUFFIX)
+
+def file_fingerprint(path,content_hash=False):
+    """Return a dict identifying the current contents of the file at path
+
+    content_hash -- if True, include the SHA-1 of the file's contents
+    """
+    stats = os.stat(path)
+    result = {'path':os.path.abspath(path),'size':stats.st_size,\
+      'mtime':stats.st_mtime}
+    if content_hash:
+        digest = sha1()
+        infile = open(path,"rb")
+        for block in iter(lambda: infile.read(1<<20),""):
+            digest.update(block)
+        infile.close()
+        result['sha1'] = digest.hexdigest()
+    return result
+
+def fingerprint_matches(cached,current):
+    """Return True if a cached fingerprint agrees with every field of current"""
+    return all(cached.get(key) == value for key,value in current.iteritems())
+
+def write_table_cache(table,cache_path,fingerprint):
+    """Write a binary cache of table to cache_path
+
+    fingerprint -- the file_fingerprint of the table's source file
+
+    The cache is written to a temporary file and renamed into place, so
+    a partly written cache is never read.
+    """
+    n_rows = len(table.RowIds)
+    sections = []
+    blocks = []
+    data_size = 0
+    for values in [table.RowIds]+[table.getCol(col) for col in table.ColIds]:
+        values = list(values)
+        text = "\n".join(values)
+        #Field i is text[offsets[i]:offsets[i+1]-1]
+        offsets = zeros(n_rows+1,dtype=int64)
+        offsets[1:] = cumsum(fromiter((len(v)+1 for v in values),int64,n_rows))
+        text_start = data_size
+        data_size = _aligned(data_size+len(text))
+        offsets_start = data_size
+        data_size += offsets.nbytes
+        sections.append((text_start,len(text),offsets_start))
+        blocks.append((text,offsets))
+
+    meta = dumps({'fingerprint':fingerprint,'header_fields':table.HeaderFields,\
+      'comment_lines':table.OtherCommentLines,'n_rows':n_rows,\
+      'field_delimiter':table.FieldDelimiter,'comment_prefix':table.CommentPrefix,\
+      'sections':sections},HIGHEST_PROTOCOL)
+    preamble = CACHE_MAGIC+struct.pack("<Q",len(meta))+meta
+
+    cache_dir,cache_name = os.path.split(os.path.abspath(cache_path))
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fd,temp_path = mkstemp(prefix=".%s." %cache_name,suffix=".tmp",dir=cache_dir)
+    try:
+        with os.fdopen(fd,"wb") as outfile:
+            outfile.write(_padded(preamble))
+            for text,offsets in blocks:
+                outfile.write(_padded(text))
+                outfile.write(offsets.tostring())
+        os.rename(temp_path,cache_path)
+    except:
+        os.remove(temp_path)
+        raise
+
+def read_table_cache(cache_path,fingerprint,field_delimiter="\t",\
+    comment_prefix="#",null_tokens=DEFAULT_NULL_TOKENS):
+    """Return a MappingTable from the cache at cache_path, or None
+
+    None is returned if there is no readable cache, or if the cache
+    was made from a file that doesn't match fingerprint, or with a
+    different delimiter or comment prefix.
+    """
+    try:
+        infile = open(cache_path,"rb")
+    except IOError:
+        return None
+    try:
+        cache_map = mmap.mmap(infile.fileno(),0,access=mmap.ACCESS_READ)
+    except (mmap.error,ValueError):
+        #e.g. an empty file
+        return None
+    finally:
+        infile.close()
+
+    if cache_map[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+        return None
+    meta_start = len(CACHE_MAGIC)+8
+    meta_len = struct.unpack("<Q",cache_map[len(CACHE_MAGIC):meta_start])[0]
+    meta = loads(cache_map[meta_start:meta_start+meta_len])
+    if not fingerprint_matches(meta['fingerprint'],fingerprint) or\
+      meta['field_delimiter'] != field_delimiter or\
+      meta['comment_prefix'] != comment_prefix:
+        return None
+
+    source = CachedColumnSource(cache_map,_aligned(meta_start+meta_len),\
+      meta['sections'],meta['n_rows'])
+    table = MappingTable()
+    table.loadTableFromColumnSource(meta['header_fields'],source.column(-1),\
+      source,meta['comment_lines'],field_delimiter,comment_prefix,null_tokens)
+    return table
+
+def evict_cache_files(cache_dir,max_cache_bytes,keep=()):
+    """Delete least recently used cache files in cache_dir beyond max_cache_bytes
+
+    keep -- paths of cache files that must not be deleted
+    """
+    keep = set(os.path.abspath(p) for p in keep)
+    cache_files = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(CACHE_SUFFIX):
+            continue
+        path = os.path.abspath(os.path.join(cache_dir,name))
+        stats = os.stat(path)
+        cache_files.append((stats.st_mtime,stats.st_size,path))
+
+    total = sum(size for mtime,size,path in cache_files)
+    for mtime,size,path in sorted(cache_files):
+        if total <= max_cache_bytes:
+            break
+        if path in keep:
+            continue
+        os.remove(path)
+        total -= size
+
+class CachedColumnSource(object):
+    """Read columns or rows of a table from a memory mapped cache file"""
+
+    def __init__(self,cache_map,data_start,sections,n_rows):
+        """Index the column sections of a cache
+
+        sections -- (text start,text length,offsets start) for the row
+        ids, then for each column, relative to data_start
+        """
+        self.CacheMap = cache_map
+        self.DataStart = data_start
+        self.Sections = sections[1:]
+        self.RowIdSection = sections[0]
+        self.NRows = n_rows
+
+    def column(self,col_idx):
+        """Return an object array of the fields of column col_idx
+
+        col_idx -- the column index, or -1 for the row ids
+        """
+        text_start,text_len,offsets_start = self._section(col_idx)
+        if not self.NRows:
+            return object_array([])
+        start = self.DataStart+text_start
+        return object_array(self.CacheMap[start:start+text_len].split("\n"))
+
+    def row(self,row_idx):
+        """Return the list of fields in the row at row_idx"""
+        return [self._field(col_idx,row_idx) for col_idx in range(len(self.Sections))]
+
+    def _section(self,col_idx):
+        """Return the section describing column col_idx (-1 for row ids)"""
+        if col_idx == -1:
+            return self.RowIdSection
+        return self.Sections[col_idx]
+
+    def _field(self,col_idx,row_idx):
+        """Return a single field without decoding the rest of its column"""
+        text_start,text_len,offsets_start = self._section(col_idx)
+        offsets = frombuffer(self.CacheMap,dtype=int64,count=2,\
+          offset=self.DataStart+offsets_start+8*row_idx)
+        start = self.DataStart+text_start
+        return self.CacheMap[start+offsets[0]:start+offsets[1]-1]
+
+def _aligned(n_bytes,alignment=8):
+    """Round n_bytes up to a multiple of alignment"""
+    return -(-n_bytes//alignment)*alignment
+
+def _padded(data,alignment=8):
+    """Pad data with null bytes to a multiple of alignment"""
+    return data+"\0"*(_aligned(len(data),alignment)-len(data))
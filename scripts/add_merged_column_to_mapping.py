@@ -128,8 +128,8 @@ def add_merged_column_to_mapping(mapping_file_lines,cols_to_merge,merged_col_del
             continue
         elif line_type == 'header':
             header_columns=map(strip,line.lstrip('#').split(delimiter))
-            #col_indices_to_merge=\
-            #  [i for i,col in enumerate(header_columns) if col in cols_to_merge]
+            #In the order of cols_to_merge, not of the header
+            col_indices_to_merge = [header_columns.index(col) for col in cols_to_merge]
             new_header_entries =\
                [merged_col_delim.join(cols_to_merge)]
             yield fields_to_line(header_columns+new_header_entries,delimiter=delimiter,comment_marker="#")
@@ -137,14 +137,8 @@ def add_merged_column_to_mapping(mapping_file_lines,cols_to_merge,merged_col_del
             yield line #other comment line, keep it intact
         elif line_type == 'data':
             old_data_fields = map(strip,line.strip().split("\t"))
-            #new_data =\
-            #     merged_col_delim.join([d for i,d in enumerate(old_data_fields) if i in col_indices_to_merge])
-            #BAD!!!! the above  reorders columns
-            new_data = []
-            for col in cols_to_merge:
-                col_index = header_columns.index(col)
-                new_data.append(old_data_fields[col_index])
-            new_data = merged_col_delim.join(new_data)
+            new_data = merged_col_delim.join([old_data_fields[col_index]\
+              for col_index in col_indices_to_merge])
             new_data_fields = old_data_fields
             new_data_fields.append(new_data)
             result = delimiter.join(new_data_fields)
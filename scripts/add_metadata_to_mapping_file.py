@@ -20,7 +20,11 @@ try:
     from cogent.util.option_parsing import parse_command_line_parameters, make_option
 except ImportError:
     raise ImportError("Could not import option parsing from cogent.util.option_parsing.  Is PyCogent installed (you can run this script within MacQIIME or the QIIME virtualbox to make use of a 'pre-packaged' PyCogent installation)")
-from string import strip
+from datetime import datetime
+from multiprocessing import Pool
+from itertools import izip,repeat
+from mapping import MappingTable
+import instrumentation
 
 script_info = {}
 script_info['brief_description'] = "Given a mapping file and the tab-delimited file of metadata on organisms or genes, add metadata to the mapping file."
@@ -34,7 +38,7 @@ script_info['required_options'] = [\
 make_option('-i','--input_mapping_file',type="existing_filepath",\
   help='the input QIIME format mapping file.'),\
 make_option('-m','--metadata_files',\
-  help='The new metadata table, with at least one column matching mapping file ids, and the other containing metadata, all in tab-delimited format. If a list of comma-separated files is passed, they will be joined in order.  In this case a comma-separated list of mapping columns must be passed using the --mapping_columns parameter.'),\
+  help='The new metadata table, with at least one column matching mapping file ids, and the other containing metadata, all in tab-delimited format. Quotes in metadata fields are kept. A metadata line with more non-empty fields than its header is an error; extra empty fields (e.g. a trailing tab) are ignored. If a list of comma-separated files is passed, they will be joined in order.  In this case a comma-separated list of mapping columns must be passed using the --mapping_columns parameter.'),\
   make_option('--mapping_columns',\
   help='column name that will map to mapping file ids. If multiple input files are passed, you can pass a comma-separated list of fields, in the same order as the files.  Each mapping field will be used for the corresponding file. If && signs are included in any column name, the metadata and/or mapping file will have a new column added for use in mapping that is the concatenation of those columns, separated by a delimiter defined by --merged_column_delimiter'),\
   make_option('--merged_column_delimiter',default='_',\
@@ -45,8 +49,20 @@ script_info['optional_options'] = [\
    help='a comma-delimited string describing columns to place at the start of the mapping file. If supplied, ensure that these columns are first in the output file [default: %default]'),\
  make_option('--last_cols',default='Description,DESCRIPTION',\
    help='if supplied, ensure that these columns are last in the output file [default: %default]'),\
+ make_option('--join_type',default='left',\
+ help='which samples to keep. left: every sample in the mapping file. inner: only samples with metadata in every metadata file. outer: also add a row for each metadata record matching no sample. [default: %default]'),\
+ make_option('--jobs',type='int',default=1,\
+ help='the number of metadata files to parse at the same time, in separate processes [default: %default]'),\
  make_option('--unknown_method',default='default_value',\
- help='selects how mismatched columns are handled. If using multiple mapping columns, comma-separated  default_value: replace mismatches with a default value.  strict: raise an error if fields mismatch. linear_interpolation: for numeric data fields only. Infers the data value by linear interpolation of the closest two matches to the id field. nearest_value: matches based on the closest matching value available.  If tied, use linear interpolation. [default: %default]'),\
+ help='selects how mismatched columns are handled. If using multiple mapping columns, comma-separated  default_value: replace mismatches with a default value.  strict: raise an error if fields mismatch. linear_interpolation: for numeric data fields only. Infers the data value by linear interpolation of the closest two matches to the id field (other fields use nearest_value). nearest_value: matches based on the closest matching value available (a number, or a date if --key_date_format is given).  If tied, use the smaller value. [default: %default]'),\
+ make_option('--group_columns',default=None,\
+ help='for nearest_value and linear_interpolation, a comma-separated list of columns that must also match exactly (e.g. site) [default: %default]'),\
+ make_option('--tolerance',type='float',default=None,\
+ help='for nearest_value and linear_interpolation, the largest difference between keys that can be matched (in days for dates) [default: no limit]'),\
+ make_option('--key_date_format',default=None,\
+ help='for nearest_value and linear_interpolation, treat keys as dates in this strptime format (e.g. %Y%m%d) [default: keys are numbers]'),\
+ make_option('--stats_file',type="new_filepath",default=None,\
+ help='if supplied, write the calls, rows, bytes and time of each table operation to this file (JSON) [default: %default]'),\
  make_option('-o','--output_mapping_file',type="new_filepath",\
    default='./merged_results.txt',help='the output filepath for the new mappinging file, updated with metadata [default: based on input filename]')]
 script_info['version'] = __version__
@@ -54,185 +70,240 @@ script_info['version'] = __version__
 
 
 
-def supplement_mapping_file(old_mapping_file_lines,new_metadata_file_lines,\
-    col_to_match,first_cols=[],last_cols=[],metadata_delimiter="\t",merged_col_delim="_"):
-    """Supplement a mapping file with new entries from a metadata file
+UNKNOWN_METHODS = ['default_value','strict','nearest_value','linear_interpolation']
 
+def supplement_mapping_file(mapping_table,metadata_tables,cols_to_match,\
+    how='left',merged_col_delim="_",unknown_methods=None,group_cols=None,\
+    tolerance=None,conversion_fn=float):
+    """Return a new MappingTable joining metadata tables to a mapping table
+
+    mapping_table -- MappingTable of the QIIME mapping file
+    metadata_tables -- list of MappingTables of new metadata, in join order.
+      Each must have a column named by the matching entry of cols_to_match.
+    cols_to_match -- list of the column used to match each metadata table
+      to samples.  If a column contains '&&' (e.g. 'site&&date'), the named
+      mapping columns are first merged into a new column, joined by 
+      merged_col_delim.  Metadata tables with all of the named columns,
+      but not the merged one, get the merged column too.
+    how -- 'left','inner' or 'outer' (see MappingTable.join).  Tables
+      matched by nearest_value or linear_interpolation keep every sample,
+      so they can only be joined with 'left'.
+    unknown_methods -- list of the method used to match each metadata
+      table (see UNKNOWN_METHODS).  Defaults to 'default_value' for all.
+    group_cols,tolerance,conversion_fn -- for nearest_value and 
+      linear_interpolation, see MappingTable.joinNearest
+
+    If all tables are matched exactly, all are matched against the 
+    mapping table before the output columns are built, so each mapping
+    row is only processed once.
     """
+    for metadata_table,col_to_match in zip(metadata_tables,cols_to_match):
+        add_merged_key_columns(metadata_table,[col_to_match],merged_col_delim,\
+          required=False)
+    mapping_table,cols_to_match =\
+      add_merged_key_columns(mapping_table,cols_to_match,merged_col_delim)
+    
+    if unknown_methods is None:
+        unknown_methods = ['default_value']*len(metadata_tables)
+    for metadata_table,col_to_match,method in\
+      zip(metadata_tables,cols_to_match,unknown_methods):
+        if col_to_match not in metadata_table.ColIndices:
+            raise ValueError("col_to_match: %s not in header fields: %s"\
+              %(col_to_match,str(metadata_table.ColIds)))
+        if method not in UNKNOWN_METHODS:
+            raise ValueError("Unknown method %s.  Valid methods are: %s"\
+              %(method,",".join(UNKNOWN_METHODS)))
+        if method in ('nearest_value','linear_interpolation') and how != 'left':
+            raise ValueError("The %s method keeps every sample, so it can't be used with the '%s' join type.  Use a 'left' join."\
+              %(method,how))
+    
+    exact_methods = ['default_value','strict']
+    if all(method in exact_methods for method in unknown_methods):
+        result = mapping_table.joinAll(metadata_tables,cols_to_match,how=how,\
+          fill_value='Unknown')
+    else:
+        result = mapping_table
+        for metadata_table,col_to_match,method in\
+          zip(metadata_tables,cols_to_match,unknown_methods):
+            if method in exact_methods:
+                result = result.join(metadata_table,col_to_match,how=how)
+                continue
+            if method == 'linear_interpolation':
+                join_method = 'linear'
+            else:
+                join_method = 'nearest'
+            result = result.joinNearest(metadata_table,col_to_match,\
+              by=group_cols,tolerance=tolerance,method=join_method,\
+              conversion_fn=conversion_fn)
+    
+    for metadata_table,col_to_match,method in\
+      zip(metadata_tables,cols_to_match,unknown_methods):
+        if method == 'strict':
+            check_all_keys_match(result,metadata_table,col_to_match)
+    return result
+
+def check_all_keys_match(mapping_table,metadata_table,col_to_match):
+    """Raise ValueError if any sample's col_to_match value isn't in metadata_table"""
+    metadata_keys = set(metadata_table.getCol(col_to_match).tolist())
+    missing = [key for key in mapping_table.getCategoricalCol(col_to_match)[0].tolist()\
+      if key not in metadata_keys]
+    if missing:
+        raise ValueError("strict matching: no metadata for %s values: %s"\
+          %(col_to_match,",".join(missing)))
+
+def date_to_day_number(date_format):
+    """Return a function converting date strings in date_format to day numbers"""
+    def convert(date_string):
+        return datetime.strptime(date_string,date_format).toordinal()
+    return convert
+
+def add_merged_key_columns(mapping_table,cols_to_match,merged_col_delim="_",\
+    required=True):
+    """Add merged columns for any '&&' keys in cols_to_match
+    
+    required -- if False, skip merges of columns the table doesn't have,
+      rather than raising a ValueError
 
-    #handle special columns that with '&&' markers requesting
-    #column merges in mapping file before matching
-    if "&&" in col_to_match:
+    Merged columns are added to mapping_table itself.  Returns 
+    mapping_table, and cols_to_match with each '&&' key replaced by the
+    name of its merged column.
+    """
+    result = []
+    for col_to_match in cols_to_match:
+        #handle special columns that with '&&' markers requesting
+        #column merges in mapping file before matching
+        if "&&" not in col_to_match:
+            result.append(col_to_match)
+            continue
         cols_to_merge = col_to_match.split("&&")
-        print "ADDING MERGED COLUMN:",cols_to_merge
-        old_mapping_file_lines =\
-             add_merged_column_to_mapping(old_mapping_file_lines,cols_to_merge,\
-             merged_col_delim="_",delimiter="\t")
+        merged_col = merged_col_delim.join(cols_to_merge)
+        if merged_col not in mapping_table.ColIndices and (required or\
+          all(col in mapping_table.ColIndices for col in cols_to_merge)):
+            mapping_table.addMergedColumn(cols_to_merge,merged_col_delim,merged_col)
+            print "ADDED MERGED COLUMN:",merged_col
         #update col to match to be the merged column
-        col_to_match=merged_col_delim.join(cols_to_merge)
-        print "ADDED MERGED COLUMN:",col_to_match
+        result.append(merged_col)
+    return mapping_table,result
+
+def load_metadata_table(metadata_fp):
+    """Return a MappingTable of the metadata file at metadata_fp"""
+    print "Loading new metadata from file:",metadata_fp
+    return MappingTable(clean_mapping_lines(open(metadata_fp,'U').readlines(),\
+      strip_quotes=False))
+
+def load_metadata_tables(metadata_fps,jobs=1):
+    """Return a list of MappingTables of metadata files, parsing up to jobs at once"""
+    if jobs <= 1 or len(metadata_fps) <= 1:
+        return map(load_metadata_table,metadata_fps)
+    pool = Pool(min(jobs,len(metadata_fps)))
+    try:
+        return pool.map(load_metadata_table,metadata_fps)
+    finally:
+        pool.close()
+        pool.join()
+
+def clean_mapping_lines(lines,strip_quotes=True):
+    """Return lines without blank lines or surrounding quotes
     
-
-    #Preparse new metadata file
-    new_header_entries, new_metadata=\
-      parse_metadata_lines(new_metadata_file_lines,col_to_match,\
-      delimiter=metadata_delimiter)
-
-    #Add new metadata to old mapping file
-    result = new_mapping_lines(old_mapping_file_lines,new_metadata,new_header_entries,col_to_match,delimiter=metadata_delimiter,default_value='Unknown',default_method='default', first_fields=first_cols,last_fields=last_cols)
+    strip_quotes -- if False, keep quotes (as for metadata files)
+    """
+    result = []
+    for line in lines:
+        #Cleanup quotes and double-quotes
+        if strip_quotes:
+            line = line.strip('"').strip("'")
+        if line.strip():
+            result.append(line)
     return result
 
 def parse_metadata_lines(metadata_lines,col_to_match,delimiter="\t"):
     """Get new mapping file entries given metadata lines
     metadata lines -- lines from the metadata file (to be added to the mapping file)
-    """
-    #New data will be keyed by the mapping_column value
-    metadata= {}
-    header_line = metadata_lines.next()
-    header_fields = map(strip,header_line.strip('#').split(delimiter))
-    
-    for line in metadata_lines:
-        metadata_fields = map(strip,line.split(delimiter))
-        try:
-            metadata_key_idx = header_fields.index(col_to_match)
-        except ValueError:
-            raise ValueError("col_to_match: %s not in header fields: %s" %(col_to_match,str(header_fields)))
-        key = metadata_fields[metadata_key_idx]
-        
-        new_metadata_entries =\
-          [d for i,d in enumerate(metadata_fields) if i != metadata_key_idx]
-        
-        new_header_entries =\
-          [h for i,h in enumerate(header_fields) if i != metadata_key_idx] 
-        
-        #OLD: new_data used to contain lists of data entries
-        #new_data[new_data_key] = new_data_entries
-        
-        metadata[key] = dict(zip(new_header_entries,new_metadata_entries))
-    
-    #Check for bad headers
-    #for header in new_header_entries:
-    #    if len(header) == 1:
-    #        raise ValueError("Bad header value (length 1):",header)
-    
-    #although the new data columns are also implicit in new_data
-    #they are returned as a list to allow for preservation of ordering
-    
-    return new_header_entries, metadata    
 
-def add_merged_column_to_mapping(mapping_file_lines,cols_to_merge,merged_col_delim="_",delimiter="\t"):
-    """Add a new line to a mapping file, which merges each column in cols_to_merge
+    Returns the metadata columns other than col_to_match, and a dict 
+    of the other fields of each metadata line keyed by its col_to_match
+    value.  For duplicate keys the last line wins.
+    """
+    metadata_table = MappingTable(clean_mapping_lines(list(metadata_lines),\
+      strip_quotes=False),field_delimiter=delimiter)
+    if col_to_match not in metadata_table.ColIndices:
+        raise ValueError("col_to_match: %s not in header fields: %s"\
+          %(col_to_match,str(metadata_table.ColIds)))
+    new_header_entries = [h for h in metadata_table.ColIds if h != col_to_match]
+    keys = metadata_table.getCol(col_to_match).tolist()
+    columns = [metadata_table.getCol(h).tolist() for h in new_header_entries]
+    metadata = {}
+    for key,fields in izip(keys,izip(*columns) if columns else repeat(())):
+        metadata[key] = dict(zip(new_header_entries,fields))
+    return new_header_entries,metadata
+
+def add_merged_column_to_mapping(mapping_file_lines,cols_to_merge,\
+    merged_col_delim="_",delimiter="\t"):
+    """Add a new column to a mapping file, which merges each column in cols_to_merge
     mapping_file_lines:  iterator of lines for a QIIME mapping file
     cols_to_merge: list of columns to merge into a single new column
     merged_col_delim:  value used to join cols_to_merge
     delimiter: overall delimiter for fields
-    """
-
-    for i,line in enumerate(mapping_file_lines):
-        line_type = identify_mapping_file_line_type(i,line)
-        if line_type == 'blank':
-            continue
-        elif line_type == 'header':
-            header_columns=map(strip,line.lstrip('#').split(delimiter))
-            #col_indices_to_merge=\
-            #  [i for i,col in enumerate(header_columns) if col in cols_to_merge]
-            new_header_entries =\
-               [merged_col_delim.join(cols_to_merge)]
-            yield fields_to_line(header_columns+new_header_entries,delimiter=delimiter,comment_marker="#")
-        elif line_type == 'comment':
-            yield line #other comment line, keep it intact
-        elif line_type == 'data':
-            old_data_fields = map(strip,line.strip().split("\t"))
-            #new_data =\
-            #     merged_col_delim.join([d for i,d in enumerate(old_data_fields) if i in col_indices_to_merge])
-            #BAD!!!! the above  reorders columns
-            new_data = []
-            for col in cols_to_merge:
-                col_index = header_columns.index(col)
-                new_data.append(old_data_fields[col_index])
-            new_data = merged_col_delim.join(new_data)
-            new_data_fields = old_data_fields
-            new_data_fields.append(new_data)
-            result = delimiter.join(new_data_fields)
-            yield "%s\n" %result
-
-
 
+    Returns an iterator of the new mapping file lines (see 
+    MappingTable.addMergedColumn).
+    """
+    mapping_table = load_mapping_lines(mapping_file_lines,delimiter,\
+      strip_quotes=False)
+    mapping_table.addMergedColumn(cols_to_merge,merged_col_delim)
+    return iter(mapping_table.delimitedSelf())
 
 def new_mapping_lines(old_mapping_lines,metadata,new_header_entries,col_to_match,\
   delimiter="\t",default_value='Unknown',\
   default_method='default', first_fields=['SampleID','BarcodeSequence',\
   'LinkerPrimerSequence'],last_fields=['Description']):
     """Yield new mapping file lines from the old QIIME mapping file + new metadata
-    """
 
-    for i,line in enumerate(old_mapping_lines):
+    metadata,new_header_entries -- as returned by parse_metadata_lines
+    default_value -- the value of new columns for samples without metadata
 
-        #Cleanup quotes and double-quotes
-        line = line.strip('"').strip("'")
-        line_type = identify_mapping_file_line_type(i,line)
-
-        if line_type == 'blank':
-            continue #skip blank lines
-
-        elif line_type == 'header':
-            
-            mapping_columns=map(strip,line.lstrip('#').split(delimiter))
-            output_header_entries = mapping_columns + new_header_entries
-            #NOTE: the index column col_to_match will be in mapping_columns
-            # but not new_header_entires
-            output_header_entries = sort_fields(output_header_entries,\
-              first_fields,last_fields)
-            
-            #First line will be the ordered, commented header
-            yield  fields_to_line(output_header_entries,delimiter,\
-              comment_marker="#")
-
-        elif line_type == 'comment':
-            #Uninteresting comment line, replicated
-            #without modification
+    The metadata are left joined to the mapping file on col_to_match 
+    (see MappingTable.join).  default_method is ignored.
+    """
+    mapping_table = load_mapping_lines(old_mapping_lines,delimiter)
+    if col_to_match not in mapping_table.ColIndices:
+        raise KeyError("Couldn't find col_to_match: %s in mapping data:%s"\
+          %(col_to_match,str(mapping_table.ColIds)))
+    keys = metadata.keys()
+    metadata_table = MappingTable()
+    metadata_table.loadTableFromColumns([col_to_match]+list(new_header_entries),\
+      [keys]+[[metadata[key].get(h,default_value) for key in keys]\
+      for h in new_header_entries],field_delimiter=delimiter)
+    result = mapping_table.join(metadata_table,col_to_match,\
+      fill_value=default_value)
+    output_cols = sort_fields(result.ColIds,first_fields,last_fields)
+    for chunk in result.iterDelimitedChunks(cols=output_cols):
+        for line in chunk.splitlines(True):
             yield line
 
-        elif line_type == 'data':
-           # print line 
-            mapping_data_fields = map(strip,line.strip().split(delimiter))
-            #print mapping_data_fields
-            mapping_data = dict(zip(mapping_columns,mapping_data_fields))
-            #print mapping_data
-            #update the dictionary of data values
-            try: 
-                metadata_for_this_line =\
-                    metadata.get(mapping_data[col_to_match],None)
-            except KeyError:
-                raise KeyError("Couldn't find col_to_match: %s in mapping data:%s" %(col_to_match,str(mapping_data.keys())))
-            #print metadata_for_this_line
-
-            if metadata_for_this_line is not None:
-                metadata_for_this_line.update(mapping_data) 
-                mapping_data = metadata_for_this_line
-            #then write to the file linearly filling in missing vals as 
-            #needed
-            output_fields = []
-            default = "Unknown"
-            for entry in output_header_entries:
-                #each entry is a column we must have
-                #print "mapping_data:",mapping_data
-                value=mapping_data.get(entry,default)
-                output_fields.append(value) 
-            yield fields_to_line(output_fields)
-
-
 def update_data_by_exact_match(data,header_fields,new_data,new_header_fields,\
     mapping_col,default="Unknown"):
-
+    """Return a dict of one mapping line's fields, updated with its new data
+    
+    new_data -- a dict of the new fields for each mapping_col value, as 
+      returned by parse_metadata_lines
+    
+    Fields of new_header_fields are set to default if there is no new 
+    data for the line.  To update a whole table, use MappingTable.join.
+    """
     mapping_line_data=dict(zip(header_fields,data))
     value_to_match = mapping_line_data[mapping_col]
-    default_result = {h:default for h in new_header_fields}
+    default_result = dict((h,default) for h in new_header_fields)
     mapping_line_data.update(new_data.get(value_to_match,default_result))
     return mapping_line_data
 
-    
-    
+def load_mapping_lines(mapping_lines,delimiter="\t",strip_quotes=True):
+    """Return a MappingTable of QIIME mapping file lines, checking the header"""
+    mapping_lines = clean_mapping_lines(list(mapping_lines),strip_quotes)
+    #Raises an error unless the header is valid
+    identify_mapping_file_line_type(0,mapping_lines[0])
+    return MappingTable(mapping_lines,field_delimiter=delimiter)
+
 def sort_fields(all_fields,first_fields,last_fields,unique_only=True):
     if unique_only:
         #Clunky approach, but not using Set in order to preserve
@@ -292,9 +363,8 @@ def main():
   
     if opts.input_mapping_file == opts.output_mapping_file:
         raise ValueError("Overwriting input not currently supported.  Input and output files must be different.")
-    
-    metadata_file_delimiter = ','
-    mapping_file_delimiter = '\t'
+    if opts.stats_file:
+        instrumentation.enable()
 
     first_cols = opts.first_cols.split(",")
     last_cols = opts.last_cols.split(",")
@@ -304,7 +374,7 @@ def main():
     
     print "Input metadata files:"+opts.metadata_files
     if "," in opts.metadata_files:
-        input_metadata_files = ",".split(opts.metadata_files)
+        input_metadata_files = opts.metadata_files.split(",")
     else:
         input_metadata_files = [opts.metadata_files]
     total_files = len(input_metadata_files)
@@ -314,45 +384,45 @@ def main():
         #will be mapped using that field
         mapping_fields = [opts.mapping_columns]*total_files
     else:
-        mapping_fields = ",".split(opts.mapping_columns)
+        mapping_fields = opts.mapping_columns.split(",")
         if len(mapping_fields) != total_files:
             raise ValueError("If passing multiple, comma-separated files, you must EITHER pass only one mapping column (which will be used to join all tables) OR a comma-separated list of mapping columns, in the same order as the files they should be used to map.")
     
-    #Load old QIIME mapping file.  Parse header line, then for each data line,
-    #insert new fields just before description
+    #Load old QIIME mapping file.  New metadata columns are joined on,
+    #then all columns are ordered once when the result is written
     print "Loading input QIIME mapping file:",opts.input_mapping_file
-    #The result starts as the old mapping file, then we add/update columns
-    result = open(opts.input_mapping_file,'U')
+    result = load_mapping_lines(open(opts.input_mapping_file,'U').readlines())
     
     files_to_join = zip(input_metadata_files,mapping_fields)
     print "Files to join:",files_to_join
-    for metadata_fp,mapping_col in files_to_join:
-        #if "&&" in mapping_col:
-        #    #Information from the mapping file should be concatenated
-        #    #into a new column before adding new metadata
-        #    old_mapping_file_lines =\
-        #      add_merged_column_to_mapping(old_mapping_file_lines,\
-        #      mapping_col.split("&&"), merged_col_delim)
-
-        print "Loading new metadata from file:",metadata_fp
-        metadata_file = open(metadata_fp,'U') 
+    unknown_methods = opts.unknown_method.split(",")
+    if len(unknown_methods) == 1:
+        unknown_methods = unknown_methods*total_files
+    elif len(unknown_methods) != total_files:
+        raise ValueError("Pass either one --unknown_method, or one per metadata file")
+    if opts.group_columns:
+        group_cols = opts.group_columns.split(",")
+    else:
+        group_cols = None
+    if opts.key_date_format:
+        conversion_fn = date_to_day_number(opts.key_date_format)
+    else:
+        conversion_fn = float
     
-        print "Generating new mapping file by joining metadata file %s on column %s" %(metadata_file,mapping_col)
-        
-        result = supplement_mapping_file(result,metadata_file,\
-          mapping_col,first_cols=first_cols,last_cols=last_cols)
+    #Index all metadata first, then join everything in one pass
+    metadata_tables = load_metadata_tables(input_metadata_files,jobs=opts.jobs)
+    print "Generating new mapping file by joining %i metadata files" %total_files
+    result = supplement_mapping_file(result,metadata_tables,mapping_fields,\
+      how=opts.join_type,merged_col_delim=opts.merged_column_delimiter,\
+      unknown_methods=unknown_methods,group_cols=group_cols,\
+      tolerance=opts.tolerance,conversion_fn=conversion_fn)
     
-    #print "Result:", result
-    i=0
-    #Open output file
-    print "Opening output file:",opts.output_mapping_file
-    outfile = open(opts.output_mapping_file,'w+')
-    for l in result:
-        i+=1
-        outfile.write(l)
-        #print l.strip()
-    print "Done. %i output lines saved to:%s" %(i,opts.output_mapping_file)
-    outfile.close()
+    output_cols = sort_fields(result.ColIds,first_cols,last_cols)
+    print "Writing output file:",opts.output_mapping_file
+    result.writeTable(opts.output_mapping_file,cols=output_cols)
+    print "Done. %i samples saved to:%s" %(len(result.RowIds),opts.output_mapping_file)
+    if opts.stats_file:
+        instrumentation.export_stats(opts.stats_file)
 
 if __name__ == "__main__":
     main()
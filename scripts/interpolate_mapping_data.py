@@ -23,6 +23,7 @@ try:
 except ImportError:
     raise ImportError("Could not import option parsing from cogent.util.option_parsing.  Is PyCogent installed (you can run this script within MacQIIME or the QIIME virtualbox to make use of a 'pre-packaged' PyCogent installation)")
 from mapping import MappingTable
+import instrumentation
 
 script_info = {}
 script_info['brief_description'] = "Perform missing data interpolation on a QIIME mapping file."
@@ -48,6 +49,10 @@ script_info['optional_options'] = [\
     help="Name of columns to use in splitting up the dataset before interpolation (e.g. interpolate only within data that share values for all of these columns).  If provided, the table will be split based on all unique values of this column and results interpolated within each, then merged back into a single output [default:%default]"),\
  make_option('-o','--output_file',type="new_filepath",\
    default='interpolated_vals.txt',help='the output filepath for interpolated values.[default: %default]'),\
+ make_option('-j','--jobs',type='int',default=1,\
+   help='number of processes to interpolate with.  Groups of rows and interpolation columns are shared among them. [default: %default]'),\
+ make_option('--stats_file',type="new_filepath",default=None,\
+   help='if supplied, write the calls, rows, bytes and time of each table operation to this file (JSON) [default: %default]'),\
 ]
 
 script_info['version'] = __version__
@@ -57,58 +62,30 @@ script_info['version'] = __version__
 if __name__ == "__main__":
     option_parser, opts, args =\
       parse_command_line_parameters(**script_info)
+    if opts.stats_file:
+        instrumentation.enable()
 
     infile = open(opts.input_mapping_file,"U")
-    outfile = open(opts.output_file,"w")
     
     input_mapping_table = MappingTable(infile.readlines())
     y_cols=opts.interpolation_columns.split(",")
     x_col=opts.reference_column
     
     
+    #Interpolate within each group of rows sharing values in the 
+    #split columns.  This lets users e.g. interpolate pH vs. growth within
+    # treatment categories.  All groups and columns are handled in one pass
+    # over the table, so the table isn't split into separate tables.
     if opts.split_col is None:
-        mapping_tables = [input_mapping_table]
-        mapping_table_labels = ['all_data']
+        group_by_cols = None
     else:
         group_by_cols = opts.split_col.split(",")
-        mapping_table_dict = input_mapping_table.splitByCol(group_by_cols)
-        print "mapping_table_dict:",mapping_table_dict
-        mapping_tables = []
-        mapping_table_labels = []
-        for m in mapping_table_dict.iteritems():
-            print m
-            mapping_tables.append(m[1])
-            print len(m[1].Data)
-            mapping_table_labels.append(m[0])
-
-        
-    #We want to generate a collection of tables, one for each value in
-    # the split column.  This lets users e.g. interpolate pH vs. growth within
-    # treatment categories.
-
-    header_and_comments_written = False 
-    for i,mapping_table in enumerate(mapping_tables):
-        print "Interpolating table length:",len(mapping_table.Data) 
-        if len(mapping_table.Data) < 5:
-            #for line in mapping_table.delimitedSelf():
-            #    print line
-            print "Skipping table for %s (has only %i rows)" %(mapping_table_labels[i],len(mapping_table.Data))
-
-        for y_col in y_cols:  
-            mapping_table.updateColByInterpolation(y_col,x_col)
-       
-        #we want to merge tables in output
-        #so only the first table will write its header and comments
-        if not header_and_comments_written:
-            for line in mapping_table.delimitedSelf():
-                outfile.write(line)
-            header_and_comments_written = True
-            continue
-        
-        #skip comments on subsequent merged tables
-        for line in mapping_table.delimitedSelf(write_header=False,\
-          write_comments=False):
-                outfile.write(line)
     
-    outfile.close()
+    input_mapping_table.updateColsByInterpolation(y_cols,x_col,group_by_cols,\
+      jobs=opts.jobs)
+    
+    #Rows are written in their original order
+    input_mapping_table.writeTable(opts.output_file)
+    if opts.stats_file:
+        instrumentation.export_stats(opts.stats_file)
     
@@ -17,8 +17,8 @@ from warnings import warn
 from collections import defaultdict
 from cogent.util.option_parsing import parse_command_line_parameters, make_option
 from string import strip
-from datetime import date
-from md_menagerie.calc_time_interval import string_to_date 
+from itertools import izip
+from mapping import MappingTable,quote_expression_column
 
 script_info = {}
 script_info['brief_description'] = "Given a mapping file with metadata specifying a start date, end date and sample date, generate a new metadata file with a treatment column modified according to whether samples fall before, during, or after treatment."
@@ -41,109 +41,81 @@ make_option('-i','--input_mapping_file',type="existing_filepath",\
 script_info['optional_options'] = [\
   make_option('-o','--output_mapping_file',type="new_filepath",\
    default=None,help='the output filepath for the new mappinging file, updated with metadata [default: based on input filename]'),\
-  make_option('--pre_suffix',default='_pretreatment'
-      help='suffix for pre-treatment samples [Default:%default]'),\
-  make_option('--post_suffix',default='_posttreatment'
+  make_option('--treatment_column',default='Treatment',\
+      help='column holding the treatment of each sample [Default:%default]'),\
+  make_option('--new_column',default=None,\
+      help='name of the output column [Default:the treatment column followed by _by_date]'),\
+  make_option('--pre_suffix',default='_pretreatment',\
       help='suffix for pre-treatment samples [Default:%default]'),\
+  make_option('--post_suffix',default='_posttreatment',\
+      help='suffix for post-treatment samples [Default:%default]'),\
    ]
 script_info['version'] = __version__
 
 
-def mapping_line_to_metadata_dict(line,header_index_dict,field_delimiter="\t",line_delimiter="\n"):
-    """Return a dict of metadata_key: metadata value for a given data line.  
-    NOTE: in this dict SampleID is treated as a metadata value"""
-    fields = line.strip(line_delimiter).split(field_delimiter)
-    md = {fields[header_index_dict[k]] for k in header_index_dict.keys()}
-    return md
-
-def index_columns_by_header(header_line,field_delimiter="\t",line_delimiter="\n"):
-    """Return a dict indexing columns by their order in the header
-    Result will be a header_col:index dict"""
-
-    headers = line.lstrip('#').strip(line_delimiter).split(field_delimiter)
-    header_index_dict = {h:i for i,h in enumerate(headers)} 
-    return header_index_dict
-
-def new_metadata_by_per_sample_formula(lines,f,new_col_name='derived_metadata'):
+def new_metadata_by_per_sample_formula(lines,f,new_col_name='derived_metadata',\
+    columns=None,jobs=1,chunksize=None):
     """Return a new metadata column based on the results of running f on metadata for this sample
     lines - lines of a QIIME mapping file
     f - a function taking a dict of header:value entries for this sample, and returning a single 
     string as output
     new_col_name - the name of the metadata column to be output
-    vals_to_skip
-    
-    
+    columns - the columns passed to f [default: all, including SampleID]
+    jobs - number of processes to run f in (see MappingTable.mapRows)
+    chunksize - samples per task sent to each process
+
+    Yields a header line, then a SampleID and result line per sample.
+    For derivations that can be written as expressions, 
+    MappingTable.addDerivedColumn is much faster.
     """
-    
+    mapping_table = MappingTable(list(lines))
+    mapping_table.mapRows(f,new_col_name,columns=columns,jobs=jobs,chunksize=chunksize)
     yield "#SampleID\t%s\n" %new_col_name
-    for i,line in enumerate(lines):
-        if i==0 and line.startswith('#'):
-            header_index_dict = index_columns_by_header
-        elif line.startswith('#'):
-            continue
-        else:
-            #We're in a data line
-            metadata = mapping_line_to_metadata_dict(line,header_index_dict)
-            sample_id = metadata['SampleID']
-            new_col = f(metadata)
-            yield "\t".join(sample_id,new_col)+"\n"
-            
-            
-            
-def make_HERBVREdate_span_function(start_date_header='start_date',sample_time_header='date',end_date_header='end_date',\
-        suffix_output_dict={'=start':'treatment','=end':'post','<start':'pre','>end':'damaged'):
-    """Make a function to modify treatments for project HERBVRE specifically"""
-    
-
-        sample_id = fields[header_index_dict['SampleID']]
-        
-        #Get relevant date strings for start, stop, sampling date
-        current_date_str = metadata[curr_time_header]
-        start_date_str = metadata[start_time_header]
-        end_date_str = metadata[end_time_header]
-
-        #Convert all to Date objects instead of strings
-        current_date = string_to_date(current_concatenateddate)
-        start_date = string_to_date(start_concatenateddate)
-        end_date = string_to_date(end_concatenateddate)
-
-        
-        #Don't fail on "Unknown" date values
-        #TODO: parameterize 'Unknown'`
-        if current_concatenateddate in vals_to_skip or\
-          start_concatenateddate in vals_to_skip:
-            yield "\t".join([sample_id,"Unknown"])
-            continue 
+    for sample_id,new_col in izip(mapping_table.RowIds,\
+      mapping_table.getCol(new_col_name).tolist()):
+        yield "\t".join([sample_id,new_col])+"\n"
+
+def treatment_by_date_expression(treatment_column='Treatment',sample_time_column='date',\
+    start_time_column='start_date',end_time_column='end_date',pre_suffix='_pretreatment',\
+    post_suffix='_posttreatment'):
+    """Return expression text labelling each sample's treatment by its sample date (project HERBVRE)
+
+    Samples from before the start date get the treatment plus pre_suffix,
+    samples after the end date get the treatment plus post_suffix, and
+    samples between them (inclusive) get the treatment unchanged.  Samples
+    with an unknown date have no result.  See MappingTable.addDerivedColumn.
+    """
+    sample_date = "date(%s)" %quote_expression_column(sample_time_column)
+    treatment = quote_expression_column(treatment_column)
+    return 'if %s < date(%s) then %s + "%s" elif %s > date(%s) then %s + "%s" else %s'\
+      %(sample_date,quote_expression_column(start_time_column),treatment,pre_suffix,\
+        sample_date,quote_expression_column(end_time_column),treatment,post_suffix,treatment)
 
 def main():
     option_parser, opts, args =\
        parse_command_line_parameters(**script_info)
-  
-    
-    metadata_file_delimiter = ','
-    mapping_file_delimiter = '\t'
-
-    #Open output file
-    print "Opening output file:",opts.output_mapping_file
-    outfile = open(opts.output_mapping_file,'w+')
+    new_column = opts.new_column or opts.treatment_column+"_by_date"
+    output_mapping_file = opts.output_mapping_file or\
+      opts.input_mapping_file.rsplit('.',1)[0]+"_"+new_column+".txt"
 
-    
-    #Load old QIIME mapping file.  Parse header line, then for each data line,
-    #insert new fields just before description
     print "Loading input QIIME mapping file:",opts.input_mapping_file
-    old_mapping_file = open(opts.input_mapping_file,'U')
-    
-
-    result = modify_metadata_by_date(old_mapping_file,opts.start_time_column,opts.curr_time_column) 
-
-
-    
-    #print "Result:", result
-    for l in result:
-        outfile.write(l)
-        print l.strip()
-    print "Done. Output saved to:",opts.output_mapping_file
-    outfile.close()
+    mapping_file = open(opts.input_mapping_file,'U')
+    mapping_table = MappingTable(mapping_file.readlines())
+    mapping_file.close()
+
+    for col in [opts.treatment_column,opts.sample_time_column,\
+      opts.start_time_column,opts.end_time_column]:
+        if col not in mapping_table.ColIndices:
+            option_parser.error("The column '%s' isn't in the mapping file header:%s"\
+              %(col,str(sorted(mapping_table.ColIds))))
+    mapping_table.addDerivedColumn(new_column,treatment_by_date_expression(\
+      opts.treatment_column,opts.sample_time_column,opts.start_time_column,\
+      opts.end_time_column,opts.pre_suffix,opts.post_suffix))
+
+    print "Writing output file:",output_mapping_file
+    mapping_table.writeTable(output_mapping_file,\
+      cols=mapping_table.ColIds[:1]+[new_column],write_comments=False)
+    print "Done. Output saved to:",output_mapping_file
 
 if __name__ == "__main__":
     main()
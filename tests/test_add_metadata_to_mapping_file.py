@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""Tests the line-based helpers of the add_metadata_to_mapping_file script."""
+
+from cogent.util.unit_test import TestCase, main
+from add_metadata_to_mapping_file import parse_metadata_lines,\
+  new_mapping_lines,add_merged_column_to_mapping,update_data_by_exact_match
+
+class AddMetadataToMappingFileTests(TestCase):
+    """Tests of the add_metadata_to_mapping_file script."""
+
+    def setUp(self):
+        """Create some data to be used in the tests."""
+        self.MetadataLines =\
+          ["#DOB\tSeason\tTempF\n",\
+           "20061218\tWinter\t-10\n",\
+           "20060817\tSummer\t95\n"]
+
+        self.MappingLines =\
+          ["#SampleID\tBarcodeSequence\tDOB\tDescription\n",\
+           "#A comment\n",\
+           "PC.354\tAGCACGAGCCTA\t20061218\tMouse_354\n",\
+           "PC.355\tAACTCGTCGATG\t20060817\tMouse_355\n",\
+           "PC.356\tACAGACCACTCA\t20060305\tMouse_356\n"]
+
+    def test_parse_metadata_lines_keys_fields_by_column(self):
+        """parse_metadata_lines gives the other fields of each metadata line"""
+        header,metadata = parse_metadata_lines(iter(self.MetadataLines),'DOB')
+        self.assertEqual(header,['Season','TempF'])
+        self.assertEqual(metadata['20060817'],{'Season':'Summer','TempF':'95'})
+        self.assertEqual(len(metadata),2)
+        self.assertRaises(ValueError,parse_metadata_lines,\
+          iter(self.MetadataLines),'Site')
+
+    def test_new_mapping_lines_joins_metadata(self):
+        """new_mapping_lines adds metadata columns, filling missing values"""
+        header,metadata = parse_metadata_lines(iter(self.MetadataLines),'DOB')
+        obs = list(new_mapping_lines(iter(self.MappingLines),metadata,header,\
+          'DOB',first_fields=['SampleID']))
+        self.assertEqual(obs,\
+          ["#SampleID\tBarcodeSequence\tDOB\tSeason\tTempF\tDescription\n",\
+           "#A comment\n",\
+           "PC.354\tAGCACGAGCCTA\t20061218\tWinter\t-10\tMouse_354\n",\
+           "PC.355\tAACTCGTCGATG\t20060817\tSummer\t95\tMouse_355\n",\
+           "PC.356\tACAGACCACTCA\t20060305\tUnknown\tUnknown\tMouse_356\n"])
+        self.assertRaises(KeyError,list,new_mapping_lines(iter(self.MappingLines),\
+          metadata,header,'Site'))
+
+    def test_add_merged_column_to_mapping_appends_merged_column(self):
+        """add_merged_column_to_mapping adds a column joining other columns"""
+        obs = list(add_merged_column_to_mapping(self.MappingLines,\
+          ['SampleID','DOB']))
+        self.assertEqual(obs[0],\
+          "#SampleID\tBarcodeSequence\tDOB\tDescription\tSampleID_DOB\n")
+        self.assertEqual(obs[2],\
+          "PC.354\tAGCACGAGCCTA\t20061218\tMouse_354\tPC.354_20061218\n")
+
+    def test_update_data_by_exact_match_fills_defaults(self):
+        """update_data_by_exact_match adds new data for a line, or defaults"""
+        header,metadata = parse_metadata_lines(iter(self.MetadataLines),'DOB')
+        obs = update_data_by_exact_match(['PC.355','20060817'],\
+          ['SampleID','DOB'],metadata,header,'DOB')
+        self.assertEqual(obs,{'SampleID':'PC.355','DOB':'20060817',\
+          'Season':'Summer','TempF':'95'})
+        obs = update_data_by_exact_match(['PC.356','20060305'],\
+          ['SampleID','DOB'],metadata,header,'DOB')
+        self.assertEqual(obs['Season'],'Unknown')
+
+if __name__ == '__main__':
+    main()
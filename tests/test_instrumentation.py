@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""Tests counters and timers of MappingTable operations."""
+
+import logging
+from cogent.util.unit_test import TestCase, main
+from StringIO import StringIO
+from json import loads
+from time import time
+import instrumentation
+from mapping import MappingTable
+
+class InstrumentationTests(TestCase):
+    """Tests of the instrumentation module."""
+
+    def setUp(self):
+        """Define a small mapping table and start from empty stats"""
+        self.MappingLines=\
+        ["#SampleID\tSite\tTemp\tGrowthRate\n",\
+         "S.1\tA\t1.0\t3.0\n",\
+         "S.2\tA\t2.0\tUnknown\n",\
+         "S.3\tB\t3.0\t0.0\n"]
+        instrumentation.reset()
+
+    def tearDown(self):
+        """Leave instrumentation off for other tests"""
+        instrumentation.disable()
+        instrumentation.reset()
+
+    def test_operations_are_not_recorded_by_default(self):
+        """Instrumented methods record nothing unless instrumentation is enabled"""
+        table = MappingTable(self.MappingLines)
+        table.splitByCol(['Site'])
+        self.assertEqual(instrumentation.snapshot(),{})
+
+    def test_enabled_operations_record_rows_bytes_and_time(self):
+        """Enabled instrumentation records calls, rows, bytes and time per operation"""
+        instrumentation.enable()
+        table = MappingTable(self.MappingLines)
+        table.splitByCol(['Site'])
+        table.splitByCol(['Site','Temp'])
+        out = StringIO()
+        table.writeTable(out)
+        stats = instrumentation.snapshot()
+        self.assertEqual(stats['loadTableFromLines']['rows_out'],3)
+        self.assertEqual(stats['loadTableFromLines']['bytes'],\
+          sum(map(len,self.MappingLines)))
+        self.assertEqual(stats['splitByCol']['calls'],2)
+        self.assertEqual(stats['splitByCol']['rows_in'],6)
+        self.assertEqual(stats['splitByCol']['rows_out'],6)
+        self.assertEqual(stats['writeTable']['bytes'],len(out.getvalue()))
+        self.assertTrue(stats['writeTable']['seconds'] >= 0.0)
+
+        instrumentation.reset()
+        self.assertEqual(instrumentation.snapshot(),{})
+
+    def test_nested_operations_record_self_time(self):
+        """Operations called by other operations are not counted in their callers' seconds"""
+        instrumentation.enable()
+        table = MappingTable(self.MappingLines)
+        other = MappingTable(["#Site\tDepth\n","A\t5\n"])
+        instrumentation.reset()
+        start = time()
+        for i in range(50):
+            table.join(other,'Site')
+        wall_seconds = time()-start
+        stats = instrumentation.snapshot()
+        self.assertEqual(stats['joinAll']['calls'],50)
+        self.assertTrue(stats['join']['seconds'] < stats['joinAll']['seconds'])
+        self.assertTrue(sum(s['seconds'] for s in stats.values()) <= wall_seconds)
+
+    def test_export_stats_writes_json_and_tsv(self):
+        """export_stats writes a snapshot as JSON or one line per operation"""
+        instrumentation.record('joinAll',0.5,rows_in=10,rows_out=8)
+        out = StringIO()
+        instrumentation.export_stats(out)
+        self.assertEqual(loads(out.getvalue())['joinAll']['rows_out'],8)
+        out = StringIO()
+        instrumentation.export_stats(out,format='tsv')
+        self.assertEqual(out.getvalue().splitlines(),\
+          ["operation\tcalls\tseconds\trows_in\trows_out\tbytes",\
+           "joinAll\t1\t0.5\t10\t8\t0"])
+        self.assertRaises(ValueError,instrumentation.export_stats,out,'xml')
+
+    def test_debug_messages_are_logged_only_when_enabled(self):
+        """Debug messages from operations go to the md_menagerie logger if enabled"""
+        log = StringIO()
+        handler = logging.StreamHandler(log)
+        instrumentation.logger.addHandler(handler)
+        instrumentation.logger.setLevel(logging.DEBUG)
+        try:
+            table = MappingTable(self.MappingLines)
+            table.updateColByInterpolation('GrowthRate','Temp')
+            self.assertEqual(log.getvalue(),"")
+            instrumentation.enable(debug=True)
+            table.interpolate('GrowthRate','Temp')
+            self.assertTrue("COL TO INTERPOLATE: GrowthRate" in log.getvalue())
+        finally:
+            instrumentation.logger.removeHandler(handler)
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,16 @@
 """Tests the MappingTable object."""
 
 from cogent.util.unit_test import TestCase, main
-from mapping import MappingTable,average_points_by_x
+from mapping import MappingTable,average_points_by_x,make_criterion_from_text,\
+  make_expression_from_text,quote_expression_column
 from numpy import array
+from StringIO import StringIO
+from tempfile import mkdtemp
+from shutil import rmtree
+from os import listdir
+from os.path import join
+from cPickle import dumps,loads
+from datetime import date
 
 class MappingTests(TestCase):
     """Tests of the mapping class  module."""
@@ -68,6 +76,37 @@ class MappingTests(TestCase):
         self.assertEqualItems(obs_table.HeaderFields, exp_header)
         self.assertEqual(obs_table.Data,exp_data)
 
+    def test_load_mapping_pads_short_rows(self):
+        """loadTableFromLines pads rows with missing trailing fields"""
+        lines = ["#SampleID\tTemp\tDescription\n","S.1\t1.0\n"]
+        obs_table = MappingTable(lines)
+        self.assertEqual(obs_table.Data,[["S.1","1.0",""]])
+        self.assertRaises(ValueError,MappingTable,lines+["S.2\t1.0\tx\ty\n"])
+
+    def test_load_mapping_ignores_extra_empty_fields(self):
+        """loadTableFromLines drops empty fields past the header width"""
+        lines = ["#SampleID\tTemp\tDescription\n","S.1\t1.0\tx\t\n",\
+          "S.2\t2.0\ty\t \t\n"]
+        for lazy in (False,True):
+            obs_table = MappingTable(lines,lazy=lazy)
+            self.assertEqual(obs_table.Data,[["S.1","1.0","x"],["S.2","2.0","y"]])
+            self.assertEqual(list(obs_table.getCol('Description')),["x","y"])
+            self.assertRaises(ValueError,MappingTable,\
+              lines+["S.3\t3.0\tz\t\tw\n"],lazy=lazy)
+
+    def test_getCol_returns_column_array(self):
+        """MappingTable.getCol returns the stored data for a column"""
+        obs = self.ValidTable.getCol('DOB')
+        self.assertEqual(list(obs),['20061218', '20060817', '20060305'])
+        self.assertRaises(ValueError,self.ValidTable.getCol,'NotAColumn')
+
+    def test_Data_is_a_row_view_of_columns(self):
+        """MappingTable.Data gives row access to columnar storage"""
+        obs_table = self.ValidTable
+        self.assertEqual(len(obs_table.Data),3)
+        self.assertEqual(obs_table.Data[-1][0],'PC.356')
+        self.assertEqual(obs_table.Data[1:2],[obs_table.Data[1]])
+
     def test_iterRows_iterates_over_valid_rows(self):
         """MappingTable.iterRows iterates over rows"""
         exp_first_row = ('PC.354',["PC.354","AGCACGAGCCTA","YATGCTGCCTCCCGTAGGAGT","Control","20061218","Control_mouse__I.D._354"])
@@ -79,7 +118,18 @@ class MappingTests(TestCase):
         exp_first_row = ('PC.356',["PC.356","ACAGACCACTCA","YATGCTGCCTCCCGTAGGAGT","Control","20060305","Control_mouse__I.D._356"])
         obs_table = MappingTable(self.ValidMappingFileLines)
         self.assertEqual(obs_table.iterRows(row_names=['PC.356']).next(),exp_first_row)
-        
+
+    def test_rowIndices_resolves_row_ids(self):
+        """MappingTable.rowIndices gives positions in table or caller order"""
+        obs_table = self.ValidTable
+        row_names = ['PC.356','Missing','PC.354','PC.356']
+        self.assertEqual(obs_table.rowIndices(row_names).tolist(),[0,2])
+        self.assertEqual(obs_table.rowIndices(row_names,preserve_order=True).tolist(),\
+          [2,0,2])
+        obs_ids = [row_id for row_id,row in\
+          obs_table.iterRows(['PC.356','PC.354'],preserve_order=True)]
+        self.assertEqual(obs_ids,['PC.356','PC.354'])
+
     def test_iterRowData_iterates_over_valid_rows(self):
         """MappingTable.iterRowData iterates over row data"""
         exp_first_row = ["PC.354","AGCACGAGCCTA","YATGCTGCCTCCCGTAGGAGT","Control","20061218","Control_mouse__I.D._354"]
@@ -120,6 +170,22 @@ class MappingTests(TestCase):
         self.assertEqual([c for c in obs_merged_output],exp_merged_output)
 
 
+    def test_addMergedColumn_adds_indexed_key_column(self):
+        """MappingTable.addMergedColumn adds a real, indexed column of merged values"""
+        table = MappingTable(["#SampleID\tSite\tMonth\n","S.1\tA\t1\n",\
+          "S.2\tA\t2\n","S.3\tB\t1\n","S.4\tA\t1\n"])
+        self.assertEqual(table.addMergedColumn(['Site','Month']),'Site_Month')
+        self.assertEqual(table.ColIds,['SampleID','Site','Month','Site_Month'])
+        self.assertEqual(table.getCol('Site_Month').tolist(),['A_1','A_2','B_1','A_1'])
+        self.assertEqual(table.rowIndicesWithValue('Site_Month','A_1').tolist(),[0,3])
+        self.assertEqual(table.Data[3],['S.4','A','1','A_1'])
+        table.addMergedColumn(['Month','SampleID'],'&',merged_col='key',index=False)
+        self.assertEqual(table.getCol('key').tolist(),['1&S.1','2&S.2','1&S.3','1&S.4'])
+        self.assertRaises(ValueError,table.addMergedColumn,['Site','Month'])
+        lazy = MappingTable(self.ValidMappingFileLines,lazy=True)
+        lazy.addMergedColumn(['BarcodeSequence','DOB'])
+        self.assertEqual(lazy.Data[0][-1],'AGCACGAGCCTA_20061218')
+
     def test_iterColData_iterates_over_valid_cols(self):
         """MappingTable.iterColData iterates over column data"""
         obs_table = MappingTable(self.ValidMappingFileLines)
@@ -161,7 +227,27 @@ class MappingTests(TestCase):
           [2,'Unknown'],
           [3,'Unknown']]
         self.assertEqualItems(obs,exp)
- 
+
+    def test_iterNumericDataByRow_skips_rows_with_nonnumeric_data(self):
+        """MappingTable.iterNumericDataByRow yields only fully numeric rows"""
+        obs = [row for row in self.InterpolationTable.iterNumericDataByRow(\
+          ['GrowthRate','Temp'])]
+        exp = [[1.0,3.0],[2.0,2.0],[3.0,0.0]]
+        self.assertEqual(obs,exp)
+
+    def test_getNumericCol_parses_once_and_invalidates_on_update(self):
+        """MappingTable.getNumericCol caches values and a validity mask"""
+        table = self.InterpolationTable
+        values,valid = table.getNumericCol('GrowthRate')
+        self.assertFloatEqual(values[:3],[3.0,2.0,0.0])
+        self.assertEqual(valid.tolist(),[True]*3+[False]*5)
+        self.assertTrue(table.getNumericCol('GrowthRate')[0] is values)
+
+        table.updateCol('GrowthRate','SampleID',{'S.4':4.0})
+        values,valid = table.getNumericCol('GrowthRate')
+        self.assertFloatEqual(values[3],4.0)
+        self.assertEqual(valid.tolist(),[True]*4+[False]*4)
+
     def test_splitByCol_functions_with_valid_textual_data(self):
         """MappingTable.splitTableByColumns generates a dict of new tables"""
         start_table = self.InterpolationTable
@@ -193,13 +279,32 @@ class MappingTests(TestCase):
         
         obs_entry_272 = new_tables[('2.72',)].delimitedSelf()
         self.assertEqualItems(obs_entry_272,exp_entry_272)
-       
+
+    def test_splitByCol_groups_are_isolated_on_update(self):
+        """MappingTable.splitByCol groups copy data only when modified"""
+        start_table = self.InterpolationTable
+        new_tables = start_table.splitByCol(['Temp'])
+        group = new_tables[('1.0',)]
+        self.assertEqual(group.RowIds,['S.1','S.5'])
+        self.assertEqual(group.getCol('GrowthRate').tolist(),['3.0','Unknown'])
+
+        #Updating a group must not change the parent table
+        group.updateCol('GrowthRate','SampleID',{'S.5':'2.5'})
+        self.assertEqual(group.getCol('GrowthRate').tolist(),['3.0','2.5'])
+        self.assertEqual(start_table.getCol('GrowthRate')[4],'Unknown')
+
+        #...and updating the parent must not change other groups
+        other = new_tables[('2.0',)]
+        start_table.updateCol('GrowthRate','SampleID',{'S.2':'9.0'})
+        self.assertEqual(other.getCol('GrowthRate').tolist(),['2.0'])
+        self.assertEqual(start_table.getCol('GrowthRate')[1],'9.0')
+
     def test_interpolate_gives_correct_output_with_valid_data(self):
         """MappingTable.interpolate correctly interpolates a short data series"""
         table = self.InterpolationTable
         # Test values taken from the scipy documentation here:
         # http://docs.scipy.org/doc/numpy/reference/generated/numpy.interp.html
-        obs_x,obs_y = table.interpolate("Temp","GrowthRate")
+        obs_x,obs_y = table.interpolate("GrowthRate","Temp")
         exp_y = array([3.0,3.0,2.5,0.56,0.0])
         self.assertFloatEqual(obs_y,exp_y)
 
@@ -208,7 +313,7 @@ class MappingTests(TestCase):
         table = self.InterpolationTableWithDuplicate
         # Test values taken from the scipy documentation here:
         # http://docs.scipy.org/doc/numpy/reference/generated/numpy.interp.html
-        obs_x,obs_y = table.interpolate("Temp","GrowthRate")
+        obs_x,obs_y = table.interpolate("GrowthRate","Temp")
         exp_y = array([3.0,3.0,3.0,2.5,0.56,0.0])
         self.assertFloatEqual(obs_y,exp_y)
 
@@ -242,6 +347,26 @@ class MappingTests(TestCase):
         exp = ['S.6']
         self.assertEqualItems(obs,exp)
 
+    def test_selectRowsByValue_finds_closest_rows(self):
+        """MappingTable.selectRowsByValue finds closest rows on either or both sides"""
+        table = self.InterpolationTableWithDuplicate
+        self.assertEqual(table.selectRowsByValue(1.0,'Temp'),['S.1','S.5','S.5b'])
+        self.assertEqual(table.selectRowsByValue(1.0,'Temp',sides='less_than'),['S.4'])
+        self.assertEqual(table.selectRowsByValue(1.0,'Temp',sides='greater_than'),['S.6'])
+        self.assertEqual(table.selectRowsByValue(9.0,'Temp',sides='greater_than'),[])
+        #ties on both sides return both
+        self.assertEqual(table.selectRowsByValue(1.25,'Temp'),\
+          ['S.1','S.5','S.5b','S.6'])
+        self.assertRaises(ValueError,table.selectRowsByValue,1.0,'Temp',sides='above')
+
+    def test_selectRowsByValues_matches_many_targets(self):
+        """MappingTable.selectRowsByValues finds the closest row for each target"""
+        table = self.InterpolationTableWithDuplicate
+        obs = table.selectRowsByValues([1.0,1.25,-5.0,2.8,10.0],'Temp')
+        self.assertEqual(obs,['S.1','S.1','S.4','S.7','S.8'])
+        obs = table.selectRowsByValues([0.0,3.0],'Temp',sides='less_than')
+        self.assertEqual(obs,[None,'S.7'])
+
     def test_updateCol_functions_with_valid_data(self):
         """MappingTable.updateCol should update a column"""
         table = self.InterpolationTableWithDuplicate
@@ -280,7 +405,321 @@ class MappingTests(TestCase):
          "S.7\t2.72\t0.56\tSample.7.Description\n",\
          "S.8\t3.14\t0.0\tSample.7.Description\n"] 
         self.assertEqualItems(obs,exp)
+
+    def test_updateColsByInterpolation_interpolates_within_groups(self):
+        """MappingTable.updateColsByInterpolation interpolates each group separately"""
+        lines =\
+        ["#SampleID\tSite\tTemp\tGrowthRate\tpH\n",\
+         "S.1\tA\t1.0\t3.0\t7.0\n",\
+         "S.2\tA\t3.0\t1.0\tUnknown\n",\
+         "S.3\tA\t2.0\tUnknown\t8.0\n",\
+         "S.4\tB\t2.0\t10.0\tUnknown\n",\
+         "S.5\tB\t4.0\tUnknown\tUnknown\n",\
+         "S.6\tB\tUnknown\tUnknown\t6.0\n"]
+        table = MappingTable(lines)
+        table.updateColsByInterpolation(['GrowthRate','pH'],'Temp',['Site'])
+        self.assertEqual(table.getCol('GrowthRate').tolist(),\
+          ['3.0','1.0','2.0','10.0','10.0','Unknown'])
+        self.assertEqual(table.getCol('pH').tolist(),\
+          ['7.0','8.0','8.0','Unknown','Unknown','6.0'])
+        parallel = MappingTable(lines)
+        parallel.updateColsByInterpolation(['GrowthRate','pH'],'Temp',['Site'],jobs=3)
+        self.assertEqual(parallel.delimitedSelf(),table.delimitedSelf())
+
+    def test_updateColsByInterpolation_matches_updateColByInterpolation(self):
+        """MappingTable.updateColsByInterpolation without groups matches updateColByInterpolation"""
+        obs = self.InterpolationTableWithDuplicate
+        obs.updateColsByInterpolation(['GrowthRate'],'Temp')
+        exp = MappingTable(self.InterpolationTableWithDuplicateLines)
+        exp.updateColByInterpolation('GrowthRate','Temp')
+        self.assertEqual(obs.delimitedSelf(),exp.delimitedSelf())
     
+    def test_getCategoricalCol_encodes_repetitive_columns(self):
+        """MappingTable.getCategoricalCol gives a value pool and a code per row"""
+        table = self.InterpolationTable
+        pool,codes = table.getCategoricalCol('GrowthRate')
+        self.assertEqual(pool.tolist(),['0.0','2.0','3.0','Unknown'])
+        self.assertEqual(codes.tolist(),[2,1,0,3,3,3,3,3])
+        self.assertEqual(pool[codes].tolist(),table.getCol('GrowthRate').tolist())
+        values,valid = table.getNumericCol('GrowthRate')
+        self.assertEqual(valid.tolist(),[True]*3+[False]*5)
+        self.assertEqual(values[:3].tolist(),[3.0,2.0,0.0])
+        pool,codes = table.getCategoricalCol('SampleID')
+        self.assertEqual(pool[codes].tolist(),table.RowIds)
+
+    def test_categorical_columns_update_and_split(self):
+        """Dictionary encoded columns behave like plain columns when changed"""
+        table = self.InterpolationTable
+        unknown_rows = table.subsetByIndex(table.rowIndicesWithValue('GrowthRate','Unknown'))
+        self.assertEqual(unknown_rows.RowIds,['S.4','S.5','S.6','S.7','S.8'])
+        self.assertEqual(table.rowIndicesWithValue('GrowthRate','7.0').tolist(),[])
+        table.updateCol('GrowthRate','SampleID',{'S.4':'2.0'})
+        self.assertEqual(table.rowIndicesWithValue('GrowthRate','2.0').tolist(),[1,3])
+        self.assertEqual(unknown_rows.Data[0],['S.4','0.0','Unknown','Sample.4.Description'])
+        self.assertEqual(table.Data[3],['S.4','0.0','2.0','Sample.4.Description'])
+
+    def test_getValidMask_marks_null_tokens(self):
+        """MappingTable.getValidMask is False for fields that are null tokens"""
+        lines = ["#SampleID\tpH\tSite\n","S.1\t7.0\ta\n","S.2\tNA\ta\n",\
+          "S.3\t\tb\n","S.4\t-\tb\n","S.5\tnine\n"]
+        table = MappingTable(lines)
+        self.assertEqual(table.getValidMask('pH').tolist(),[True,False,False,True,True])
+        self.assertEqual(table.getValidMask('Site').tolist(),[True]*4+[False])
+        self.assertEqual(table.getNumericCol('pH')[1].tolist(),[True]+[False]*4)
+        table = MappingTable(lines,null_tokens=['-'])
+        self.assertEqual(table.getValidMask('pH').tolist(),[True,True,True,False,True])
+        
+    def test_updateCol_does_not_convert_missing_values(self):
+        """MappingTable.updateCol skips conversion_fn for null reference values"""
+        table = self.InterpolationTable
+        table.updateCol('Description','GrowthRate',{2.0:'two'},conversion_fn=float)
+        self.assertEqual(table.getCol('Description')[1:4].tolist(),\
+          ['two','Sample.3.Description','Sample.4.Description'])
+        
+    def test_join_adds_columns_of_matching_rows(self):
+        """MappingTable.join gathers other's columns by key for each how"""
+        table = self.InterpolationTable
+        other = MappingTable(["#Temp\tSite\tGrowthRate\n","1.0\tA\t9.9\n",\
+          "2.0\tB\t9.9\n","9.0\tC\t9.9\n","1.0\tD\t9.9\n"])
+        
+        left = table.join(other,'Temp')
+        self.assertEqual(left.ColIds,table.ColIds+['Site'])
+        self.assertEqual(left.RowIds,table.RowIds)
+        self.assertEqual(left.getCol('Site').tolist(),\
+          ['D','B','Unknown','Unknown','D','Unknown','Unknown','Unknown'])
+        self.assertEqual(left.getCol('GrowthRate').tolist(),\
+          table.getCol('GrowthRate').tolist())
+        
+        inner = table.join(other,'Temp',how='inner',fill_value='NA')
+        self.assertEqual(inner.RowIds,['S.1','S.2','S.5'])
+        self.assertEqual(inner.Data[1],['S.2','2.0','2.0','Sample.2.Description','B'])
+        
+        outer = table.join(other,'Temp',how='outer',fill_value='NA')
+        self.assertEqual(outer.RowIds,table.RowIds+['9.0'])
+        self.assertEqual(outer.Data[-1],['9.0','9.0','9.9','NA','C'])
+        self.assertEqual(outer.RowIndices['9.0'],len(table.RowIds))
+        clashing = MappingTable(["#Temp\tSite\n","S.1\tA\n"])
+        self.assertRaises(ValueError,table.join,clashing,'Temp',how='outer')
+        self.assertRaises(ValueError,table.join,other,'Temp',how='cross')
+
+    def test_joinAll_matches_chained_joins(self):
+        """MappingTable.joinAll gives the same table as joining one table at a time"""
+        table = self.InterpolationTable
+        sites = MappingTable(["#Temp\tSite\n","1.0\tA\n","2.0\tB\n","3.0\tA\n"])
+        regions = MappingTable(["#Location\tRegion\tTemp\n","A\tNorth\t0.0\n"])
+        for how in ['left','inner','outer']:
+            exp = table.join(sites,'Temp',how=how).join(regions,'Site',how=how,\
+              other_on='Location')
+            obs = table.joinAll([sites,regions],['Temp','Site'],how=how,\
+              other_on=['Temp','Location'])
+            self.assertEqual(obs.delimitedSelf(),exp.delimitedSelf())
+        self.assertRaises(ValueError,table.joinAll,[sites,regions],['Temp'])
+
+    def test_joinNearest_matches_nearest_records(self):
+        """MappingTable.joinNearest joins records by nearest key within groups"""
+        samples = MappingTable(["#SampleID\tsite\tdepth\n","S1\ta\t1.0\n",\
+          "S2\ta\t4.0\n","S3\tb\t2.0\n","S4\tb\tUnknown\n","S5\tc\t3.0\n"])
+        records = MappingTable(["#site\tdepth\ttemp\tnote\n","a\t0.0\t10\tr1\n",\
+          "a\t2.0\t20\tr2\n","a\t5.0\t50\tr3\n","b\t2.0\t7\tr4\n","b\t2.0\t8\tr5\n"])
+        
+        obs = samples.joinNearest(records,'depth',by=['site'])
+        self.assertEqual(obs.ColIds,['SampleID','site','depth','temp','note'])
+        self.assertEqual(obs.getCol('temp').tolist(),['10','50','8','Unknown','Unknown'])
+        obs = samples.joinNearest(records,'depth',by=['site'],direction='backward')
+        self.assertEqual(obs.getCol('note').tolist()[:3],['r1','r2','r5'])
+        obs = samples.joinNearest(records,'depth',by=['site'],direction='forward')
+        self.assertEqual(obs.getCol('note').tolist()[:3],['r2','r3','r4'])
+        obs = samples.joinNearest(records,'depth',by=['site'],tolerance=0.5)
+        self.assertEqual(obs.getCol('note').tolist()[:3],['Unknown','Unknown','r5'])
+        obs = samples.joinNearest(records,'depth')
+        self.assertEqual(obs.getCol('note').tolist(),['r1','r3','r5','Unknown','r5'])
+        
+    def test_joinNearest_interpolates_between_records(self):
+        """MappingTable.joinNearest with method='linear' interpolates numeric fields"""
+        samples = MappingTable(["#SampleID\tdepth\n","S1\t1.0\n","S2\t4.0\n",\
+          "S3\t2.0\n","S4\t9.0\n"])
+        records = MappingTable(["#depth\ttemp\tnote\n","0.0\t10\tr1\n",\
+          "2.0\t20\tr2\n","5.0\t50\tr3\n"])
+        obs = samples.joinNearest(records,'depth',method='linear')
+        self.assertFloatEqual(obs.getNumericCol('temp')[0],[15.0,40.0,20.0,50.0])
+        self.assertEqual(obs.getCol('note').tolist(),['r1','r3','r2','r3'])
+        self.assertRaises(ValueError,samples.joinNearest,records,'depth',method='cubic')
+
+    def test_joinWindow_aggregates_readings_before_each_key(self):
+        """MappingTable.joinWindow summarizes readings in a window around each key"""
+        samples = MappingTable(["#SampleID\tsite\tday\n","S1\ta\t10\n",\
+          "S2\ta\t3\n","S3\tb\t10\n","S4\tb\tUnknown\n","S5\tc\t10\n"])
+        readings = MappingTable(["#site\tday\ttemp\n","a\t9\t20\n","a\t1\t5\n",\
+          "a\t7\t10\n","a\t11\t99\n","a\t8\tNA\n","b\t4\t1\n","b\t6\t3\n"])
+        obs = samples.joinWindow(readings,'day',['temp'],(-3,0),\
+          by=['site'],stats=['mean','min','max','count'])
+        self.assertEqual(obs.ColIds,['SampleID','site','day','temp_mean',\
+          'temp_min','temp_max','temp_count'])
+        self.assertEqual(obs.getCol('temp_mean').tolist(),\
+          ['15.0','5.0','Unknown','Unknown','Unknown'])
+        self.assertEqual(obs.getCol('temp_min').tolist()[:2],['10.0','5.0'])
+        self.assertEqual(obs.getCol('temp_max').tolist()[:2],['20.0','5.0'])
+        self.assertEqual(obs.getCol('temp_count').tolist(),['2','1','0','Unknown','0'])
+        obs = samples.joinWindow(readings,'day',['temp'],(-10,0),stats=['sum'])
+        self.assertEqual(obs.getCol('temp_sum').tolist(),\
+          ['39.0','5.0','39.0','Unknown','39.0'])
+        self.assertRaises(ValueError,samples.joinWindow,readings,'day',['temp'],\
+          (0,-3))
+        self.assertRaises(ValueError,samples.joinWindow,readings,'day',['temp'],\
+          (-3,0),stats=['median'])
+
+    def test_getDateCol_parses_dates_once_per_value(self):
+        """MappingTable.getDateCol parses yyyymmdd and other formats to datetime64 days"""
+        table = MappingTable(["#SampleID\tDate\tStart\n","S.1\t20120817\t20120801\n",\
+          "S.2\tUnknown\t20120801\n","S.3\t20120230\t20120801\n",\
+          "S.4\t2012-08-20\t20120801\n","S.5\t20120817\tNA\n"])
+        dates,valid = table.getDateCol('Date')
+        self.assertEqual(valid.tolist(),[True,False,False,False,True])
+        self.assertEqual(str(dates[0]),'2012-08-17')
+        dates,valid = table.getDateCol('Date',('%Y%m%d','%Y-%m-%d'))
+        self.assertEqual(valid.tolist(),[True,False,False,True,True])
+        self.assertEqual(str(dates[3]),'2012-08-20')
+        days,valid = table.daysBetween('Date','Start',('%Y%m%d','%Y-%m-%d'))
+        self.assertEqual(days.tolist(),[16,0,0,19,0])
+        self.assertEqual(valid.tolist(),[True,False,False,True,False])
+        days,valid = table.daysBetween('Date',date(2012,8,18))
+        self.assertEqual(days[valid].tolist(),[-1,-1])
+        table.updateCol('Date','SampleID',{'S.2':'20120818'})
+        self.assertEqual(table.getDateCol('Date')[1].tolist(),[True,True,False,False,True])
+
+    def test_timeToEvent_measures_from_first_event_per_individual(self):
+        """MappingTable.timeToEvent adds days and weeks since each individual's first event"""
+        table = MappingTable(["#SampleID\tIndividual\tDate\tHealth\tBleached\n",\
+          "A.1\tA\t20120801\tHealthy\tNo\n","A.2\tA\t20120815\tDSS\tNo\n",\
+          "A.3\tA\t20120808\tDSS\tYes\n","A.4\tA\tUnknown\tDSS\tNo\n",\
+          "B.1\tB\t20120801\tHealthy\tNo\n","B.2\tB\t20120901\tHealthy\tYes\n"])
+        obs = table.timeToEvent('Date',[('Health','DSS'),('Bleached','Yes')])
+        self.assertEqual(obs,['DaysAfterDSS','WeeksAfterDSS','DaysAfterYes','WeeksAfterYes'])
+        self.assertEqual(table.getCol('DaysAfterDSS').tolist(),\
+          ['-7','7','0','Unknown','Unknown','Unknown'])
+        self.assertEqual(table.getCol('WeeksAfterDSS').tolist(),\
+          ['-1.0','1.0','0.0','Unknown','Unknown','Unknown'])
+        self.assertEqual(table.getCol('WeeksAfterYes').tolist()[4:],['-4.0','0.0'])
+        obs = table.timeToEvent('Date',[('Health','DSS'),('Bleached','DSS')],weeks=False)
+        self.assertEqual(obs,['DaysAfterHealth_DSS','DaysAfterBleached_DSS'])
+        self.assertEqual(set(table.getCol('DaysAfterBleached_DSS').tolist()),set(['Unknown']))
+        self.assertRaises(ValueError,table.timeToEvent,'Date',[('Health','DSS')])
+
+    def test_addDerivedColumn_labels_rows_by_date_range(self):
+        """MappingTable.addDerivedColumn adds the value of an expression in each row"""
+        table = MappingTable(["#SampleID\tTreatment\tStart\tEnd\tDate\n",\
+          "S.1\tHerb\t20120801\t20120810\t20120731\n",\
+          "S.2\tHerb\t20120801\t20120810\t20120810\n",\
+          "S.3\tControl\t20120801\t20120810\t20120811\n",\
+          "S.4\tControl\t20120801\t20120810\tUnknown\n"])
+        obs = table.addDerivedColumn('Phase','if date(Date) < date(Start) then '+\
+          'Treatment+"_pre" elif date(Date) between date(Start) and date(End) '+\
+          'then Treatment else Treatment+"_post"')
+        self.assertEqual(obs,'Phase')
+        self.assertEqual(table.getCol('Phase').tolist(),\
+          ['Herb_pre','Herb','Control_post','Unknown'])
+        table.addDerivedColumn('Days','date(Date) - Start',fill_value='NA')
+        self.assertEqual(table.getCol('Days').tolist(),['-1','9','10','NA'])
+        values,valid = table.evaluateExpression('date(Date) + 1 > date("20120810")')
+        self.assertEqual(values.tolist(),[False,True,True,False])
+        self.assertEqual(valid.tolist(),[True,True,True,False])
+        self.assertRaises(ValueError,table.addDerivedColumn,'Days','1')
+
+    def test_mapRows_adds_results_of_a_function_in_row_order(self):
+        """MappingTable.mapRows calls a function on the requested columns of each row"""
+        table = MappingTable(["#SampleID\tSite\tDepth\n"]+\
+          ["S.%i\tReef %i\t%i\n" %(i,i%3,i) for i in range(25)])
+        label = lambda row: "%s:%s" %(row['Site'],sorted(row.keys()))
+        table.mapRows(label,'Label',columns=['Site','Depth'])
+        exp = ["Reef %i:['Depth', 'Site']" %(i%3) for i in range(25)]
+        self.assertEqual(table.getCol('Label').tolist(),exp)
+        table.mapRows(lambda row: int(row['Depth'])*2,'Double',jobs=3,chunksize=4)
+        self.assertEqual(table.getCol('Double').tolist(),[str(i*2) for i in range(25)])
+        self.assertRaises(ValueError,table.mapRows,label,'Label')
+        self.assertRaises(ValueError,table.mapRows,label,'Other',columns=['Temp'])
+
+    def test_pickled_table_keeps_data(self):
+        """MappingTable can be pickled, e.g. to pass between processes"""
+        table = self.InterpolationTable.subsetByIndex([4,1])
+        obs = loads(dumps(table,2))
+        self.assertEqual(obs.delimitedSelf(),table.delimitedSelf())
+        self.assertEqual(obs.RowIndices,{'S.5':0,'S.2':1})
+        obs.updateCol('GrowthRate','SampleID',{'S.5':'1.0'})
+        self.assertEqual(obs.getNumericCol('GrowthRate')[0].tolist(),[1.0,2.0])
+
+    def test_lazy_table_matches_eager_table(self):
+        """MappingTable with lazy=True gives the same data as an eager load"""
+        lines = self.InterpolationTableLines
+        eager = MappingTable(lines)
+        lazy = MappingTable(lines,lazy=True)
+        self.assertEqual(lazy.RowIds,eager.RowIds)
+        self.assertEqual(lazy.Data[6],eager.Data[6])
+        self.assertEqual(lazy.getCol('Temp').tolist(),eager.getCol('Temp').tolist())
+        self.assertEqual(lazy.Data[6],eager.Data[6])
+        lazy.updateColByInterpolation('GrowthRate','Temp')
+        eager.updateColByInterpolation('GrowthRate','Temp')
+        self.assertEqual(lazy.delimitedSelf(),eager.delimitedSelf())
+
+    def test_lazy_table_loads_columns_of_wide_and_short_lines(self):
+        """MappingTable with lazy=True loads columns in any order, padding short lines"""
+        lines = ["#SampleID\t"+"\t".join("C%i" %i for i in range(20))+"\n",\
+          "S.1\t"+"\t".join(str(i) for i in range(20))+"\n","S.2\ta\tb\n"]
+        lazy = MappingTable(lines,lazy=True)
+        self.assertEqual(lazy.getCol('C9').tolist(),['9',''])
+        self.assertEqual(lazy.getCol('C1').tolist(),['1','b'])
+        self.assertEqual(lazy.getCol('C19').tolist(),['19',''])
+        self.assertEqual(lazy.getCol('C17').tolist(),['17',''])
+        self.assertEqual(lazy.delimitedSelf(),MappingTable(lines).delimitedSelf())
+        
+    def test_table_loads_non_ascii_unicode_fields(self):
+        """MappingTable loads and groups unicode fields with non-ASCII characters"""
+        lines = [u"#SampleID\tSite\n",u"S.1\tR\xe9union\n",u"S.2\tAruba\n",\
+          u"S.3\tR\xe9union\n",u"S.4\tR\xe9union\n"]
+        table = MappingTable(lines)
+        self.assertEqual(table.getCol('Site').tolist(),\
+          [u"R\xe9union",u"Aruba",u"R\xe9union",u"R\xe9union"])
+        pool,codes = table.getCategoricalCol('Site')
+        self.assertEqual(pool.tolist(),[u"Aruba",u"R\xe9union"])
+        self.assertEqual(codes.tolist(),[1,0,1,1])
+        self.assertEqual(table.rowIndicesWithValue('Site',u"R\xe9union").tolist(),[0,2,3])
+
+    def test_lazy_table_checks_field_counts_at_load(self):
+        """MappingTable with lazy=True still rejects lines with too many fields"""
+        lines = ["#SampleID\tpH\n","S.1\t7.0\n","S.2\t7.1\textra\n"]
+        self.assertRaises(ValueError,MappingTable,lines,lazy=True)
+        table = MappingTable(["#SampleID\tpH\tSite\n","S.1\t7.0\n"],lazy=True)
+        self.assertEqual(table.getCol('Site').tolist(),[''])
+
+    def test_writeTable_matches_delimitedSelf(self):
+        """MappingTable.writeTable writes the same text as delimitedSelf in chunks"""
+        table = self.InterpolationTable
+        out = StringIO()
+        table.writeTable(out,rows_per_chunk=3)
+        self.assertEqual(out.getvalue(),"".join(table.delimitedSelf()))
+
+    def test_writeTable_selects_rows_and_cols(self):
+        """MappingTable.writeTable projects columns and limits rows"""
+        table = self.InterpolationTable
+        out = StringIO()
+        table.writeTable(out,limit_to_rows=['S.6','S.2'],cols=['Temp','SampleID'],\
+          write_comments=False)
+        self.assertEqual(out.getvalue(),"#Temp\tSampleID\n2.0\tS.2\n1.5\tS.6\n")
+        self.assertRaises(ValueError,table.writeTable,StringIO(),cols=['pH'])
+
+    def test_writeTable_replaces_path_atomically(self):
+        """MappingTable.writeTable to a path leaves only the finished file"""
+        table = self.InterpolationTable
+        out_dir = mkdtemp()
+        try:
+            out_path = join(out_dir,'out.txt')
+            open(out_path,'w').write('old contents')
+            table.writeTable(out_path,rows_per_chunk=2)
+            self.assertEqual(open(out_path).read(),"".join(table.delimitedSelf()))
+            self.assertRaises(ValueError,table.writeTable,out_path,cols=['pH'])
+            self.assertEqual(listdir(out_dir),['out.txt'])
+        finally:
+            rmtree(out_dir)
+
     def test_rowMatches(self):
         """MappingTable.rowMatches returns True for matching rows"""
         obs_table = self.ValidTable
@@ -301,6 +740,44 @@ class MappingTests(TestCase):
         
         self.assertEqualItems(obs,exp)
 
+    def test_rowsMatching_accepts_query_text(self):
+        """MappingTable.rowsMatching filters rows with query text"""
+        table = self.InterpolationTable
+        obs = [row_id for row_id,row in\
+          table.rowsMatching("Temp > 1.2 and GrowthRate:Unknown or SampleID = S.1")]
+        self.assertEqual(obs,['S.1','S.6','S.7','S.8'])
+
+    def test_rowMaskMatching_skips_nonnumeric_values(self):
+        """MappingTable.rowMaskMatching never matches 'Unknown' in numeric comparisons"""
+        table = self.InterpolationTable
+        obs = table.rowMaskMatching("GrowthRate < 2.5")
+        self.assertEqual(obs.tolist(),[False,True,True]+[False]*5)
+
+    def test_rowIndicesWithValue_uses_index_kept_current_by_updates(self):
+        """MappingTable.rowIndicesWithValue agrees with and without an index"""
+        table = self.InterpolationTable
+        self.assertEqual(table.rowIndicesWithValue('GrowthRate','Unknown').tolist(),\
+          [3,4,5,6,7])
+        table.createIndex('GrowthRate')
+        self.assertEqual(table.rowIndicesWithValue('GrowthRate','Unknown').tolist(),\
+          [3,4,5,6,7])
+        table.updateColByInterpolation('GrowthRate','Temp')
+        self.assertEqual(table.rowIndicesWithValue('GrowthRate','Unknown').tolist(),[])
+        self.assertEqual(table.rowIndicesWithValue('GrowthRate','3.0').tolist(),[0,3,4])
+        table.dropIndex('GrowthRate')
+        self.assertEqual(table.rowIndicesWithValue('GrowthRate','3.0').tolist(),[0,3,4])
+
+    def test_valueGroups_lists_rows_for_each_value(self):
+        """MappingTable.valueGroups maps each value to its row positions"""
+        table = self.InterpolationTable
+        exp = {'1.0':[0,4],'2.0':[1],'3.0':[2],'0.0':[3],'1.5':[5],\
+          '2.72':[6],'3.14':[7]}
+        obs = table.valueGroups('Temp')
+        self.assertEqual(dict((k,v.tolist()) for k,v in obs.items()),exp)
+        table.createIndex('Temp')
+        obs = table.valueGroups('Temp')
+        self.assertEqual(dict((k,v.tolist()) for k,v in obs.items()),exp)
+
     
 
 class MappingFunctionTests(TestCase):
@@ -326,5 +803,51 @@ class MappingFunctionTests(TestCase):
         self.assertFloatEqual(obs_x,exp_x)
         self.assertFloatEqual(obs_y,exp_y)
 
+    def test_make_criterion_from_text_parses_grammar(self):
+        """make_criterion_from_text handles :,=,<,>, and/or and parentheses"""
+        table = MappingTable(["#SampleID\tsite\tpH\n","a\tReef 1\t7.0\n",\
+          "b\tReef 2\t8.0\n","c\tReef 1\tUnknown\n"])
+        criterion = make_criterion_from_text(\
+          "(site:'Reef 2' or pH < 7.5) and SampleID = a")
+        self.assertEqual(criterion(table).tolist(),[True,False,False])
+        criterion = make_criterion_from_text('site = "Reef 1" OR pH > 7.5')
+        self.assertEqual(criterion(table).tolist(),[True,True,True])
+        
+    def test_make_criterion_from_text_rejects_bad_text(self):
+        """make_criterion_from_text raises ValueError on invalid criteria"""
+        for text in ["pH >","pH > high","(pH > 7","pH:7 site:a","and"]:
+            self.assertRaises(ValueError,make_criterion_from_text,text)
+
+    def test_make_expression_from_text_parses_grammar(self):
+        """make_expression_from_text handles arithmetic, comparisons, logic and functions"""
+        table = MappingTable(["#SampleID\tsite\tpH\tDepth\n","a\tReef 1\t7.0\t4\n",\
+          "b\tReef 2\t8.0\t10\n","c\tReef 1\tUnknown\t2\n"])
+        values,valid = make_expression_from_text("(pH + 1) * 2 - Depth/2")(table)
+        self.assertFloatEqual(values[valid],[14.0,13.0])
+        self.assertEqual(valid.tolist(),[True,True,False])
+        values,valid = make_expression_from_text(\
+          "[site] = 'Reef 1' and not Depth between 3 and 5 or not known(pH)")(table)
+        self.assertEqual(values.tolist(),[False,False,True])
+        values,valid = make_expression_from_text(\
+          "if pH > 7.5 then 'high' elif pH > 6 then round(pH) else site")(table)
+        self.assertEqual(values.values().tolist(),['7','high','Reef 1'])
+        self.assertEqual(valid.tolist(),[True,True,False])
+
+    def test_make_expression_from_text_reads_escaped_brackets(self):
+        """make_expression_from_text reads ]] in a bracketed column name as ]"""
+        table = MappingTable(["#SampleID\tDose [mg]\tpH\n","a\t5\t7.0\n"])
+        self.assertEqual(quote_expression_column('Dose [mg]'),'[Dose [mg]]]')
+        values,valid = make_expression_from_text("[Dose [mg]]] * 2 + [pH]")(table)
+        self.assertFloatEqual(values,[17.0])
+        self.assertRaises(ValueError,make_expression_from_text,"[Dose [mg]] * 2")
+
+    def test_make_expression_from_text_rejects_bad_text(self):
+        """make_expression_from_text raises ValueError on invalid expressions"""
+        table = MappingTable(["#SampleID\tpH\n","a\t7.0\n"])
+        for text in ["pH +","(pH","if pH > 7 then 1","pH > 7 pH","date(pH) + date(pH)"]:
+            self.assertRaises(ValueError,lambda: make_expression_from_text(text)(table))
+        self.assertRaises(ValueError,make_expression_from_text("pH and pH"),table)
+        self.assertRaises(ValueError,make_expression_from_text("Temp > 1"),table)
+
 if __name__ == '__main__':
     main()
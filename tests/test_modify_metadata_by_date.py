@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+
+"""Tests the modify_metadata_by_date script."""
+
+from cogent.util.unit_test import TestCase, main
+from mapping import MappingTable
+from modify_metadata_by_date import treatment_by_date_expression
+
+class ModifyMetadataByDateTests(TestCase):
+    """Tests of the modify_metadata_by_date script."""
+
+    def test_treatment_by_date_expression_quotes_column_names(self):
+        """treatment_by_date_expression works with ] in column names"""
+        table = MappingTable(["#SampleID\tTreatment [arm]\tDate\tStart]\tEnd\n",\
+          "S.1\tHerb\t20120731\t20120801\t20120810\n",\
+          "S.2\tHerb\t20120805\t20120801\t20120810\n",\
+          "S.3\tControl\t20120811\t20120801\t20120810\n"])
+        expression = treatment_by_date_expression('Treatment [arm]','Date',\
+          'Start]','End','_pre','_post')
+        table.addDerivedColumn('Phase',expression)
+        self.assertEqual(table.getCol('Phase').tolist(),\
+          ['Herb_pre','Herb','Control_post'])
+
+if __name__ == '__main__':
+    main()
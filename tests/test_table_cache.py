@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""Tests binary caching of parsed mapping tables."""
+
+from cogent.util.unit_test import TestCase, main
+from md_menagerie.table_cache import load_mapping_table,cache_path_for,evict_cache_files
+from md_menagerie import table_cache
+from md_menagerie.mapping import MappingTable
+from tempfile import mkdtemp
+from shutil import rmtree
+from os import listdir,utime
+from os.path import join,exists,getsize
+
+class TableCacheTests(TestCase):
+    """Tests of the table_cache module."""
+
+    def setUp(self):
+        """Write a mapping file to a temporary directory"""
+        self.MappingLines=\
+        ["#SampleID\tTemp\tGrowthRate\tDescription\n",\
+         "#Comment line, full of crazy comments\n",\
+         "S.1\t1.0\t3.0\tSample.1.Description\n",\
+         "S.2\t2.0\t\tSample.2.Description\n",\
+         "S.3\t3.0\t0.0\n"]
+        self.TempDir = mkdtemp()
+        self.MappingPath = join(self.TempDir,'mapping.txt')
+        open(self.MappingPath,'w').writelines(self.MappingLines)
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        rmtree(self.TempDir)
+
+    def test_load_mapping_table_matches_parsed_table(self):
+        """load_mapping_table gives the same table with and without a cache"""
+        exp = MappingTable(self.MappingLines)
+        first = load_mapping_table(self.MappingPath)
+        self.assertTrue(exists(cache_path_for(self.MappingPath)))
+        cached = load_mapping_table(self.MappingPath)
+        self.assertEqual(cached.Data[1],exp.Data[1])
+        self.assertEqual(cached.RowIds,exp.RowIds)
+        self.assertEqual(cached.delimitedSelf(),exp.delimitedSelf())
+        self.assertEqual(first.delimitedSelf(),exp.delimitedSelf())
+        cached.updateColByInterpolation('GrowthRate','Temp')
+        self.assertEqual(cached.getCol('GrowthRate').tolist(),['3.0','1.5','0.0'])
+
+    def test_load_mapping_table_rebuilds_stale_cache(self):
+        """load_mapping_table reparses a file that changed after caching"""
+        cache_dir = join(self.TempDir,'cache')
+        load_mapping_table(self.MappingPath,cache_dir=cache_dir)
+        new_lines = self.MappingLines + ["S.4\t4.0\t1.0\tSample.4.Description\n"]
+        open(self.MappingPath,'w').writelines(new_lines)
+        obs = load_mapping_table(self.MappingPath,cache_dir=cache_dir,check_content=True)
+        self.assertEqual(obs.RowIds,['S.1','S.2','S.3','S.4'])
+        self.assertEqual(len(listdir(cache_dir)),1)
+
+    def test_load_mapping_table_uses_cache_it_cannot_touch(self):
+        """load_mapping_table reads a cache even if its time can't be updated"""
+        load_mapping_table(self.MappingPath)
+        def fail(path,times):
+            raise OSError(1,"Operation not permitted",path)
+        original_utime = table_cache.os.utime
+        table_cache.os.utime = fail
+        try:
+            obs = load_mapping_table(self.MappingPath)
+        finally:
+            table_cache.os.utime = original_utime
+        self.assertEqual(obs.RowIds,['S.1','S.2','S.3'])
+
+    def test_evict_cache_files_removes_least_recently_used(self):
+        """evict_cache_files deletes the oldest cache files first"""
+        cache_dir = join(self.TempDir,'cache')
+        paths = []
+        for i in range(3):
+            path = join(self.TempDir,'mapping_%i.txt' %i)
+            open(path,'w').writelines(self.MappingLines)
+            load_mapping_table(path,cache_dir=cache_dir)
+            cache_path = cache_path_for(path,cache_dir)
+            utime(cache_path,(1000+i,1000+i))
+            paths.append(cache_path)
+        evict_cache_files(cache_dir,2*getsize(paths[0]))
+        self.assertEqual([exists(p) for p in paths],[False,True,True])
+
+if __name__ == '__main__':
+    main()